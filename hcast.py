@@ -1,8 +1,13 @@
-import string
+import copy
+import itertools
 import math
+import string
 from dataclasses import dataclass
 
 import hrminstr as hrmi
+import hcmultable
+import hccost
+import hcconst
 from hcexceptions import HCTypeError
 
 class HCInternalError(Exception):
@@ -54,7 +59,83 @@ def get_validate_func(method_name):
 	return validate_func
 
 validate_expr_branchable = get_validate_func("validate_branchable")
-validate_expr            = get_validate_func("validate")
+validate_expr_uncached   = get_validate_func("validate")
+
+# Validate an expression giving a number, as validate_expr_uncached, unless a
+# variable is known to already hold the value of an identical expression, in
+# which case it is replaced with a reference to that variable.
+def validate_expr(expr, namespace):
+	key = None
+	if isinstance(expr, AbstractBinaryOperator):
+		key = expr.get_value_key(namespace.values)
+
+	# Constant expressions are left to be folded instead
+	if key is not None and len(expr.get_namespace().names) == 0:
+		key = None
+
+	if key is not None:
+		name = namespace.values.find_variable(key)
+		if name is not None:
+			return (VariableRef(name), [])
+
+	new_expr, injected_stmts = validate_expr_uncached(expr, namespace)
+
+	if key is not None and isinstance(new_expr, VariableRef):
+		namespace.values.record(key, new_expr.name)
+
+	return (new_expr, injected_stmts)
+
+# Calculate side-effect-free values which appear more than once in an
+# expression in statements ahead of it, so that each is only calculated once.
+# Returns a list of validated statements to inject before the expression.
+def hoist_repeated_values(expr, namespace):
+	# The result of the expression may be assigned to a variable, but if
+	# anything else is assigned, the repeated values may differ.
+	while isinstance(expr, Assignment):
+		expr = expr.expr
+
+	if len(expr.get_namespace().assigned_names) > 0:
+		return []
+
+	counts = {}
+	def count_values(subexpr):
+		if not isinstance(subexpr, AbstractBinaryOperator):
+			return
+
+		key = subexpr.get_value_key(namespace.values)
+		if key is not None:
+			counts[key] = counts.get(key, 0) + 1
+
+		count_values(subexpr.left)
+		count_values(subexpr.right)
+
+	count_values(expr)
+
+	# Only the outermost repeated value is calculated ahead,
+	# as any values inside it are then only needed once.
+	stmts = []
+	def hoist_values(subexpr):
+		if not isinstance(subexpr, AbstractBinaryOperator):
+			return
+
+		key = subexpr.get_value_key(namespace.values)
+		if (counts.get(key, 0) < 2
+				or len(subexpr.get_namespace().names) == 0):
+			hoist_values(subexpr.left)
+			hoist_values(subexpr.right)
+			return
+
+		if namespace.values.find_variable(key) is not None:
+			return
+
+		# The expression is validated in place, so
+		# the copies left in the expression are untouched.
+		assign = ExprLine(Assignment(namespace.get_unique_name(),
+				copy.deepcopy(subexpr)))
+		stmts.extend(assign.validate(namespace))
+
+	hoist_values(expr)
+	return stmts
 
 class AbstractLine:
 	__slots__ = [
@@ -83,6 +164,13 @@ class AbstractLine:
 	def get_namespace(self):
 		raise NotImplementedError("AbstractLine.get_namespace", self)
 
+	# Set the line number of this statement, and of any statements inside it,
+	# where not already known. Statements generated by the compiler take the
+	# line number of the statement they were generated for.
+	def fill_lineno(self, lineno):
+		if self.lineno is None:
+			self.lineno = lineno
+
 # eg: init zero @ 10
 # eg: init zero = 0 @ 10
 class InitialValueDeclaration(AbstractLine):
@@ -191,11 +279,15 @@ class StatementList:
 
 			# If the validation function returns a Statement, replace the current one
 			if isinstance(result, AbstractLine):
+				result.fill_lineno(stmt.lineno)
 				self.stmts[i] = result
 
 			# If the validation returns a list of statements, replace the current one with all of them
 			elif (isinstance(result, list)
 					and all(isinstance(s, AbstractLine) for s in result)):
+				for new_stmt in result:
+					new_stmt.fill_lineno(stmt.lineno)
+
 				self.stmts[i:i+1] = result
 				i += len(result) - 1
 
@@ -218,6 +310,10 @@ class StatementList:
 
 		return ns
 
+	def fill_lineno(self, lineno):
+		for stmt in self.stmts:
+			stmt.fill_lineno(lineno)
+
 	def get_last_stmt(self):
 		if len(self.stmts) == 0:
 			return None
@@ -269,17 +365,37 @@ class Forever(StmtWithBody):
 	def get_namespace(self):
 		return self.body.get_namespace()
 
+	def fill_lineno(self, lineno):
+		super().fill_lineno(lineno)
+		self.body.fill_lineno(lineno)
+
 	def validate(self, namespace):
+		# Only values which the body doesn't change are known at its start
+		namespace.values.forget(self.get_namespace().assigned_names)
+		values = namespace.values.copy()
+
 		self.body.validate_structure(namespace)
+
+		namespace.values = values
 		return None
 
 	def __repr__(self):
 		return f"Forever({repr(self.body)})"
 
+# Number of times a loop is assumed to run each time it is entered,
+# when deciding whether it is worth making it faster
+ESTIMATED_LOOP_ITERATIONS = 8
+
 class While(StmtWithBody):
 	__slots__ = [
 		"condition",
 		"body",
+
+		# Cost model used to decide whether to rotate the loop
+		"cost_model",
+
+		# hcprofile.Profile of a previous run of the program, or None
+		"profile",
 	]
 
 	def __init__(self, cond, body=None):
@@ -287,6 +403,8 @@ class While(StmtWithBody):
 
 		self.condition = cond
 		self.body = body if body is not None else StatementList()
+		self.cost_model = hccost.DEFAULT_COST_MODEL
+		self.profile = None
 
 	def get_body(self):
 		return self.body
@@ -296,7 +414,16 @@ class While(StmtWithBody):
 		ns.merge(self.body.get_namespace())
 		return ns
 
+	def fill_lineno(self, lineno):
+		super().fill_lineno(lineno)
+		self.body.fill_lineno(lineno)
+
 	def validate(self, namespace):
+		# Only values which the loop doesn't change are known at its start,
+		# and those are all which are known after it, if it runs no times.
+		namespace.values.forget(self.get_namespace().assigned_names)
+		values = namespace.values.copy()
+
 		self.condition, injected_stmts_cond = validate_expr_branchable(
 				self.condition, namespace)
 
@@ -305,9 +432,18 @@ class While(StmtWithBody):
 					injected_stmts_cond, self.condition)
 
 		self.body.validate_structure(namespace)
+		self.cost_model = namespace.cost_model
+		self.profile = namespace.profile
 
+		namespace.values = values
 		return None
 	
+	# The loop is compiled with the condition at the end of the body, jumping
+	# back to the start of the body if it passes. If the loop is not rotated,
+	# the loop is entered at the condition. Otherwise, it is entered at a
+	# second copy of the condition, which guards the first run of the body.
+	# This saves jumping from the end of the body back to the condition, at
+	# the cost of the extra copy.
 	def create_block(self):
 		self.body.create_blocks()
 		exit_block = hrmi.Block(self.lineno)
@@ -318,8 +454,43 @@ class While(StmtWithBody):
 		for blk in self.body.get_exit_blocks():
 			blk.assign_next(cond_block.get_entry_block())
 
+		if self.should_rotate(cond_block, exit_block):
+			cond_block = self.condition.create_branch_block(
+					self.body, exit_block, self.lineno)
+
 		self.block = hrmi.CompoundBlock(cond_block, [exit_block])
 
+	# Decide whether to rotate the loop, given the condition at its end
+	def should_rotate(self, cond_block, exit_block):
+		if isinstance(self.condition, Boolean):
+			return False
+
+		body_entry = get_first_block(self.body)
+		cond_blocks = get_branch_blocks(cond_block, [body_entry, exit_block])
+
+		# A jump is only saved if the condition passes by jumping
+		# conditionally back to the start of the body. Otherwise, as for
+		# 'while x != 0', it must fall through to an unconditional jump back
+		# to the body, which is no better than jumping back to the condition.
+		if any(blk.next is not None and blk.next.dest is body_entry
+				for blk in cond_blocks):
+			return False
+
+		size = sum(blk.size() for blk in cond_blocks)
+		saved = self.estimate_iterations()
+		return self.cost_model.choose([False, True],
+				lambda rotate: (size, -saved) if rotate else (0, 0))
+
+	# Estimate the number of times the body runs each time the loop is entered
+	def estimate_iterations(self):
+		if self.profile is not None:
+			iterations = self.profile.get_loop_iterations(self.lineno,
+					[stmt.lineno for stmt in self.body.stmts])
+			if iterations is not None:
+				return iterations
+
+		return ESTIMATED_LOOP_ITERATIONS
+
 	def __repr__(self):
 		return (type(self).__name__ + "("
 			+ repr(self.condition) + ", "
@@ -367,12 +538,25 @@ class If(StmtWithBody):
 
 		return ns
 
+	def fill_lineno(self, lineno):
+		super().fill_lineno(lineno)
+		self.then_block.fill_lineno(lineno)
+
+		if self.else_block is not None:
+			self.else_block.fill_lineno(lineno)
+
 	def validate(self, namespace):
 		self.condition, injected_stmts = validate_expr_branchable(self.condition, namespace)
 
+		# Values known after the if statement must be known after either branch
+		values = namespace.values.copy()
 		self.then_block.validate_structure(namespace)
+		then_values = namespace.values
+
+		namespace.values = values
 		if self.else_block is not None:
 			self.else_block.validate_structure(namespace)
+		namespace.values.merge(then_values)
 
 		injected_stmts.append(self)
 		return injected_stmts
@@ -399,7 +583,11 @@ class AbstractLineWithExpr(AbstractLine):
 		self.expr = expr
 
 	def validate(self, namespace):
-		self.expr, injected_stmts = validate_expr(self.expr, namespace)
+		injected_stmts = hoist_repeated_values(self.expr, namespace)
+
+		self.expr, expr_injected = validate_expr(self.expr, namespace)
+		injected_stmts.extend(expr_injected)
+
 		injected_stmts.append(self)
 		return injected_stmts
 
@@ -442,6 +630,12 @@ class AbstractExpr:
 	def has_side_effects(self):
 		raise NotImplementedError("AbstractExpr.has_side_effects", self)
 
+	# Fetch a key, which is equal for any expressions giving the same value
+	# given the values held by variables in a ValueTable, or None if this
+	# expression's value may not be reused, such as if it has side effects.
+	def get_value_key(self, values):
+		return None
+
 	def get_namespace(self):
 		raise NotImplementedError("AbstractExpr.get_namespace", self)
 
@@ -468,12 +662,20 @@ class Assignment(AbstractExpr):
 		self.expr = expr
 
 	def validate(self, namespace):
+		key = self.expr.get_value_key(namespace.values)
 		self.expr, injected_stmts = validate_expr(self.expr, namespace)
+
+		if isinstance(self.expr, VariableRef):
+			namespace.values.assign_copy(self.name, self.expr.name)
+		else:
+			namespace.values.assign(self.name, key)
+
 		return (None, injected_stmts)
 
 	def get_namespace(self):
 		ns = self.expr.get_namespace()
 		ns.add_name(self.name)
+		ns.assigned_names.add(self.name)
 		return ns
 
 	def __repr__(self):
@@ -497,6 +699,9 @@ class Primitive(AbstractExpr):
 	def has_side_effects(self):
 		return False
 
+	def get_value_key(self, values):
+		return (type(self), self.value)
+
 	def __repr__(self):
 		return (type(self).__name__ + "(" + repr(self.value) + ")")
 
@@ -521,6 +726,38 @@ class Boolean(Primitive):
 def is_zero(expr):
 	return isinstance(expr, Number) and expr.value == 0
 
+# Find the first real block of a Block, CompoundBlock or StatementList
+def get_first_block(block):
+	block = block.get_entry_block()
+	while isinstance(block, hrmi.CompoundBlock):
+		block = block.first_block
+
+	return block
+
+# Find the blocks which make up a branch block created by create_branch_block,
+# which lead to any of the given target blocks.
+def get_branch_blocks(branch, targets):
+	blocks = []
+	to_check = [get_first_block(branch)]
+	while len(to_check) > 0:
+		blk = to_check.pop()
+		if blk in targets or blk in blocks:
+			continue
+
+		blocks.append(blk)
+		for jmp in (blk.conditional, blk.next):
+			if jmp is not None:
+				to_check.append(jmp.dest)
+
+	return blocks
+
+# Approximate number of instructions needed
+# to load a validated expression into the hands
+def estimate_size(expr):
+	block = hrmi.Block()
+	expr.add_to_block(block)
+	return len(block.instructions)
+
 class VariableRef(AbstractExpr):
 	__slots__ = ["name"]
 
@@ -538,6 +775,9 @@ class VariableRef(AbstractExpr):
 	def has_side_effects(self):
 		return False
 
+	def get_value_key(self, values):
+		return (VariableRef, values.get_variable_number(self.name))
+
 	def get_namespace(self):
 		return Namespace(self.name)
 
@@ -570,6 +810,10 @@ class AbstractBinaryOperator(AbstractExpr):
 		"right",
 	]
 
+	# True in subclasses if left and right operands may
+	# be swapped without affecting the operation.
+	commutative = False
+
 	def __init__(self, left, right):
 		self.left = left
 		self.right = right
@@ -577,6 +821,17 @@ class AbstractBinaryOperator(AbstractExpr):
 	def has_side_effects(self):
 		return self.left.has_side_effects() or self.right.has_side_effects()
 
+	def get_value_key(self, values):
+		left = self.left.get_value_key(values)
+		right = self.right.get_value_key(values)
+		if left is None or right is None:
+			return None
+
+		if self.commutative:
+			left, right = sorted((left, right), key=repr)
+
+		return (type(self), left, right)
+
 	def get_namespace(self):
 		ns_l = self.left.get_namespace()
 		ns_r = self.right.get_namespace()
@@ -591,10 +846,6 @@ class AbstractBinaryOperator(AbstractExpr):
 class AbstractAdditiveOperator(AbstractBinaryOperator):
 	hctype = Number
 
-	# True in subclasses if left and right operands may
-	# be swapped without affecting the operation.
-	commutative = False
-
 	# True in subclasses if the right operand is negated by the operation
 	negate_right_operand = False
 
@@ -623,13 +874,7 @@ class AbstractAdditiveOperator(AbstractBinaryOperator):
 		if isinstance(self.left, Number) and self.commutative:
 			self.left, self.right = self.right, self.left
 		if isinstance(self.right, Number) and not self.pseudo:
-			added_name = namespace.get_unique_name()
-			injected_stmts.append(ExprLine(Assignment(added_name, self.left)))
-			injected_stmts.extend(ExprLine(
-					(Decrement if self.negate_right_operand
-						else Increment)(added_name))
-					for _ in range(self.right.value))
-			return (VariableRef(added_name), injected_stmts)
+			return self.validate_constant_right(namespace, injected_stmts)
 
 		if not self.negate_right_operand and is_zero(self.left):
 			return (self.right, injected_stmts)
@@ -686,6 +931,58 @@ class AbstractAdditiveOperator(AbstractBinaryOperator):
 
 		return (None, injected_stmts)
 
+	# Lower the addition or subtraction of a constant right operand. The
+	# constant may be added by bumping a copy of the left operand once for
+	# each unit, or by building the constant in a tile, and adding that.
+	def validate_constant_right(self, namespace, injected_stmts):
+		delta = self.right.value
+		if self.negate_right_operand:
+			delta = -delta
+
+		# Saving the copy, then bumping it
+		bump_cost = abs(delta) + 1
+
+		# Building the constant, saving it, then adding it. Where a tile is
+		# initialised with the constant, it may be added directly instead.
+		# The left operand is saved first, since the constant is built from
+		# known values, and may overwrite the hands.
+		if abs(delta) in namespace.initial_values.values():
+			tile_cost = 1
+		else:
+			tile_cost = hcconst.estimate_constant_size(abs(delta),
+					namespace.initial_values) + 2
+
+			if not isinstance(self.left, VariableRef):
+				tile_cost += 1
+
+		use_tile = namespace.cost_model.choose([False, True],
+				lambda use_tile: (tile_cost, tile_cost) if use_tile
+					else (bump_cost, bump_cost))
+
+		if use_tile:
+			if not isinstance(self.left, VariableRef):
+				left_name = namespace.get_unique_name()
+				injected_stmts.append(ExprLine(Assignment(left_name,
+						self.left)))
+				self.left = VariableRef(left_name)
+
+			const_name = namespace.get_unique_name()
+			injected_stmts.append(ExprLine(Assignment(const_name,
+					Number(abs(delta)))))
+
+			expr = (Add if delta > 0 else Subtract)(self.left,
+					VariableRef(const_name))
+			expr, expr_injected = validate_expr(expr, namespace)
+			injected_stmts.extend(expr_injected)
+			return (expr, injected_stmts)
+
+		added_name = namespace.get_unique_name()
+		injected_stmts.append(ExprLine(Assignment(added_name, self.left)))
+		injected_stmts.extend(ExprLine(
+				(Increment if delta > 0 else Decrement)(added_name))
+				for _ in range(abs(delta)))
+		return (VariableRef(added_name), injected_stmts)
+
 	# Evaluate the value of the expression given statically
 	def eval_static(self, left, right):
 		raise NotImplementedError("AbstractAdditiveOperator.eval_static",
@@ -710,6 +1007,14 @@ class Subtract(AbstractAdditiveOperator):
 	negate_right_operand = True
 
 	def add_to_block(self, block):
+		# The difference of two variables may already be in the hands,
+		# if it was needed for an earlier comparison.
+		if (isinstance(self.left, VariableRef)
+				and isinstance(self.right, VariableRef)):
+			block.add_instruction(hrmi.LoadDifference(self.left.name,
+					self.right.name))
+			return
+
 		self.left.add_to_block(block)
 
 		if isinstance(self.right, VariableRef):
@@ -729,6 +1034,10 @@ class Difference(AbstractAdditiveOperator):
 	commutative = True
 	pseudo = True
 
+	# Either order may be chosen, so the value is not known
+	def get_value_key(self, values):
+		return None
+
 	def add_to_block(self, block):
 		if not isinstance(self.left, VariableRef) or not isinstance(self.right, VariableRef):
 			raise HCInternalError("Unable to convert Difference "
@@ -736,163 +1045,89 @@ class Difference(AbstractAdditiveOperator):
 
 		block.add_instruction(hrmi.Difference(self.left.name, self.right.name))
 
-_primes = [2]
-
-def get_primes():
-	for p in _primes:
-		yield p
-
-	i = _primes[-1]
-	while True:
-		i += 1
-		is_prime = True
-
-		for p in _primes:
-			quot, rem = divmod(i, p)
-
-			if rem == 0:
-				is_prime = False
-				break
-
-			if quot < p:
-				break
-
-		if is_prime:
-			_primes.append(i)
-			yield i
-
-def prime_factors(n):
-	if n == 1:
-		return [1]
-
-	factors = []
-
-	primes = get_primes()
-	p = next(primes)
-	while n != 1:
-		quot, rem = divmod(n, p)
-
-		if rem == 0:
-			factors.append(p)
-			n = quot
-		elif quot < p:
-			factors.append(n)
-			break
-		else:
-			p = next(primes)
-
-	return factors
-
-# Holds a strategy for multiplying up to a large number.
-# Consists of a series of multiplications (factors),
-# then a small addition (offset).
+# Holds a strategy for multiplying by a constant using only addition.
+# Consists of a chain of operations, each of which either adds a previously
+# saved value to the running product, or saves the running product so that
+# it can be added again later. See hcmultable for more details.
 class MultiplicationStrategy:
 	__slots__ = [
-		"factors",
-		"offset",
+		"operations",
 
 		# Value this strategy will multiply up to
 		"value",
 
-		# Estimated number of instructions taken
-		# to perform this multiplication.
+		# Number of instructions taken to perform this multiplication.
+		# Each instruction is run exactly once, so this is also the number
+		# of steps taken, and the shortest chain is best under any cost model.
 		"instructions",
 	]
 
-	def __init__(self, factors, offset):
-		self.factors = sorted(factors, reverse=True)
-		self.offset = offset
-
-		self.value = math.prod(factors) + offset
-
-		for i in range(len(self.factors)):
-			f = self.factors[i]
-			if f > 5 and f < self.value:
-				self.factors[i] = find_multiplication_strategy(f)
-
-		self.instructions = self.offset
-		for f in self.factors:
-			if isinstance(f, MultiplicationStrategy):
-				self.instructions += f.instructions
-			else:
-				self.instructions += f
+	def __init__(self, operations):
+		self.operations = operations
+		self.value = hcmultable.evaluate_chain(operations)
+		self.instructions = len(operations)
 
 	def __str__(self):
-		return (" * ".join(f"({f})" if isinstance(f, MultiplicationStrategy)
-					else str(f) for f in self.factors)
-				+ (" + " + str(self.offset) if self.offset != 0 else ""))
+		symbols = {
+			hcmultable.OP_ADD: "+",
+			hcmultable.OP_SUB: "-",
+		}
+
+		return " ".join("save" if opcode == hcmultable.OP_SAVE
+					else symbols[opcode] + str(idx)
+				for opcode, idx in self.operations)
 
 # Lookup table for memoising multiplication stategies
 _multiplication_stategies = {}
 
 # Find the best strategy for multiplying by addition.
-# Returns (a list of prime factors, and number to add at the end)
-# Any value in the prime factors could be replaced
-# with another tuple of a similar form.
+# Strategies are looked up from the precomputed table in hcmultable.
 def find_multiplication_strategy(n):
 	if n in _multiplication_stategies:
 		return _multiplication_stategies[n]
 
-	best_strategy = None
+	strategy = MultiplicationStrategy(hcmultable.get_chain(n))
 
-	i = 0
-	while best_strategy is None or i < best_strategy.instructions:
-		product = n - i
-		factors = prime_factors(product)
-
-		strategy = MultiplicationStrategy(factors, i)
-
-		if (best_strategy is None
-				or strategy.instructions < best_strategy.instructions):
-			best_strategy = strategy
-
-		i += 1
-
-	_multiplication_stategies[n] = best_strategy
-	return best_strategy
-
-# Nest repeated addition nodes
-def nest_addition(expr, n):
-	if n == 0:
-		return Number(0)
-
-	if n == 1:
-		return expr
-
-	return Add(nest_addition(expr, n - 1), expr)
+	_multiplication_stategies[n] = strategy
+	return strategy
 
 # Expand a multiplication strategy into its various additions and assignments.
+# expr must be a VariableRef, since its value will be added several times.
 # Returns (the new expression which holds the result of the multiplication,
 # and a list of injected statements used in the calculation)
 def expand_multiplication_strategy(strategy, expr, namespace):
-	if isinstance(strategy, int):
-		return (nest_addition(expr, strategy), [])
-
 	injected_stmts = []
-	working_product = expr
-	for fact in strategy.factors:
-		working_product, fact_stmts = expand_multiplication_strategy(
-				fact, working_product, namespace)
-		injected_stmts.extend(fact_stmts)
-
-		var_name = namespace.get_unique_name()
-		injected_stmts.append(ExprLine(Assignment(var_name, working_product)))
-		working_product = VariableRef(var_name)
 
-	offset_add = nest_addition(expr, strategy.offset)
-	final_add = Add(working_product, offset_add)
+	saved = [expr]
+	working_product = expr
+	for opcode, idx in strategy.operations:
+		if opcode == hcmultable.OP_SAVE:
+			working_product, save_stmts = validate_expr(
+					working_product, namespace)
+			injected_stmts.extend(save_stmts)
+
+			var_name = namespace.get_unique_name()
+			injected_stmts.append(ExprLine(
+					Assignment(var_name, working_product)))
+			working_product = VariableRef(var_name)
+			saved.append(working_product)
+		elif opcode == hcmultable.OP_ADD:
+			working_product = Add(working_product, saved[idx])
+		else:
+			working_product = Subtract(working_product, saved[idx])
 
-	final_add, injected_final = validate_expr(final_add, namespace)
+	working_product, injected_final = validate_expr(working_product, namespace)
 	injected_stmts.extend(injected_final)
 
-	return (final_add, injected_stmts)
+	return (working_product, injected_stmts)
 
 # Find an efficient way to multiply an expression by a constant using only addition.
 # Returns (a new expression node, and a list of injected statements)
 def validate_expr_mul_const(expr, n, namespace):
 	injected_stmts = []
 
-	if expr.has_side_effects() and n > 1:
+	# The operand is added several times, so it must be evaluated only once.
+	if not isinstance(expr, VariableRef) and n != 1:
 		var_name = namespace.get_unique_name()
 		new_assign = ExprLine(Assignment(var_name, expr))
 		injected_stmts.append(new_assign)
@@ -906,8 +1141,271 @@ def validate_expr_mul_const(expr, n, namespace):
 
 	return (expanded_expr, injected_stmts)
 
+# Negate the value of a variable without using a constant.
+def negate_var(name):
+	return Subtract(Subtract(VariableRef(name), VariableRef(name)),
+			VariableRef(name))
+
+# Statements which reorder the operands of a runtime multiplication so that
+# the multiplier is not negative, and is no larger than the magnitude of the
+# multiplicand. Since products are limited to 999, the multiplier is then
+# at most 31, unless the product is out of range anyway.
+# If order_magnitude is False, only the sign of the multiplier is corrected.
+def order_runtime_mul_operands(multiplicand_name, multiplier_name, namespace,
+		order_magnitude=True):
+	mcand  = lambda: VariableRef(multiplicand_name)
+	mplier = lambda: VariableRef(multiplier_name)
+
+	# (-a) * (-b) == a * b
+	fix_sign = If(CompareLt(mplier(), Number(0)), StatementList([
+		ExprLine(Assignment(multiplier_name, negate_var(multiplier_name))),
+		ExprLine(Assignment(multiplicand_name,
+				negate_var(multiplicand_name))),
+	]))
+
+	if not order_magnitude:
+		return [fix_sign]
+
+	tmp_name = namespace.get_unique_name()
+
+	return [
+		fix_sign,
+
+		If(CompareLt(mcand(), Number(0)), StatementList([
+			# Swap, negating both operands so the multiplier stays positive
+			If(CompareGt(Add(mcand(), mplier()), Number(0)), StatementList([
+				ExprLine(Assignment(tmp_name, mcand())),
+				ExprLine(Assignment(multiplicand_name,
+						negate_var(multiplier_name))),
+				ExprLine(Assignment(multiplier_name, negate_var(tmp_name))),
+			])),
+		]), StatementList([
+			If(CompareLt(mcand(), mplier()), StatementList([
+				ExprLine(Assignment(tmp_name, mcand())),
+				ExprLine(Assignment(multiplicand_name, mplier())),
+				ExprLine(Assignment(multiplier_name, VariableRef(tmp_name))),
+			])),
+		])),
+	]
+
+# Largest multiplier which can be multiplied by a value of
+# equal or greater magnitude to give a product within HRM's range.
+RUNTIME_MUL_MAX_MULTIPLIER = math.isqrt(hrmi.MAX_VALUE)
+
+# Base class for strategies used to lower an operation which HRM has no
+# instruction for, such as multiplication or division of runtime values.
+# The number of steps taken by a strategy depends on some value n, such as the
+# multiplier, and is estimated as a linear function of n, and of the number of
+# bits in n.
+class AbstractLoweringStrategy:
+	# Approximate number of instructions generated
+	size = None
+
+	# Steps taken are roughly steps_zero when n is zero, otherwise:
+	#   steps_base + steps_per_unit * n + steps_per_bit * n.bit_length()
+	steps_zero     = 0
+	steps_base     = 0
+	steps_per_unit = 0
+	steps_per_bit  = 0
+
+	def estimate_steps(self, n):
+		if n == 0:
+			return self.steps_zero
+
+		return (self.steps_base
+			+ self.steps_per_unit * n
+			+ self.steps_per_bit  * n.bit_length())
+
+	def __repr__(self):
+		return type(self).__name__ + "()"
+
+# Strategies for multiplying two values which are not known until runtime.
+# Each builds statements which store the product of the multiplicand and
+# multiplier in the named product variable. The multiplier is assumed to
+# have been ordered by order_runtime_mul_operands. Sizes and steps include
+# those of ordering the operands.
+class RuntimeMultiplicationStrategy(AbstractLoweringStrategy):
+	# False in subclasses which only need the sign of the multiplier to be
+	# corrected, rather than the operands to be fully ordered.
+	ordered = True
+
+	def build(self, multiplicand_name, multiplier_name, product_name,
+			namespace):
+		raise NotImplementedError("RuntimeMultiplicationStrategy.build", self)
+
+	# Average number of steps taken over the pairs of non-negative operands
+	# with a product in range. Values in HRM inboxes tend to be small, so
+	# rather than every pair being equally likely, each operand v is given
+	# a weight of 1 / (v + 1), making each order of magnitude about as likely
+	# as the next. With a uniform weighting, large multiplicands dominate,
+	# which makes the multiplier look larger than it usually is.
+	def expected_steps(self):
+		max_multiplier = (RUNTIME_MUL_MAX_MULTIPLIER if self.ordered
+				else hrmi.MAX_VALUE)
+
+		total_steps = 0
+		total_weight = 0
+		for n in range(max_multiplier + 1):
+			# Multiplicands giving a product in range,
+			# which must be at least n if the operands are ordered.
+			smallest = n if self.ordered else 0
+			largest = hrmi.MAX_VALUE // n if n > 0 else hrmi.MAX_VALUE
+			weight = sum(1 / (m + 1) for m in range(smallest, largest + 1))
+			weight /= n + 1
+
+			total_steps += weight * self.estimate_steps(n)
+			total_weight += weight
+
+		return total_steps / total_weight
+
+# Repeatedly add the multiplicand to the product, once for each unit of
+# the multiplier. Small, but takes time linear in the multiplier.
+# The multiplier is negated, then counted up to zero, so that if the loop
+# is rotated, its condition can jump straight back to the start of the body.
+class LinearMultiplication(RuntimeMultiplicationStrategy):
+	size = 48
+
+	steps_zero     = 16
+	steps_base     = 17
+	steps_per_unit = 5
+
+	def build(self, multiplicand_name, multiplier_name, product_name,
+			namespace):
+		return [
+			ExprLine(Assignment(product_name, Subtract(
+					VariableRef(multiplier_name),
+					VariableRef(multiplier_name)))),
+			ExprLine(Assignment(multiplier_name, Subtract(
+					VariableRef(product_name),
+					VariableRef(multiplier_name)))),
+			While(CompareLt(VariableRef(multiplier_name), Number(0)),
+					StatementList([
+				ExprLine(Assignment(product_name, Add(VariableRef(product_name),
+						VariableRef(multiplicand_name)))),
+				ExprLine(Increment(multiplier_name)),
+			])),
+		]
+
+# Linear multiplication without first swapping the operands to make the
+# multiplier the smaller of the two. Smaller again, but the multiplier may be
+# anything up to 999. Counts the multiplier down to zero instead, which saves
+# negating it.
+class UnorderedLinearMultiplication(LinearMultiplication):
+	ordered = False
+
+	size = 21
+
+	steps_zero     = 11
+	steps_base     = 11
+	steps_per_unit = 7
+
+	def build(self, multiplicand_name, multiplier_name, product_name,
+			namespace):
+		return [
+			ExprLine(Assignment(product_name, Subtract(
+					VariableRef(multiplier_name),
+					VariableRef(multiplier_name)))),
+			While(CompareNe(VariableRef(multiplier_name), Number(0)),
+					StatementList([
+				ExprLine(Assignment(product_name, Add(VariableRef(product_name),
+						VariableRef(multiplicand_name)))),
+				ExprLine(Decrement(multiplier_name)),
+			])),
+		]
+
+# Binary decomposition of the multiplier. A power of two is doubled until it is
+# the highest bit of the multiplier. Then the product is built up from the top
+# bit down: the product is doubled once for each bit, and the multiplicand is
+# added for each bit which is set. Rather than halving the power of two for each
+# lower bit, which HRM has no cheap way of doing, the remainder of the
+# multiplier is doubled instead. Takes time logarithmic in the multiplier, at
+# the cost of a larger program.
+class BinaryMultiplication(RuntimeMultiplicationStrategy):
+	size = 167
+
+	steps_zero    = 14
+	steps_base    = 3
+	steps_per_bit = 18
+
+	# Highest bit of the multiplier to check for. Multipliers of 32 or more are
+	# treated as having this bit set, which overflows, as the product would
+	# have anyway.
+	max_bit = RUNTIME_MUL_MAX_MULTIPLIER.bit_length()
+
+	def build(self, multiplicand_name, multiplier_name, product_name,
+			namespace):
+		mcand   = lambda: VariableRef(multiplicand_name)
+		mplier  = lambda: VariableRef(multiplier_name)
+		product = lambda: VariableRef(product_name)
+
+		power_name = namespace.get_unique_name()
+		power = lambda: VariableRef(power_name)
+
+		diff_name = namespace.get_unique_name()
+
+		# Double the product, then add the multiplicand
+		# if the next bit of the multiplier is set.
+		def next_bit():
+			return [
+				ExprLine(Assignment(product_name, Add(product(), product()))),
+				ExprLine(Assignment(multiplier_name,
+						Add(mplier(), mplier()))),
+				ExprLine(Assignment(diff_name, Subtract(mplier(), power()))),
+				If(CompareGe(VariableRef(diff_name), Number(0)),
+						StatementList([
+					ExprLine(Assignment(multiplier_name,
+							VariableRef(diff_name))),
+					ExprLine(Assignment(product_name,
+							Add(product(), mcand()))),
+				])),
+			]
+
+		# Statements to multiply once the multiplier is known to have
+		# the given bit, or a higher one, set. Each level which finds a
+		# higher bit set handles one more of the lower bits afterwards.
+		def build_level(bit):
+			top_bit = [ExprLine(Assignment(product_name, mcand()))]
+			if bit > 0:
+				top_bit.insert(0, ExprLine(Assignment(multiplier_name,
+						Subtract(mplier(), power()))))
+
+			if bit == self.max_bit:
+				return top_bit
+
+			return [
+				If(CompareGe(Subtract(Subtract(mplier(), power()), power()),
+						Number(0)), StatementList([
+					ExprLine(Assignment(power_name, Add(power(), power()))),
+					*build_level(bit + 1),
+					*next_bit(),
+				]), StatementList(top_bit)),
+			]
+
+		return [
+			If(CompareNe(mplier(), Number(0)), StatementList([
+				ExprLine(Assignment(power_name, Subtract(mplier(), mplier()))),
+				ExprLine(Increment(power_name)),
+				*build_level(0),
+			]), StatementList([
+				ExprLine(Assignment(product_name, mplier())),
+			])),
+		]
+
+RUNTIME_MULTIPLICATION_STRATEGIES = [
+	UnorderedLinearMultiplication(),
+	LinearMultiplication(),
+	BinaryMultiplication(),
+]
+
+# Pick the strategy for multiplying two values at runtime
+# which is cheapest under the given cost model.
+def choose_runtime_multiplication(cost_model):
+	return cost_model.choose(RUNTIME_MULTIPLICATION_STRATEGIES,
+			lambda s: (s.size, s.expected_steps()))
+
 class Multiply(AbstractBinaryOperator):
 	hctype = Number
+	commutative = True
 
 	def validate(self, namespace):
 		self.left,  injected_stmts       = validate_expr(self.left,  namespace)
@@ -932,7 +1430,7 @@ class Multiply(AbstractBinaryOperator):
 
 			return (Number(0), injected_stmts)
 
-		if right_const and self.right.value > 0:
+		if right_const:
 			expr, injected_stmts_mul = validate_expr_mul_const(
 					self.left, self.right.value, namespace)
 			injected_stmts.extend(injected_stmts_mul)
@@ -943,36 +1441,387 @@ class Multiply(AbstractBinaryOperator):
 		multiplicand_name = namespace.get_unique_name()
 		injected_stmts.append(ExprLine(
 				Assignment(multiplicand_name, self.left)))
-		self.left = VariableRef(multiplicand_name)
 
 		multiplier_name = namespace.get_unique_name()
 		injected_stmts.append(ExprLine(
 				Assignment(multiplier_name, self.right)))
-		self.right = VariableRef(multiplier_name)
 
 		product_name = namespace.get_unique_name()
 
-		injected_stmts.extend([
-			# Swap operands to ensure multiplier <= multiplicand
-			If(CompareLt(Subtract(VariableRef(multiplicand_name),
-					VariableRef(multiplier_name)), Number(0)), StatementList([
-				ExprLine(Assignment(product_name,
-						VariableRef(multiplicand_name))),
-				ExprLine(Assignment(multiplicand_name,
-						VariableRef(multiplier_name))),
-				ExprLine(Assignment(multiplier_name,
-						VariableRef(product_name))),
+		strategy = choose_runtime_multiplication(namespace.cost_model)
+		stmts = StatementList([
+			*order_runtime_mul_operands(multiplicand_name, multiplier_name,
+				namespace, strategy.ordered),
+			*strategy.build(multiplicand_name, multiplier_name,
+				product_name, namespace),
+		])
+		stmts.validate_structure(namespace)
+		injected_stmts.extend(stmts.stmts)
+
+		return (VariableRef(product_name), injected_stmts)
+
+# Strategies for dividing a non-negative dividend by a positive divisor.
+# Each builds statements which store the quotient and/or the remainder in
+# the named variables. Either name may be None if that result is not needed.
+# The dividend variable is used as working space, so is overwritten.
+# Steps are estimated in terms of the quotient.
+class DivisionStrategy(AbstractLoweringStrategy):
+	def build(self, dividend_name, divisor_name, quotient_name,
+			remainder_name, namespace):
+		raise NotImplementedError("DivisionStrategy.build", self)
+
+	# Average number of steps taken to divide by the given divisor, or by any
+	# divisor if it is None, assuming that each quotient is equally likely for
+	# any given divisor.
+	def expected_steps(self, divisor=None):
+		total_steps = 0
+		total_weight = 0
+		for quotient in range(hrmi.MAX_VALUE // (divisor or 1) + 1):
+			# Number of divisors which may give this quotient
+			weight = 1
+			if divisor is None:
+				weight = (hrmi.MAX_VALUE // quotient if quotient > 0
+						else hrmi.MAX_VALUE)
+
+			total_steps += weight * self.estimate_steps(quotient)
+			total_weight += weight
+
+		return total_steps / total_weight
+
+# Repeatedly subtract the divisor, once for each unit of the quotient.
+# Small, but takes time linear in the quotient.
+class RepeatedSubtraction(DivisionStrategy):
+	size = 8
+
+	steps_zero     = 16
+	steps_base     = 16
+	steps_per_unit = 6
+
+	def build(self, dividend_name, divisor_name, quotient_name,
+			remainder_name, namespace):
+		diff_name = namespace.get_unique_name()
+
+		stmts = []
+		if quotient_name is not None:
+			stmts.append(ExprLine(Assignment(quotient_name, Subtract(
+					VariableRef(dividend_name), VariableRef(dividend_name)))))
+
+		body = [ExprLine(Assignment(dividend_name, VariableRef(diff_name)))]
+		if quotient_name is not None:
+			body.append(ExprLine(Increment(quotient_name)))
+		body.append(ExprLine(Assignment(diff_name, Subtract(
+				VariableRef(dividend_name), VariableRef(divisor_name)))))
+
+		stmts.extend([
+			ExprLine(Assignment(diff_name, Subtract(
+					VariableRef(dividend_name), VariableRef(divisor_name)))),
+			While(CompareGe(VariableRef(diff_name), Number(0)),
+					StatementList(body)),
+		])
+
+		if remainder_name is not None:
+			stmts.append(ExprLine(Assignment(remainder_name,
+					VariableRef(dividend_name))))
+
+		return stmts
+
+# Long division. The divisor is doubled until it is the largest such multiple
+# which fits into the dividend, then the quotient is found one bit at a time,
+# from the top down. Rather than halving the multiple for each lower bit, which
+# HRM has no cheap way of doing, the remainder is doubled instead. This leaves
+# the remainder scaled by a power of two, so when the true remainder is needed,
+# the product of the quotient and divisor is built up alongside the quotient,
+# and subtracted from the dividend at the end. Takes time logarithmic in the
+# quotient.
+class LongDivision(DivisionStrategy):
+	size = 39
+
+	steps_zero    = 17
+	steps_base    = 5
+	steps_per_bit = 23
+
+	def build(self, dividend_name, divisor_name, quotient_name,
+			remainder_name, namespace):
+		dividend = lambda: VariableRef(dividend_name)
+		divisor  = lambda: VariableRef(divisor_name)
+
+		# Scaled remainder. This may use the dividend itself,
+		# unless the dividend is needed to find the true remainder.
+		scaled_name = dividend_name
+		if remainder_name is not None:
+			scaled_name = namespace.get_unique_name()
+		scaled = lambda: VariableRef(scaled_name)
+
+		# Product of the quotient found so far and the divisor
+		product_name = namespace.get_unique_name()
+		product = lambda: VariableRef(product_name)
+
+		multiple_name = namespace.get_unique_name()
+		multiple = lambda: VariableRef(multiple_name)
+
+		bits_name = namespace.get_unique_name()
+		diff_name = namespace.get_unique_name()
+
+		want_quotient  = quotient_name  is not None
+		want_remainder = remainder_name is not None
+
+		# Double the results so far, then take the multiple from the
+		# doubled remainder if it fits. The remainder is always less than the
+		# multiple, but may be more than half of it, so the test is made
+		# without doubling it first, to avoid overflowing.
+		next_bit = [ExprLine(Decrement(bits_name))]
+		next_bit_taken = [
+			ExprLine(Assignment(scaled_name, VariableRef(diff_name))),
+		]
+		next_bit_not_taken = [
+			ExprLine(Assignment(scaled_name, Add(scaled(), scaled()))),
+		]
+
+		if want_quotient:
+			next_bit.append(ExprLine(Assignment(quotient_name,
+					Add(VariableRef(quotient_name),
+						VariableRef(quotient_name)))))
+			next_bit_taken.append(ExprLine(Increment(quotient_name)))
+		if want_remainder:
+			next_bit.append(ExprLine(Assignment(product_name,
+					Add(product(), product()))))
+			next_bit_taken.append(ExprLine(Assignment(product_name,
+					Add(product(), divisor()))))
+
+		next_bit.extend([
+			ExprLine(Assignment(diff_name,
+					Add(Subtract(scaled(), multiple()), scaled()))),
+			If(CompareGe(VariableRef(diff_name), Number(0)),
+				StatementList(next_bit_taken),
+				StatementList(next_bit_not_taken)),
+		])
+
+		# The top bit of the quotient is set
+		top_bit = [ExprLine(Assignment(scaled_name,
+				Subtract(scaled(), multiple())))]
+		if want_quotient:
+			top_bit.extend([
+				ExprLine(Assignment(quotient_name,
+					Subtract(scaled(), scaled()))),
+				ExprLine(Increment(quotient_name)),
+			])
+		if want_remainder:
+			top_bit.append(ExprLine(Assignment(product_name, divisor())))
+
+		nonzero = [
+			ExprLine(Assignment(multiple_name, divisor())),
+			ExprLine(Assignment(bits_name, Subtract(
+					VariableRef(diff_name), VariableRef(diff_name)))),
+			While(CompareGe(Subtract(Subtract(scaled(), multiple()),
+					multiple()), Number(0)), StatementList([
+				ExprLine(Assignment(multiple_name, Add(multiple(), multiple()))),
+				ExprLine(Increment(bits_name)),
 			])),
-			ExprLine(Assignment(product_name, Number(0))),
-			While(CompareNe(VariableRef(multiplier_name), Number(0)),
+			*top_bit,
+			While(CompareNe(VariableRef(bits_name), Number(0)),
+				StatementList(next_bit)),
+		]
+		if want_remainder:
+			nonzero.append(ExprLine(Assignment(remainder_name,
+					Subtract(dividend(), product()))))
+
+		# The divisor is larger than the dividend
+		zero = []
+		if want_quotient:
+			zero.append(ExprLine(Assignment(quotient_name,
+					Subtract(dividend(), dividend()))))
+		if want_remainder:
+			zero.append(ExprLine(Assignment(remainder_name, dividend())))
+
+		stmts = []
+		if want_remainder:
+			stmts.append(ExprLine(Assignment(scaled_name, dividend())))
+
+		stmts.extend([
+			ExprLine(Assignment(diff_name, Subtract(scaled(), divisor()))),
+			If(CompareGe(VariableRef(diff_name), Number(0)),
+				StatementList(nonzero), StatementList(zero)),
+		])
+
+		return stmts
+
+DIVISION_STRATEGIES = [
+	RepeatedSubtraction(),
+	LongDivision(),
+]
+
+# Pick the strategy for dividing by the given divisor, or by a value
+# not known until runtime if None, which is cheapest under the given cost model.
+def choose_division(cost_model, divisor=None):
+	return cost_model.choose(DIVISION_STRATEGIES,
+			lambda s: (s.size, s.expected_steps(divisor)))
+
+# Build the statements to divide one variable by another, or by a constant,
+# following Python's semantics, where the quotient is rounded down, and the
+# remainder has the same sign as the divisor. Exactly one of divisor and
+# divisor_name should be given. The dividend variable is overwritten.
+# Division by zero at runtime is not detected, and does not terminate.
+def build_division(dividend_name, divisor, divisor_name,
+		quotient_name, remainder_name, namespace):
+	stmts = []
+
+	# x // -y == -x // y
+	# x %  -y == -(-x % y)
+	if divisor is None:
+		abs_divisor_name = namespace.get_unique_name()
+		stmts.extend([
+			ExprLine(Assignment(abs_divisor_name, VariableRef(divisor_name))),
+			If(CompareLt(VariableRef(abs_divisor_name), Number(0)),
 					StatementList([
-				ExprLine(Assignment(product_name, Add(VariableRef(product_name),
-						VariableRef(multiplicand_name)))),
-				ExprLine(Decrement(multiplier_name)),
+				ExprLine(Assignment(abs_divisor_name,
+					negate_var(abs_divisor_name))),
+				ExprLine(Assignment(dividend_name, negate_var(dividend_name))),
 			])),
 		])
+	elif divisor < 0:
+		stmts.append(ExprLine(Assignment(dividend_name,
+				negate_var(dividend_name))))
+
+	# For negative x, let x = -1 - a, where a is not negative. Then:
+	# (-1 - a) // y == -1 - a // y
+	# (-1 - a) %  y == y - 1 - a % y
+	abs_dividend_name = namespace.get_unique_name()
+	stmts.extend([
+		ExprLine(Assignment(abs_dividend_name, VariableRef(dividend_name))),
+		If(CompareLt(VariableRef(abs_dividend_name), Number(0)),
+				StatementList([
+			ExprLine(Assignment(abs_dividend_name,
+				negate_var(abs_dividend_name))),
+			ExprLine(Decrement(abs_dividend_name)),
+		])),
+	])
+
+	# Constant divisors are built from a one, since HRM has no constants
+	if divisor is not None:
+		abs_divisor_name = namespace.get_unique_name()
+		stmts.extend([
+			ExprLine(Assignment(abs_divisor_name, Subtract(
+					VariableRef(dividend_name), VariableRef(dividend_name)))),
+			ExprLine(Increment(abs_divisor_name)),
+		])
 
-		return (VariableRef(product_name), injected_stmts)
+		if abs(divisor) != 1:
+			stmts.append(ExprLine(Assignment(abs_divisor_name, Multiply(
+					VariableRef(abs_divisor_name), Number(abs(divisor))))))
+
+	strategy = choose_division(namespace.cost_model,
+			None if divisor is None else abs(divisor))
+	stmts.extend(strategy.build(abs_dividend_name, abs_divisor_name,
+			quotient_name, remainder_name, namespace))
+
+	fix_negative = []
+	if quotient_name is not None:
+		fix_negative.extend([
+			ExprLine(Assignment(quotient_name, negate_var(quotient_name))),
+			ExprLine(Decrement(quotient_name)),
+		])
+	if remainder_name is not None:
+		fix_negative.extend([
+			ExprLine(Assignment(remainder_name, Subtract(
+				VariableRef(abs_divisor_name), VariableRef(remainder_name)))),
+			ExprLine(Decrement(remainder_name)),
+		])
+
+	stmts.append(If(CompareLt(VariableRef(dividend_name), Number(0)),
+			StatementList(fix_negative)))
+
+	if remainder_name is not None:
+		negate_remainder = ExprLine(Assignment(remainder_name,
+				negate_var(remainder_name)))
+
+		if divisor is None:
+			stmts.append(If(CompareLt(VariableRef(divisor_name), Number(0)),
+					StatementList([negate_remainder])))
+		elif divisor < 0:
+			stmts.append(negate_remainder)
+
+	return stmts
+
+# Abstract class for division and modulo operators
+class AbstractDivisionOperator(AbstractBinaryOperator):
+	hctype = Number
+
+	# Set to True by subclasses which result in the
+	# quotient, or False for those giving the remainder.
+	quotient = True
+
+	def validate(self, namespace):
+		self.left,  injected_stmts       = validate_expr(self.left,  namespace)
+		self.right, injected_stmts_right = validate_expr(self.right, namespace)
+
+		injected_stmts.extend(injected_stmts_right)
+
+		if is_zero(self.right):
+			raise HCTypeError("Division by zero")
+
+		left_const  = isinstance(self.left,  Number)
+		right_const = isinstance(self.right, Number)
+
+		if left_const and right_const:
+			return (self.eval_static(self.left.value, self.right.value),
+					injected_stmts)
+
+		# 0 / y == 0 % y == 0
+		if is_zero(self.left):
+			if self.right.has_side_effects():
+				injected_stmts.append(ExprLine(self.right))
+
+			return (Number(0), injected_stmts)
+
+		# x / 1 == x
+		if right_const and self.right.value == 1 and self.quotient:
+			return (self.left, injected_stmts)
+
+		dividend_name = namespace.get_unique_name()
+		injected_stmts.append(ExprLine(
+				Assignment(dividend_name, self.left)))
+
+		# x / -1 == -x
+		# x % 1 == x % -1 == 0
+		if right_const and abs(self.right.value) == 1:
+			expr = Subtract(VariableRef(dividend_name),
+					VariableRef(dividend_name))
+			if self.quotient:
+				expr = negate_var(dividend_name)
+
+			expr, simple_stmts = validate_expr(expr, namespace)
+			injected_stmts.extend(simple_stmts)
+			return (expr, injected_stmts)
+
+		divisor = None
+		divisor_name = None
+		if right_const:
+			divisor = self.right.value
+		else:
+			divisor_name = namespace.get_unique_name()
+			injected_stmts.append(ExprLine(
+					Assignment(divisor_name, self.right)))
+
+		result_name = namespace.get_unique_name()
+		stmts = StatementList(build_division(dividend_name,
+				divisor, divisor_name,
+				result_name if self.quotient else None,
+				None if self.quotient else result_name,
+				namespace))
+		stmts.validate_structure(namespace)
+		injected_stmts.extend(stmts.stmts)
+
+		return (VariableRef(result_name), injected_stmts)
+
+class Divide(AbstractDivisionOperator):
+	def eval_static(self, left, right):
+		return Number(left // right)
+
+class Modulo(AbstractDivisionOperator):
+	quotient = False
+
+	def eval_static(self, left, right):
+		return Number(left % right)
 
 # Abstract class for both increment and decrement
 class AbstractIncrement(AbstractExpr):
@@ -984,9 +1833,12 @@ class AbstractIncrement(AbstractExpr):
 		self.name = name
 
 	def get_namespace(self):
-		return Namespace(self.name)
+		ns = Namespace(self.name)
+		ns.assigned_names.add(self.name)
+		return ns
 
 	def validate(self, namespace):
+		namespace.values.forget([self.name])
 		return (None, None)
 
 	def __repr__(self):
@@ -1003,6 +1855,70 @@ class Decrement(AbstractIncrement):
 	def add_to_block(self, block):
 		block.add_instruction(hrmi.BumpDown(self.name))
 
+# Check if an expression is a comparison of a number against zero
+def is_comparison(expr):
+	return (isinstance(expr, AbstractInequalityOperator)
+			or (isinstance(expr, AbstractEqualityOperator)
+				and not expr.is_xor()))
+
+# Find the comparisons making up a validated condition made of XORs and
+# negations. Other conditions are not looked inside.
+def get_xor_comparisons(cond):
+	if isinstance(cond, LogicalNot):
+		return get_xor_comparisons(cond.operand)
+
+	if isinstance(cond, AbstractEqualityOperator) and cond.is_xor():
+		return [*get_xor_comparisons(cond.left),
+				*get_xor_comparisons(cond.right)]
+
+	if is_comparison(cond):
+		return [cond]
+
+	return []
+
+# Check if the value compared by a comparison which is compiled twice, as
+# the right of an XOR, should be calculated once before either copy.
+def should_share_operand(comparison, cost_model):
+	if (not is_zero(comparison.right)
+			or isinstance(comparison.left, VariableRef)):
+		return False
+
+	# Either n instructions in each copy, of which one runs, or n
+	# instructions to calculate the value and one to save it, followed by a
+	# load in each copy. The first instruction of each copy can often be
+	# removed by state tracking, as it loads a value left in the hands by
+	# the left condition, so is not counted.
+	n = estimate_size(comparison.left)
+	return cost_model.choose([False, True],
+			lambda share: (n + 3, n + 2) if share
+				else (2 * (n - 1), n - 1))
+
+# Create a branch block for a condition, as create_branch_block, unless one
+# has already been created for the same condition, branching to the same
+# places, in which case it is reused. Blocks are stored in the dict shared.
+def create_shared_branch_block(cond, then_block, else_block, lineno, shared):
+	if isinstance(cond, LogicalNot):
+		return create_shared_branch_block(cond.operand,
+				else_block, then_block, lineno, shared)
+
+	then_entry = get_first_block(then_block)
+	else_entry = get_first_block(else_block)
+
+	# Nothing to decide if both ways lead to the same place
+	if then_entry is else_entry and not cond.has_side_effects():
+		return hrmi.CompoundBlock(then_entry, then_block.get_exit_blocks())
+
+	key = (id(cond), then_entry, else_entry)
+	if key not in shared:
+		if isinstance(cond, AbstractEqualityOperator) and cond.is_xor():
+			shared[key] = cond.create_xor_block(
+					then_block, else_block, lineno, shared)
+		else:
+			shared[key] = cond.create_branch_block(
+					then_block, else_block, lineno)
+
+	return shared[key]
+
 class AbstractEqualityOperator(AbstractBinaryOperator):
 	hctype = Boolean
 
@@ -1065,6 +1981,24 @@ class AbstractEqualityOperator(AbstractBinaryOperator):
 				self.right, namespace)
 
 		injected_stmts.extend(injected_stmts_right)
+
+		# Comparisons on the right of an XOR are compiled once for each
+		# outcome of the condition on its left. Rather than calculating the
+		# value one compares in both copies, it may be cheaper to calculate it
+		# once beforehand. Calculating values early changes the order of
+		# evaluation, so this is only done if nothing has side effects.
+		if self.has_side_effects():
+			return (None, injected_stmts)
+
+		for comparison in get_xor_comparisons(self.right):
+			if not should_share_operand(comparison, namespace.cost_model):
+				continue
+
+			var_name = namespace.get_unique_name()
+			injected_stmts.append(ExprLine(
+					Assignment(var_name, comparison.left)))
+			comparison.left = VariableRef(var_name)
+
 		return (None, injected_stmts)
 
 	# Create a Compound condition block which branches to one block
@@ -1089,20 +2023,30 @@ class AbstractEqualityOperator(AbstractBinaryOperator):
 		return hrmi.CompoundBlock(cond_block,
 				[*then_block.get_exit_blocks(), *else_block.get_exit_blocks()])
 
-	def create_xor_block(self, then_block, else_block, lineno):
-		# XOR is compiled such that there are two copies of the right condition:
-		# one for each possible outcome of the left condition.
-		right_true_block = self.right.create_branch_block(
-				then_block, else_block, lineno)
-		right_false_block = self.right.create_branch_block(
-				else_block, then_block, lineno)
+	# XOR is compiled such that there are two copies of the right condition:
+	# one for each possible outcome of the left condition.
+	#
+	# Nested XORs would need copies of copies, so conditions are compiled as a
+	# decision DAG, similar to a reduced binary decision diagram. Copies of any
+	# condition within the XOR which branch to the same places are shared,
+	# using the dict shared, so that there are at most two copies of each:
+	# one branching each way. Code size then grows linearly with the depth of
+	# nesting, rather than exponentially.
+	def create_xor_block(self, then_block, else_block, lineno, shared=None):
+		if shared is None:
+			shared = {}
+
+		right_true_block = create_shared_branch_block(self.right,
+				then_block, else_block, lineno, shared)
+		right_false_block = create_shared_branch_block(self.right,
+				else_block, then_block, lineno, shared)
 
 		if self.negate:
 			(right_true_block, right_false_block) = (
 					right_false_block, right_true_block)
 
-		return self.left.create_branch_block(
-				right_true_block, right_false_block, lineno)
+		return create_shared_branch_block(self.left,
+				right_true_block, right_false_block, lineno, shared)
 
 class CompareEq(AbstractEqualityOperator):
 	pass
@@ -1255,8 +2199,12 @@ class AbstractLogicalBinaryOperator(AbstractBinaryOperator):
 	def validate_branchable(self, namespace):
 		self.left, injected_stmts = validate_expr_branchable(
 				self.left, namespace)
+
+		# The right operand is only evaluated depending on the left
+		values = namespace.values.copy()
 		self.right, injected_stmts_right = validate_expr_branchable(
 				self.right, namespace)
+		namespace.values.merge(values)
 
 		if len(injected_stmts_right) > 0:
 			self.right = InlineStatementExpr(injected_stmts_right, self.right)
@@ -1300,7 +2248,12 @@ class InlineStatementExpr(AbstractExpr):
 		if not isinstance(self.body, StatementList):
 			self.body = StatementList(self.body)
 
+	def has_side_effects(self):
+		# The body may contain any statement
+		return True
+
 	def create_branch_block(self, then_block, else_block, lineno):
+		self.body.fill_lineno(lineno)
 		self.body.create_blocks()
 
 		branch = self.return_expr.create_branch_block(
@@ -1317,6 +2270,25 @@ class Namespace:
 	__slots__ = [
 		"names",
 		"next_generated_id",
+
+		# hccost.CostModel used to choose between alternative
+		# ways of compiling the code using this namespace.
+		"cost_model",
+
+		# hcprofile.Profile recording how often each line of the program
+		# ran in a previous run, or None if not known.
+		"profile",
+
+		# Dict mapping the names of tiles initialised with
+		# a value at the start of the program to their values.
+		"initial_values",
+
+		# Set of names of variables which are assigned to
+		"assigned_names",
+
+		# ValueTable of values known to be held by variables
+		# at the point the program has been validated up to.
+		"values",
 	]
 
 	# names may initialise to a string, iterable of strings, or None
@@ -1329,10 +2301,16 @@ class Namespace:
 			self.names = set(*names)
 
 		self.next_generated_id = 0
+		self.cost_model = hccost.DEFAULT_COST_MODEL
+		self.profile = None
+		self.initial_values = {}
+		self.assigned_names = set()
+		self.values = ValueTable()
 
 	# Merge another Namespace into this one
 	def merge(self, other):
 		self.names |= other.names
+		self.assigned_names |= other.assigned_names
 		if other.next_generated_id > self.next_generated_id:
 			self.next_generated_id = other.next_generated_id
 
@@ -1347,3 +2325,111 @@ class Namespace:
 			if name not in self.names:
 				self.add_name(name)
 				return name
+
+# Numbers the values held by variables, so that the value of an expression
+# calculated earlier may be reused, while some variable still holds it. Two
+# expressions with the same operator, whose operands have the same value
+# numbers, give the same value, whichever variables are used. Variables are
+# given a new number each time they are assigned, so the values of
+# expressions using their old values are no longer found.
+class ValueTable:
+	__slots__ = [
+		# Dict mapping variable names to the number of the value they hold
+		"variables",
+
+		# Dict mapping value keys of expressions to their value numbers
+		"expressions",
+
+		# Iterator of unused value numbers, shared
+		# by copies of the table, so none is reused.
+		"numbers",
+	]
+
+	def __init__(self, numbers=None):
+		self.variables = {}
+		self.expressions = {}
+		self.numbers = itertools.count() if numbers is None else numbers
+
+	def copy(self):
+		values = ValueTable(self.numbers)
+		values.variables = dict(self.variables)
+		values.expressions = dict(self.expressions)
+		return values
+
+	# Fetch the number of the value held by a variable.
+	# Variables not yet seen hold some new value.
+	def get_variable_number(self, name):
+		if name not in self.variables:
+			self.variables[name] = next(self.numbers)
+
+		return self.variables[name]
+
+	# Fetch the number of the value of the expression with the given key.
+	# Expressions not yet seen give some new value.
+	def get_expression_number(self, key):
+		if key not in self.expressions:
+			self.expressions[key] = next(self.numbers)
+
+		return self.expressions[key]
+
+	# Find a variable holding the value of the expression
+	# with the given key, or None if there is none.
+	def find_variable(self, key):
+		number = self.expressions.get(key)
+		if number is None:
+			return None
+
+		return self.find_variable_with_number(number)
+
+	# Find a variable holding the value with the given number, or None
+	def find_variable_with_number(self, number):
+		for name, var_number in self.variables.items():
+			if var_number == number:
+				return name
+
+		return None
+
+	# Record that a variable holds the value of the
+	# expression with the given key, having evaluated it.
+	def record(self, key, name):
+		self.expressions[key] = self.get_variable_number(name)
+
+	# Record that a variable has been assigned the value of the expression
+	# with the given key, or some unknown value if the key is None.
+	def assign(self, name, key):
+		self.forget([name])
+
+		if key is None:
+			return
+
+		if key in self.expressions:
+			self.variables[name] = self.expressions[key]
+		else:
+			self.record(key, name)
+
+	# Record that a variable has been assigned the value of another
+	def assign_copy(self, name, source):
+		self.variables[name] = self.get_variable_number(source)
+
+	# Record that a variable has been assigned the value with the given
+	# number, or some unknown value if the number is None.
+	def assign_number(self, name, number):
+		self.forget([name])
+
+		if number is not None:
+			self.variables[name] = number
+
+	# Forget the values of variables which may have been assigned
+	def forget(self, names):
+		for name in names:
+			self.variables.pop(name, None)
+
+	# Keep only the values which are known both by this table and another,
+	# such as where two branches of the program join.
+	def merge(self, other):
+		self.variables = {name: number
+				for name, number in self.variables.items()
+				if other.variables.get(name) == number}
+		self.expressions = {key: number
+				for key, number in self.expressions.items()
+				if other.expressions.get(key) == number}
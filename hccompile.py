@@ -4,9 +4,15 @@ import sys
 import string
 
 from hcexceptions import HCTypeError, LexerError, HCParseError
-from hcast import generate_name
+from hcast import generate_name, ESTIMATED_LOOP_ITERATIONS
+import hcast
 import hrminstr as hrmi
 import hcparse2
+import hccost
+import hcconst
+import hcprofile
+import hcpeephole
+import hcssa
 
 # Extract a list of all unique blocks from a statement list
 def extract_blocks(stmt_list):
@@ -38,14 +44,17 @@ def extract_blocks(stmt_list):
 
 	return blocks
 
-# Optimise code by tracking what the state of the
-# office will be at each stage in the code.
-def optimise_state_tracking(blocks, initial_memory):
-	# First, ensure all state_at_start values are accurate
+# Work out the state of the office at the start of each block
+def propagate_state(blocks, initial_memory):
+	for blk in blocks:
+		blk.state_at_start = None
+		blk.state_data_propagated = False
+
 	state = hrmi.OfficeState([hrmi.EmptyHands()])
 	for mem in initial_memory:
 		if mem.value is not None:
 			state.add_constraint(hrmi.VariableHasValue(mem.name, mem.value))
+			state.add_constraint(hrmi.VariableAssigned(mem.name))
 
 	blocks[0].update_state(state)
 	blocks_to_check = [blocks[0]]
@@ -59,24 +68,216 @@ def optimise_state_tracking(blocks, initial_memory):
 		for instr in blk.instructions:
 			instr.simulate_state(state)
 
-		# Propagate through both possible paths of the conditional jump
-		if blk.conditional is not None:
-			cond_state = state.clone()
-			blk.conditional.simulate_state_pass(cond_state)
-			cond_block = blk.conditional.dest
-			cond_block.update_state(cond_state)
-			blocks_to_check.append(cond_block)
-			
-			blk.conditional.simulate_state_fail(state)
+		# Propagate through each path of the conditional jump which may be
+		# followed in this state. Paths which can't be followed yet aren't
+		# merged into the states of the blocks they lead to, so values which
+		# only they would change may still be known. If the state at the start
+		# of this block later gets worse, the block is checked again, so any
+		# path which becomes possible will still be propagated through.
+		cjump = blk.conditional
+		follow_next = True
+		if cjump is not None:
+			if not cjump.redundant_fails(state):
+				cond_state = state.clone()
+				cjump.simulate_state_pass(cond_state)
+				cond_block = cjump.dest
+				cond_block.update_state(cond_state)
+				blocks_to_check.append(cond_block)
+
+			follow_next = not cjump.redundant_passes(state)
+			cjump.simulate_state_fail(state)
 
 		# Propagate through the unconditional
-		if blk.next is not None:
+		if blk.next is not None and follow_next:
 			next_block = blk.next.dest
 			next_block.update_state(state)
 			blocks_to_check.append(next_block)
 
 		blk.state_data_propagated = True
 
+# Find the state of the office after following a jump out of a block, or None
+# if the jump can never be followed.
+def get_jump_state(jmp):
+	blk = jmp.src
+	state = blk.state_at_start.clone()
+	for instr in blk.instructions:
+		instr.simulate_state(state)
+
+	cjump = blk.conditional
+	if cjump is None:
+		return state
+
+	if jmp is cjump:
+		if cjump.redundant_fails(state):
+			return None
+
+		cjump.simulate_state_pass(state)
+	else:
+		if cjump.redundant_passes(state):
+			return None
+
+		cjump.simulate_state_fail(state)
+
+	return state
+
+# Remove the conditional jumps out of each block which propagate_state found
+# would never be followed, or would always be, as well as any blocks which
+# could then no longer be reached. This leaves a state at the start of each
+# remaining block.
+def remove_unfollowed_jumps(blocks):
+	for blk in blocks:
+		cjump = blk.conditional
+		if blk.state_at_start is None or cjump is None:
+			continue
+
+		if get_jump_state(cjump) is None:
+			blk.unlink_conditional()
+		elif get_jump_state(blk.next) is None:
+			blk.next.redirect(cjump.dest)
+			blk.unlink_conditional()
+
+	remove_unreachable_blocks(blocks)
+
+# Largest number of instructions which may be copied by thread_jumps
+# to thread a single jump
+MAX_THREADED_SIZE = 4
+
+# Largest number of blocks thread_jumps will look through
+# from a jump for a conditional jump it can decide
+MAX_THREADED_BLOCKS = 4
+
+# Redirect jumps which lead to a conditional jump whose result is known on
+# that path, but not on every path to it, straight to where it would go.
+# The state of the office is merged from each path into a block, so the
+# conditional can't be removed from the block itself. Instead, the blocks
+# between the jump and the conditional are copied, without the conditional,
+# and the jump is redirected through the copies, if the cost model thinks the
+# steps saved are worth the extra instructions. Returns True if any jumps
+# were redirected.
+def thread_jumps(blocks, cost_model):
+	threaded = False
+
+	for src in [*blocks]:
+		if src.state_at_start is None:
+			continue
+
+		for jmp in [src.conditional, src.next]:
+			if jmp is None:
+				continue
+
+			state = get_jump_state(jmp)
+			if state is None:
+				continue
+
+			# Follow the jump until reaching a conditional jump
+			path = []
+			dest = jmp.dest
+			while len(path) < MAX_THREADED_BLOCKS and dest not in path:
+				blk = dest
+				path.append(blk)
+				for instr in blk.instructions:
+					instr.simulate_state(state)
+
+				cjump = blk.conditional
+				if cjump is not None:
+					if cjump.redundant_passes(state):
+						dest = cjump.dest
+					elif cjump.redundant_fails(state):
+						dest = blk.next.dest
+					else:
+						dest = None
+
+					break
+
+				if blk.next is None:
+					dest = None
+					break
+
+				dest = blk.next.dest
+			else:
+				dest = None
+
+			if dest is None or path[-1].conditional is None:
+				continue
+
+			size = sum(len(blk.instructions) for blk in path)
+			if size > MAX_THREADED_SIZE:
+				continue
+
+			if size > 0 and not cost_model.choose([False, True],
+					lambda thread: (size, -1) if thread else (0, 0)):
+				continue
+
+			# Copy each block on the path which has any instructions
+			copies = []
+			for blk in path:
+				if len(blk.instructions) == 0:
+					continue
+
+				copy = hrmi.Block(blk.lineno)
+				copy.instructions = [instr.clone()
+						for instr in blk.instructions]
+				copies.append(copy)
+
+			for copy, next_copy in zip(copies, [*copies[1:], dest]):
+				copy.assign_next(next_copy)
+
+			jmp.redirect(copies[0] if len(copies) > 0 else dest)
+			idx = blocks.index(src) + 1
+			blocks[idx:idx] = copies
+			threaded = True
+
+	return threaded
+
+# Remove blocks which can no longer be reached from the first block
+def remove_unreachable_blocks(blocks):
+	reachable = set()
+	to_check = [blocks[0]]
+	while len(to_check) > 0:
+		blk = to_check.pop()
+		if blk in reachable:
+			continue
+
+		reachable.add(blk)
+		to_check.extend(get_successors(blk))
+
+	for blk in [*blocks]:
+		if blk in reachable:
+			continue
+
+		for jmp in [blk.conditional, blk.next]:
+			if jmp is not None:
+				jmp.unlink_dest()
+
+		blocks.remove(blk)
+
+# Build a constant which can't be loaded from any tile from other known values
+def synthesise_constant(value, state, cost_model, temp_tiles, lineno):
+	expanded = None
+	if temp_tiles is not None:
+		expanded = hcconst.synthesise_constant(value, state, cost_model,
+				temp_tiles)
+
+	if expanded is None:
+		raise HCTypeError(f"Unable to create the constant {value} "
+				"on line " + str(lineno) + ", as no values are "
+				"known to be available to create it from")
+
+	return expanded
+
+# Optimise code by tracking what the state of the
+# office will be at each stage in the code.
+def optimise_state_tracking(blocks, initial_memory,
+		cost_model=hccost.DEFAULT_COST_MODEL, temp_tiles=None):
+	# First, ensure all state_at_start values are accurate
+	propagate_state(blocks, initial_memory)
+	remove_unfollowed_jumps(blocks)
+
+	if thread_jumps(blocks, cost_model):
+		remove_unreachable_blocks(blocks)
+		propagate_state(blocks, initial_memory)
+		remove_unfollowed_jumps(blocks)
+
 	# Make optimisations based on calculated state data
 	for blk in blocks:
 		state = blk.state_at_start.clone()
@@ -85,6 +286,8 @@ def optimise_state_tracking(blocks, initial_memory):
 		while i < len(blk.instructions):
 			instr = blk.instructions[i]
 
+			instr.propagate_copies(state)
+
 			# Remove the instruction if it's redundant
 			if instr.state_redundant(state):
 				del blk.instructions[i]
@@ -93,6 +296,10 @@ def optimise_state_tracking(blocks, initial_memory):
 			# Expand pseudo instructions if possible
 			if isinstance(instr, hrmi.PseudoInstruction):
 				expanded = instr.attempt_expand(state)
+				if expanded is None and isinstance(instr, hrmi.LoadConstant):
+					expanded = synthesise_constant(instr.value, state,
+							cost_model, temp_tiles, blk.lineno)
+
 				if expanded is not None:
 					blk.instructions[i:i+1] = expanded
 					continue
@@ -111,6 +318,23 @@ def optimise_state_tracking(blocks, initial_memory):
 			blk.next.redirect(cjump.dest)
 			blk.unlink_conditional()
 
+	# Removing conditional jumps may leave blocks which can't be reached
+	remove_unreachable_blocks(blocks)
+
+# Find values which are constant on every path through the program which may
+# be followed, using sparse conditional constant propagation on the program in
+# SSA form. Conditional jumps which are found to be decided are removed, along
+# with any blocks which may then no longer be reached, and any instructions
+# which only write values already held where they write them.
+def propagate_constants(blocks, initial_memory):
+	idoms, order = find_dominators(blocks)
+
+	ssa = hcssa.SSAForm(order, idoms, initial_memory)
+	ssa.propagate_constants()
+	ssa.apply()
+
+	remove_unreachable_blocks(blocks)
+
 def memory_map_contains(memory_map, var_name):
 	for memloc in memory_map:
 		if memloc.name == var_name:
@@ -130,11 +354,9 @@ def record_variable_use(blocks, memory_map):
 		for i in range(len(blk.instructions)):
 			instr = blk.instructions[i]
 
-			if not instr.reads_variable:
-				continue
-
-			blk.back_propagate_variable_use(i, instr.loc,
-					memory_map_contains(memory_map, instr.loc))
+			for var_name in instr.get_variables_read():
+				blk.back_propagate_variable_use(i, var_name,
+						memory_map_contains(memory_map, var_name))
 
 # Similar to record_variable_use, but tracks when the values stored in the hands
 # are needed.
@@ -157,18 +379,24 @@ def record_hand_use(blocks):
 # Any instances of a variable's value being set when
 # it isn't going to be used again may be removed.
 def optimise_variable_needs(blocks, memory_map):
-	record_variable_use(blocks, memory_map)
-	record_hand_use(blocks)
-
-	for blk in blocks:
-		i = 0
-		while i < len(blk.instructions):
-			instr = blk.instructions[i]
-
-			if instr.var_redundant():
-				del blk.instructions[i]
-			else:
-				i += 1
+	# Removing an instruction may leave those
+	# giving it its values unused as well.
+	removed = True
+	while removed:
+		removed = False
+		record_variable_use(blocks, memory_map)
+		record_hand_use(blocks)
+
+		for blk in blocks:
+			i = 0
+			while i < len(blk.instructions):
+				instr = blk.instructions[i]
+
+				if instr.var_redundant():
+					del blk.instructions[i]
+					removed = True
+				else:
+					i += 1
 
 def rename_variable(blocks, old_name, new_name):
 	for block in blocks:
@@ -176,10 +404,7 @@ def rename_variable(blocks, old_name, new_name):
 			if instr.needs_variable(old_name):
 				instr.mark_variable_used(new_name)
 
-			if not isinstance(instr, hrmi.AbstractParameterisedInstruction):
-				continue
-			if instr.loc == old_name:
-				instr.loc = new_name
+			instr.rename_variable(old_name, new_name)
 
 # Class used to track which variables are used alongside which others.
 class VariableUseTracker:
@@ -188,13 +413,15 @@ class VariableUseTracker:
 		# which are used simultaneously.
 		"used",
 
-		# Set of each unique variable seen
+		# Each unique variable seen, in the order they were first seen.
+		# This is a dict used as an ordered set, so that variables are
+		# always considered for merging in the same order.
 		"unique_vars",
 	]
 
 	def __init__(self):
 		self.used = set()
-		self.unique_vars = set()
+		self.unique_vars = {}
 
 	def _mk_key(self, var_a, var_b):
 		return tuple(sorted((var_a, var_b)))
@@ -209,7 +436,7 @@ class VariableUseTracker:
 		return self._mk_key(var_a, var_b) in self.used
 
 	def add_var(self, var):
-		self.unique_vars.add(var)
+		self.unique_vars[var] = None
 
 	def get_unique(self):
 		return iter(self.unique_vars)
@@ -232,7 +459,7 @@ def merge_disjoint_variables(blocks, namespace, memory_map):
 	for block in blocks:
 		for instr in block.instructions:
 			# Check if two or more variables are used during this instruction
-			instr_vars = list(instr.variables_used)
+			instr_vars = sorted(instr.variables_used)
 			for i in range(len(instr_vars)):
 				var1 = instr_vars[i]
 				var_use.add_var(var1)
@@ -299,6 +526,895 @@ def collapse_redundant_blocks(blocks):
 	for block in redundant_blocks:
 		blocks.remove(block)
 
+# Get the blocks which may run directly after a block
+def get_successors(block):
+	return [jmp.dest for jmp in (block.conditional, block.next)
+			if jmp is not None]
+
+# Find the loops in a program by looking for jumps back to a block which is
+# currently being visited by a depth first search from the first block.
+# Returns a tuple of (the set of back edges, as (source, destination) pairs,
+# a list of reachable blocks in reverse postorder, and a dict mapping the
+# header of each loop to the set of blocks inside that loop).
+def find_loops(blocks):
+	back_edges = set()
+	postorder = []
+	visited = set()
+	on_stack = set()
+
+	def visit(block):
+		visited.add(block)
+		on_stack.add(block)
+
+		for succ in get_successors(block):
+			if succ in on_stack:
+				back_edges.add((block, succ))
+			elif succ not in visited:
+				visit(succ)
+
+		on_stack.remove(block)
+		postorder.append(block)
+
+	visit(blocks[0])
+
+	# Each loop is made up of its header, the target of a back edge,
+	# and every block which can reach a back edge to that header without
+	# going through the header.
+	loops = {}
+	for latch, header in sorted(back_edges,
+			key=lambda e: (blocks.index(e[0]), blocks.index(e[1]))):
+		loop = loops.setdefault(header, {header})
+		to_check = [latch]
+		while len(to_check) > 0:
+			block = to_check.pop()
+			if block in loop:
+				continue
+
+			loop.add(block)
+			to_check.extend(jmp.src for jmp in block.jumps_in
+					if jmp.src in visited)
+
+	return (back_edges, postorder[::-1], loops)
+
+# Find the immediate dominator of each block reachable from the first block:
+# the closest block which every path from the first block to it runs through.
+# Returns a tuple of (a dict mapping each reachable block other than the first
+# to its immediate dominator, and a list of reachable blocks in reverse
+# postorder, so each block comes after its dominators).
+def find_dominators(blocks):
+	_, order, _ = find_loops(blocks)
+	index = {blk: i for i, blk in enumerate(order)}
+
+	def intersect(a, b):
+		while a is not b:
+			while index[a] > index[b]:
+				a = idoms[a]
+			while index[b] > index[a]:
+				b = idoms[b]
+
+		return a
+
+	idoms = {order[0]: order[0]}
+	changed = True
+	while changed:
+		changed = False
+		for blk in order[1:]:
+			preds = [jmp.src for jmp in blk.jumps_in if jmp.src in idoms]
+
+			idom = preds[0]
+			for pred in preds[1:]:
+				idom = intersect(idom, pred)
+
+			if idoms.get(blk) is not idom:
+				idoms[blk] = idom
+				changed = True
+
+	del idoms[order[0]]
+	return (idoms, order)
+
+# Check whether every path from the first block to a block runs through
+# another, given the immediate dominators found by find_dominators
+def dominates(idoms, dominator, block):
+	while block is not dominator:
+		if block not in idoms:
+			return False
+
+		block = idoms[block]
+
+	return True
+
+# Find the blocks which may run after a block, and before one it dominates,
+# without running the dominating block again. This includes the dominated
+# block itself, if it may run again in between.
+def get_blocks_between(dominator, block):
+	after = set()
+	to_check = get_successors(dominator)
+	while len(to_check) > 0:
+		blk = to_check.pop()
+		if blk is dominator or blk in after:
+			continue
+
+		after.add(blk)
+		to_check.extend(get_successors(blk))
+
+	before = set()
+	to_check = [jmp.src for jmp in block.jumps_in]
+	while len(to_check) > 0:
+		blk = to_check.pop()
+		if blk is dominator or blk in before:
+			continue
+
+		before.add(blk)
+		to_check.extend(jmp.src for jmp in blk.jumps_in)
+
+	return after & before
+
+# Names of the variables which any of the given blocks may change
+def get_variables_changed(blocks):
+	return {instr.loc for blk in blocks for instr in blk.instructions
+			if instr.writes_variable or instr.modifies_variable}
+
+# Number of a constant value. Constants are numbered by their values, rather
+# than by a ValueTable, so that values calculated from constants are folded.
+def number_constant(value):
+	return (hrmi.LoadConstant, value)
+
+# Find the value of a numbered constant, or None if the value isn't constant
+def get_numbered_constant(number):
+	if isinstance(number, tuple) and number[0] is hrmi.LoadConstant:
+		return number[1]
+
+	return None
+
+# Number the sum of two numbered values
+def number_sum(values, left, right):
+	left_val = get_numbered_constant(left)
+	right_val = get_numbered_constant(right)
+	if left_val is not None and right_val is not None:
+		result = hrmi.checked_value(left_val + right_val)
+		if result is not None:
+			return number_constant(result)
+
+	if left_val == 0:
+		return right
+	if right_val == 0:
+		return left
+
+	return values.get_expression_number(
+			(hrmi.Add, *sorted((left, right), key=repr)))
+
+# Number the difference between two numbered values
+def number_difference(values, left, right):
+	if left == right:
+		return number_constant(0)
+
+	left_val = get_numbered_constant(left)
+	right_val = get_numbered_constant(right)
+	if left_val is not None and right_val is not None:
+		result = hrmi.checked_value(left_val - right_val)
+		if result is not None:
+			return number_constant(result)
+
+	if right_val == 0:
+		return left
+
+	return values.get_expression_number((hrmi.Subtract, left, right))
+
+# Number the value which an instruction loads into the hands, given the value
+# numbers of the variables in the hcast.ValueTable values, and the number of
+# the value in the hands before it, or None if not known. Returns None if the
+# instruction doesn't calculate its result only from known values.
+def number_hands_value(instr, hands, values):
+	if isinstance(instr, hrmi.Load):
+		return values.get_variable_number(instr.loc)
+
+	if isinstance(instr, hrmi.LoadConstant):
+		return number_constant(instr.value)
+
+	if isinstance(instr, hrmi.LoadDifference):
+		return number_difference(values,
+				values.get_variable_number(instr.left),
+				values.get_variable_number(instr.right))
+
+	if isinstance(instr, hrmi.Difference) or hands is None:
+		return None
+
+	if isinstance(instr, hrmi.Add):
+		return number_sum(values, hands,
+				values.get_variable_number(instr.loc))
+
+	if isinstance(instr, hrmi.Subtract):
+		return number_difference(values, hands,
+				values.get_variable_number(instr.loc))
+
+	return None
+
+# Number the value a bump instruction leaves in its variable and the hands
+def number_bumped_value(instr, values):
+	var = values.get_variable_number(instr.loc)
+	if isinstance(instr, hrmi.BumpUp):
+		return number_sum(values, var, number_constant(1))
+
+	return number_difference(values, var, number_constant(1))
+
+# Find the first of the instructions in a block which calculate the value in
+# the hands after the given instruction, if they only affect the hands. The
+# calculation may continue from a value left in the hands by an earlier block.
+# Returns its index, or None.
+def find_hands_calculation(instructions, idx):
+	while idx >= 0:
+		instr = instructions[idx]
+		if isinstance(instr, (hrmi.Load, hrmi.LoadConstant, hrmi.Difference)):
+			return idx
+
+		if not isinstance(instr, (hrmi.Add, hrmi.Subtract)):
+			return None
+
+		idx -= 1
+
+	return 0
+
+# Remove calculations of values which some variable already holds. Values are
+# numbered by walking the blocks in dominator order, so that values calculated
+# in a block are known in the blocks it dominates, as long as the variables
+# holding them can't change in between. Where the value calculated by a series
+# of instructions is held by a variable, they are replaced by loading it.
+# Returns a dict mapping each block to the hcast.ValueTable of the values its
+# variables hold at its end.
+def number_global_values(blocks):
+	idoms, order = find_dominators(blocks)
+
+	values_at_end = {}
+	hands_at_end = {}
+	for blk in order:
+		values = hcast.ValueTable()
+		hands = None
+		if blk in idoms:
+			dom = idoms[blk]
+			between = get_blocks_between(dom, blk)
+
+			values = values_at_end[dom].copy()
+			values.forget(get_variables_changed(between))
+
+			if len(between) == 0:
+				hands = hands_at_end[dom]
+
+		i = 0
+		while i < len(blk.instructions):
+			instr = blk.instructions[i]
+			number = number_hands_value(instr, hands, values)
+
+			if number is not None and number == hands:
+				del blk.instructions[i]
+				continue
+
+			# Either order of the operands is as good for a Difference
+			holder = None
+			if number is not None:
+				if not isinstance(instr, hrmi.Load):
+					holder = values.find_variable_with_number(number)
+			elif (isinstance(instr, hrmi.Difference)
+					and not isinstance(instr, hrmi.LoadDifference)):
+				left = values.get_variable_number(instr.left)
+				right = values.get_variable_number(instr.right)
+				for diff in (number_difference(values, left, right),
+						number_difference(values, right, left)):
+					holder = values.find_variable_with_number(diff)
+					if holder is not None:
+						number = diff
+						break
+
+			start = None
+			if holder is not None:
+				start = find_hands_calculation(blk.instructions, i)
+
+			if start is not None:
+				blk.instructions[start:i+1] = [hrmi.Load(holder)]
+				i = start
+
+			if isinstance(instr, hrmi.Save):
+				values.assign_number(instr.loc, hands)
+			elif isinstance(instr, hrmi.AbstractBumpInstruction):
+				number = number_bumped_value(instr, values)
+				values.assign_number(instr.loc, number)
+			elif instr.writes_variable or instr.modifies_variable:
+				values.forget([instr.loc])
+
+			if instr.writes_hands or number is not None:
+				hands = number
+			elif isinstance(instr, hrmi.Output):
+				hands = None
+
+			i += 1
+
+		values_at_end[blk] = values
+		hands_at_end[blk] = hands
+
+	return values_at_end
+
+# Check whether the value in the hands at the start of a block may be used
+def hands_used_at_start(block):
+	seen = set()
+	while block not in seen:
+		seen.add(block)
+		for instr in block.instructions:
+			if (instr.reads_hands
+					or isinstance(instr, (hrmi.Add, hrmi.Subtract))):
+				return True
+
+			if instr.writes_hands:
+				return False
+
+		if block.conditional is not None:
+			return True
+
+		if block.next is None:
+			return False
+
+		block = block.next.dest
+
+	return False
+
+# Find the instructions calculating a value in a loop, starting from the given
+# instruction, which may be run once before the loop instead of on every run
+# of it. These load a value which the loop doesn't change, then may add or
+# subtract others, save the result to variables, and bump those. The
+# calculation may continue into blocks which may only be reached from the one
+# before. Returns a tuple of (a list of the (block, index) of each instruction,
+# and whether the value it leaves in the hands may be used afterwards), or
+# None. If the value may be used, the calculation ends with the instruction
+# which last saved or bumped it, so that it may be loaded back from there.
+def find_invariant_calculation(block, idx, loop, changed):
+	instr = block.instructions[idx]
+	if isinstance(instr, hrmi.Load):
+		if instr.loc in changed:
+			return None
+	elif not isinstance(instr, hrmi.LoadConstant):
+		return None
+
+	calculation = [(block, idx)]
+	written = set()
+	saved_length = None
+	while True:
+		idx += 1
+		while idx >= len(block.instructions):
+			nxt = block.next.dest if block.next is not None else None
+			if (block.conditional is not None or nxt not in loop
+					or len(nxt.jumps_in) != 1):
+				instr = None
+				break
+
+			block = nxt
+			idx = 0
+		else:
+			instr = block.instructions[idx]
+
+		if isinstance(instr, (hrmi.Add, hrmi.Subtract)):
+			if instr.loc in changed and instr.loc not in written:
+				break
+		elif isinstance(instr, hrmi.Save):
+			written.add(instr.loc)
+		elif isinstance(instr, hrmi.AbstractBumpInstruction):
+			if instr.loc not in written:
+				break
+		else:
+			break
+
+		calculation.append((block, idx))
+		if instr.writes_variable or instr.modifies_variable:
+			saved_length = len(calculation)
+
+	if saved_length is None:
+		return None
+
+	if instr is not None and instr.writes_hands:
+		return (calculation, False)
+
+	return (calculation[:saved_length], True)
+
+# Check that a calculation found by find_invariant_calculation runs on every
+# run of its loop, before anything which could leave the loop, or end the
+# program by taking input, and before anything reads the variables it writes.
+# This means the values it saves are the same each time they're read, and
+# that running it before the loop starts can't cause an error the program
+# wouldn't have run into anyway.
+def calculation_runs_first(calculation, loop, header):
+	written = {blk.instructions[idx].loc for blk, idx in calculation
+			if blk.instructions[idx].writes_variable}
+	first_block, start = calculation[0]
+
+	def runs_before(instructions):
+		return not any(isinstance(instr, hrmi.Input)
+				or any(name in written for name in instr.get_variables_read())
+				for instr in instructions)
+
+	if not runs_before(first_block.instructions[:start]):
+		return False
+
+	# Find every block which may run before the calculation
+	before = set()
+	to_check = [header]
+	while len(to_check) > 0:
+		blk = to_check.pop()
+		if blk is first_block or blk in before:
+			continue
+
+		before.add(blk)
+		for succ in get_successors(blk):
+			if succ not in loop or succ is header:
+				return False
+
+			to_check.append(succ)
+
+	return all(runs_before(blk.instructions) for blk in before)
+
+# Number the values held after a calculation, given the hcast.ValueTable of
+# those held before it. Returns a new ValueTable.
+def number_calculation(instructions, values):
+	values = values.copy()
+	hands = None
+	for instr in instructions:
+		if isinstance(instr, hrmi.Save):
+			values.assign_number(instr.loc, hands)
+		elif isinstance(instr, hrmi.AbstractBumpInstruction):
+			hands = number_bumped_value(instr, values)
+			values.assign_number(instr.loc, hands)
+		else:
+			hands = number_hands_value(instr, hands, values)
+
+	return values
+
+# Move calculations in loops which give the same values each time the loop
+# runs to before the loop. Loops are found as in find_loops, and each
+# calculation found by find_invariant_calculation which runs before anything
+# else in its loop may use its results is moved to a new block, which runs
+# before the loop is entered, and is jumped to in place of the loop's header
+# from outside the loop.
+#
+# If the loop is only entered from a single block, where the variables
+# written by the calculation already hold the values it would give them, such
+# as where a while loop's condition is checked before the loop is entered, the
+# calculation is simply removed. values_at_end should give the values held at
+# the end of each block, as returned by number_global_values.
+#
+# Loops whose header doesn't dominate the rest of the loop, which may be
+# entered part way through, are left alone, since a block before the header
+# wouldn't run on every way in.
+def hoist_loop_invariants(blocks, values_at_end, cost_model, profile=None):
+	hoisted = True
+	while hoisted:
+		hoisted = False
+		_, order, loops = find_loops(blocks)
+		idoms, _ = find_dominators(blocks)
+		frequencies, probabilities = estimate_block_frequencies(blocks,
+				profile)
+
+		for header in sorted(loops,
+				key=lambda header: (len(loops[header]), order.index(header))):
+			if not all(dominates(idoms, header, blk)
+					for blk in loops[header]):
+				continue
+
+			if hoist_from_loop(blocks, header, loops[header], values_at_end,
+					cost_model, frequencies, probabilities):
+				hoisted = True
+				break
+
+# Move a single calculation out of the loop with the given header and blocks,
+# as described by hoist_loop_invariants. Returns True if one was moved.
+def hoist_from_loop(blocks, header, loop, values_at_end, cost_model,
+		frequencies, probabilities):
+	changed = get_variables_changed(loop)
+	entries = [jmp for jmp in header.jumps_in if jmp.src not in loop]
+
+	# Unless the loop is where the program starts, a block before it
+	# must be jumped to from outside the loop to run at all
+	if len(entries) == 0 and header is not blocks[0]:
+		return False
+
+	for block in [blk for blk in blocks if blk in loop]:
+		for idx in range(len(block.instructions)):
+			found = find_invariant_calculation(block, idx, loop, changed)
+			if found is None:
+				continue
+
+			calculation, hands_used = found
+
+			instructions = [blk.instructions[i] for blk, i in calculation]
+			written = {instr.loc for instr in instructions
+					if instr.writes_variable}
+
+			# The calculation must be the only thing in the
+			# loop which changes the variables it writes.
+			if any((instr.writes_variable or instr.modifies_variable)
+					and instr.loc in written
+					and not any(instr is calc for calc in instructions)
+					for blk in loop for instr in blk.instructions):
+				continue
+
+			if not calculation_runs_first(calculation, loop, header):
+				continue
+
+			values = None
+			if len(entries) == 1 and header is not blocks[0]:
+				values = values_at_end.get(entries[0].src)
+
+			available = False
+			if values is not None:
+				values_after = number_calculation(instructions, values)
+				available = all(values.copy().get_variable_number(name)
+						== values_after.get_variable_number(name)
+						for name in written)
+
+			if not available:
+				if hands_used_at_start(header):
+					continue
+
+				# The block before the loop may need to jump into it
+				saved = len(instructions) - hands_used
+				runs = frequencies.get(block, 0) - sum(
+						frequencies.get(jmp.src, 0)
+							* get_jump_probability(jmp, probabilities)
+						for jmp in entries)
+				if header is blocks[0]:
+					runs -= 1
+
+				if not cost_model.choose([False, True], lambda hoist:
+						(1, -saved * runs) if hoist
+						else (0, 0)):
+					continue
+
+				preheader = hrmi.Block(header.lineno)
+				preheader.instructions = instructions
+				for jmp in entries:
+					jmp.redirect(preheader)
+
+				preheader.assign_next(header)
+				blocks.insert(blocks.index(header), preheader)
+
+				if values is not None:
+					values_at_end[preheader] = values_after
+
+			# If the value left in the hands is used, it's loaded back from
+			# the variable it was last saved to, where the calculation was.
+			last_block = calculation[-1][0]
+			reload_idx = min(i for blk, i in calculation if blk is last_block)
+
+			for blk, i in reversed(calculation):
+				del blk.instructions[i]
+
+			if hands_used:
+				last_block.instructions.insert(reload_idx,
+						hrmi.Load(instructions[-1].loc))
+
+			return True
+
+	return False
+
+# Default largest number of instructions unroll_loops may add to unroll a loop
+MAX_UNROLLED_SIZE = 16
+
+# Unroll loops which jump back to their start unconditionally, by running
+# copies of the whole loop one after the other, each jumping on to the next
+# copy in place of the start of the loop, and the last back to the original.
+# Each copy keeps its own tests for leaving the loop, so the loop may still
+# stop after any number of runs, but the copies may be laid out to follow on
+# from one another without a JUMP, and the state of the office is tracked
+# separately through each. Only loops with no loops inside them are unrolled.
+#
+# At most factor copies of the loop are run in total, so loops aren't unrolled
+# by default, and at most max_size instructions are added for each loop, which
+# is unrolled if the cost model thinks the JUMPs saved are worth the extra
+# instructions.
+def unroll_loops(blocks, cost_model, profile=None, factor=1,
+		max_size=MAX_UNROLLED_SIZE):
+	_, _, loops = find_loops(blocks)
+	frequencies, probabilities = estimate_block_frequencies(blocks, profile)
+
+	for header, loop in loops.items():
+		if any(other is not header and other in loop for other in loops):
+			continue
+
+		# Only one jump into each copy may be saved
+		back_jumps = [jmp for jmp in header.jumps_in if jmp.src in loop]
+		runs = max((frequencies.get(jmp.src, 0)
+					* get_jump_probability(jmp, probabilities)
+				for jmp in back_jumps if jmp is jmp.src.next), default=None)
+		if runs is None:
+			continue
+
+		loop_blocks = [blk for blk in blocks if blk in loop]
+		size = sum(len(blk.instructions) + (blk.conditional is not None)
+				for blk in loop_blocks)
+
+		copies = min(factor - 1, max_size // max(size, 1))
+		if copies < 1:
+			continue
+
+		saved = runs * copies / (copies + 1)
+		if not cost_model.choose([False, True], lambda unroll:
+				(size * copies, -saved) if unroll else (0, 0)):
+			continue
+
+		# Every copy is made before any jumps back to the header
+		# are redirected, so that each starts out as the original.
+		all_dups = []
+		for _ in range(copies):
+			dups = {blk: blk.duplicate() for blk in loop_blocks}
+			for dup in dups.values():
+				for jmp in (dup.conditional, dup.next):
+					if (jmp is not None and jmp.dest is not header
+							and jmp.dest in dups):
+						jmp.redirect(dups[jmp.dest])
+
+			all_dups.append(dups)
+
+		new_blocks = []
+		for dups in all_dups:
+			for jmp in back_jumps:
+				jmp.redirect(dups[header])
+
+			new_blocks.extend(dups[blk] for blk in loop_blocks)
+			back_jumps = [jmp for blk in new_blocks[-len(loop_blocks):]
+					for jmp in (blk.conditional, blk.next)
+					if jmp is not None and jmp.dest is header]
+
+		idx = blocks.index(loop_blocks[-1]) + 1
+		blocks[idx:idx] = new_blocks
+
+# Estimate the probability that a block's conditional jump is taken. A jump
+# out of a loop is assumed to be taken only on the last iteration of the loop.
+# Otherwise, each way is assumed to be equally likely.
+def estimate_branch_probability(block, loops):
+	cond_exits = False
+	next_exits = False
+	for loop in loops.values():
+		if block not in loop:
+			continue
+
+		cond_exits |= block.conditional.dest not in loop
+		next_exits |= block.next.dest not in loop
+
+	if cond_exits and not next_exits:
+		return 1 / ESTIMATED_LOOP_ITERATIONS
+
+	if next_exits and not cond_exits:
+		return 1 - 1 / ESTIMATED_LOOP_ITERATIONS
+
+	return 0.5
+
+# Largest number of times a loop is assumed to run each time it is entered,
+# when estimating from a profile. Loops which were never seen to exit,
+# such as forever loops, are assumed to run this many times.
+MAX_PROFILED_LOOP_ITERATIONS = 1000
+
+# Estimate how many times each block in scope is run, relative to the start
+# block, given the probability of each conditional jump being taken, and the
+# number of times each loop header is run each time its loop is entered.
+def propagate_frequencies(start, scope, order, back_edges,
+		probabilities, multipliers):
+	frequencies = {}
+
+	# Every jump which isn't a back edge goes forwards in reverse postorder,
+	# so the frequencies of all blocks jumping into a block are known before
+	# that block is reached.
+	for block in order:
+		if block not in scope:
+			continue
+
+		if block is start:
+			frequencies[block] = 1
+		else:
+			frequencies[block] = sum(
+					frequencies[jmp.src]
+						* get_jump_probability(jmp, probabilities)
+					for jmp in block.jumps_in
+					if jmp.src in frequencies
+						and (jmp.src, block) not in back_edges)
+
+		frequencies[block] *= multipliers.get(block, 1)
+
+	return frequencies
+
+# Estimate the number of times each loop header is run each time its loop is
+# entered, from the probabilities of each conditional jump being taken.
+# Starting from the header of each loop, innermost first, the probability of
+# reaching a back edge to the header is found, from which the average number
+# of times the loop is run follows.
+def estimate_loop_multipliers(order, back_edges, loops, probabilities):
+	multipliers = {}
+
+	for header in sorted(loops,
+			key=lambda header: (len(loops[header]), order.index(header))):
+		frequencies = propagate_frequencies(header, loops[header], order,
+				back_edges, probabilities, multipliers)
+
+		repeat_probability = sum(frequencies[jmp.src]
+					* get_jump_probability(jmp, probabilities)
+				for jmp in header.jumps_in
+				if (jmp.src, header) in back_edges)
+
+		multipliers[header] = 1 / max(1 - repeat_probability,
+				1 / MAX_PROFILED_LOOP_ITERATIONS)
+
+	return multipliers
+
+# Estimate how many times each block is run, relative to the first block.
+# Returns a tuple of (a dict mapping each block to its frequency, and a dict
+# mapping each block with a conditional jump to the probability it is taken).
+#
+# Without a profile, loops are assumed to run ESTIMATED_LOOP_ITERATIONS times
+# each time they are entered. With a profile, the probability of each
+# conditional jump on a line the profile has a record of is taken from the
+# profile, and the number of times each loop runs is worked out from those.
+def estimate_block_frequencies(blocks, profile=None):
+	back_edges, order, loops = find_loops(blocks)
+
+	probabilities = {}
+	for block in order:
+		if block.conditional is None or block.next is None:
+			continue
+
+		probability = None
+		if profile is not None:
+			probability = profile.get_branch_probability(block.lineno)
+
+		if probability is None:
+			probability = estimate_branch_probability(block, loops)
+
+		probabilities[block] = probability
+
+	if profile is None:
+		multipliers = dict.fromkeys(loops, ESTIMATED_LOOP_ITERATIONS)
+	else:
+		multipliers = estimate_loop_multipliers(order, back_edges,
+				loops, probabilities)
+
+	frequencies = dict.fromkeys(blocks, 0)
+	frequencies.update(propagate_frequencies(blocks[0], set(order), order,
+			back_edges, probabilities, multipliers))
+
+	return (frequencies, probabilities)
+
+# Probability that a jump is followed, given the probability of each
+# block's conditional jump being taken.
+def get_jump_probability(jmp, probabilities):
+	block = jmp.src
+	if block not in probabilities:
+		return 1
+
+	if jmp is block.conditional:
+		return probabilities[block]
+
+	return 1 - probabilities[block]
+
+# Reorder blocks so that as many unconditional jumps as possible, especially
+# those which are run most often, jump to the block directly after them, and
+# so don't need a JUMP instruction. Each jump saved saves an instruction, so
+# this helps both the size and speed of the program.
+#
+# Blocks are joined into chains, taking each unconditional jump in order of
+# how often it is estimated to run, and joining its source to its destination
+# if the source is at the end of a chain, and the destination is at the start
+# of another. The chains are then placed in order, starting from the chain
+# containing the first block, and finishing with the chain containing the end
+# of the program, if any.
+#
+# If an hcprofile.Profile is given, it is used to estimate how often each
+# jump runs.
+def layout_blocks(blocks, profile=None):
+	if len(blocks) == 0:
+		return
+
+	frequencies, probabilities = estimate_block_frequencies(blocks, profile)
+
+	# Tuples of (estimated number of runs, source block index, block)
+	# for each unconditional jump
+	edges = [(frequencies[block]
+				* get_jump_probability(block.next, probabilities),
+			idx, block)
+		for idx, block in enumerate(blocks)
+		if block.next is not None]
+
+	# Initially, each block is its own chain
+	chains = {block: [block] for block in blocks}
+	chain_of = {block: chains[block] for block in blocks}
+
+	for _, _, block in sorted(edges, key=lambda e: (-e[0], e[1])):
+		dest = block.next.dest
+		src_chain  = chain_of[block]
+		dest_chain = chain_of[dest]
+
+		# The first block must stay at the start of the program
+		if (src_chain[-1] is not block or dest_chain[0] is not dest
+				or src_chain is dest_chain or dest is blocks[0]):
+			continue
+
+		src_chain.extend(dest_chain)
+		del chains[dest]
+		for moved in dest_chain:
+			chain_of[moved] = src_chain
+
+	# The program ends by running off the end of the last block
+	ordered = [chains[head] for head in chains]
+	first_chain = chain_of[blocks[0]]
+	ordered.remove(first_chain)
+	ordered.insert(0, first_chain)
+
+	for chain in ordered:
+		if chain[-1].next is None and chain is not first_chain:
+			ordered.remove(chain)
+			ordered.append(chain)
+			break
+
+	blocks[:] = [block for chain in ordered for block in chain]
+
+	for idx, block in enumerate(blocks):
+		block.set_label(generate_name(idx))
+
+# Largest number of instructions in a tail which may be copied by
+# duplicate_tails, to limit how much the program may grow for each jump saved
+MAX_TAIL_DUPLICATION_SIZE = 6
+
+# Copy the small tails of code which are jumped to unconditionally from
+# several places into the blocks jumping to them, so that each may run
+# straight on into its own copy, rather than all but one needing a JUMP.
+# Each copy may then be optimised separately by state tracking, using what is
+# known on its path.
+#
+# A tail is a block and the blocks it runs straight on into, up to one which
+# must finish with a JUMP, eg. the end of a loop body following an if/else
+# statement, which jumps back to the start of the loop. If the tail didn't
+# finish with a JUMP, the copy would just move the JUMP elsewhere. Which jumps
+# are needed is found by trying out a layout of the blocks, so this must run
+# before the blocks are optimised, for the copies to be specialised.
+def duplicate_tails(blocks, cost_model, profile=None):
+	if len(blocks) == 0:
+		return
+
+	frequencies, probabilities = estimate_block_frequencies(blocks, profile)
+
+	trial = [*blocks]
+	layout_blocks(trial, profile)
+	falls_through = {trial[i] for i in range(len(trial) - 1)
+			if trial[i].next is not None and trial[i].next.dest is trial[i + 1]}
+
+	for join in [*blocks]:
+		tail = [join]
+		while tail[-1] in falls_through:
+			tail.append(tail[-1].next.dest)
+
+		if tail[-1].next is None:
+			continue
+
+		# The JUMP out of the copy replaces the JUMP into the original
+		size = sum(len(blk.instructions) + (blk.conditional is not None)
+				for blk in tail)
+		if size > MAX_TAIL_DUPLICATION_SIZE:
+			continue
+
+		for jmp in [*join.jumps_in]:
+			src = jmp.src
+			if jmp is not src.next or src in tail or src in falls_through:
+				continue
+
+			runs = frequencies.get(src, 0) * get_jump_probability(jmp,
+					probabilities)
+
+			if not cost_model.choose([False, True],
+					lambda dup: (size, -runs) if dup else (0, 0)):
+				continue
+
+			copies = [blk.duplicate() for blk in tail]
+			for blk, next_blk in zip(copies, copies[1:]):
+				blk.next.redirect(next_blk)
+
+			jmp.redirect(copies[0])
+			idx = blocks.index(src) + 1
+			blocks[idx:idx] = copies
+			falls_through.add(src)
+			falls_through.update(copies[:-1])
+
 def mark_implicit_jumps(blocks):
 	for i in range(len(blocks) - 1):
 		if blocks[i].next is None:
@@ -338,45 +1454,67 @@ def assign_memory(blocks, initial_memory):
 					and type(inst.loc) is str):
 				inst.loc = get_addr(inst.loc)
 
-def main():
-	import argparse
+# Number of instructions in a compiled program
+# Find the lines of the finished program, after peephole optimisation,
+# optionally with comments giving the source line of each instruction
+def program_lines(blocks, line_info=False):
+	lines = []
+	for block in blocks:
+		asm = block.to_asm(line_info)
+		if len(asm) > 0:
+			lines.extend(asm.split("\n"))
 
-	parser = argparse.ArgumentParser(description="Compile .hc files")
-	parser.add_argument("input", default=None)
+	return hcpeephole.optimise(lines)
 
-	args = parser.parse_args()
+# Count the instructions in the finished program
+def program_size(blocks):
+	return hcpeephole.count_instructions(program_lines(blocks))
 
-	tree = None
-	try:
-		if args.input is None:
-			tree = hcparse2.parse_file(sys.stdin)
-		else:
-			tree = hcparse2.parse_from_path(args.input)
-	except (LexerError, HCParseError) as e:
-		print(e, file=sys.stderr)
-		return 1
+# Compile the program at the given path into a list of blocks,
+# choosing how to compile each part of it using the given cost model,
+# and the hcprofile.Profile of a previous run of the program, if any.
+# Loops are unrolled by unroll_loops, given the factor and size to unroll by.
+def compile_program(path, cost_model, profile=None, unroll_factor=1,
+		unroll_size=MAX_UNROLLED_SIZE):
+	tree = hcparse2.parse_from_path(path)
 
-	try:
-		initial_memory_map = tree.get_memory_map()
-		namespace = tree.get_namespace()
-		tree.validate_structure(namespace)
+	initial_memory_map = tree.get_memory_map()
+	namespace = tree.get_namespace()
+	namespace.cost_model = cost_model
+	namespace.profile = profile
+	namespace.initial_values = {mem.name: mem.value
+			for mem in initial_memory_map if mem.value is not None}
+	tree.validate_structure(namespace)
 
-		tree.create_blocks()
-		end_block = hrmi.Block()
-		tree.last_block.assign_next(end_block)
+	tree.create_blocks()
+	end_block = hrmi.Block()
+	tree.last_block.assign_next(end_block)
 
-		blocks = extract_blocks(tree)
+	blocks = extract_blocks(tree)
 
-		# Ensure end block is at the end, if it's still present
-		if end_block in blocks:
-			blocks.remove(end_block)
-			blocks.append(end_block)
+	# Ensure end block is at the end, if it's still present
+	if end_block in blocks:
+		blocks.remove(end_block)
+		blocks.append(end_block)
 
-		merge_disjoint_variables(blocks, namespace, initial_memory_map)
-		optimise_state_tracking(blocks, initial_memory_map)
-	except HCTypeError as e:
-		print(e, file=sys.stderr)
-		return 1
+	collapse_redundant_blocks(blocks)
+
+	# Branches which are never taken are removed before anything is copied
+	propagate_constants(blocks, initial_memory_map)
+	collapse_redundant_blocks(blocks)
+
+	duplicate_tails(blocks, cost_model, profile)
+	values_at_end = number_global_values(blocks)
+	hoist_loop_invariants(blocks, values_at_end, cost_model, profile)
+	unroll_loops(blocks, cost_model, profile, unroll_factor, unroll_size)
+
+	# Variables left unread must not be saved to, before
+	# they are considered for merging with others.
+	optimise_variable_needs(blocks, initial_memory_map)
+
+	merge_disjoint_variables(blocks, namespace, initial_memory_map)
+	optimise_state_tracking(blocks, initial_memory_map, cost_model,
+			hcconst.TemporaryTiles(namespace.get_unique_name))
 
 	optimise_variable_needs(blocks, initial_memory_map)
 
@@ -384,14 +1522,116 @@ def main():
 
 	assign_memory(blocks, initial_memory_map)
 
+	layout_blocks(blocks, profile)
 	mark_implicit_jumps(blocks)
 
+	return blocks
+
+# Compile the program at the given path to take as few steps as possible,
+# using at most max_size instructions.
+#
+# Starts from the fastest program, then repeatedly overrides whichever choice
+# is expected to save the most instructions for each step it adds, until the
+# program fits. Returns the blocks of the first program found which fits,
+# or of the smallest found if none do.
+def compile_within_size(path, max_size, profile=None, unroll_factor=1,
+		unroll_size=MAX_UNROLLED_SIZE):
+	cost_model = hccost.BudgetCostModel()
+
+	smallest = None
+	while True:
+		cost_model.reset()
+		blocks = compile_program(path, cost_model, profile,
+				unroll_factor, unroll_size)
+		size = program_size(blocks)
+
+		if size <= max_size:
+			return blocks
+
+		if smallest is None or size < program_size(smallest):
+			smallest = blocks
+
+		override = cost_model.find_smaller_choice()
+		if override is None:
+			break
+
+		choice_idx, alt_idx = override
+		cost_model.overrides[choice_idx] = alt_idx
+
+	# Choices are estimated individually, so making each the smallest
+	# possible may still find a smaller program.
+	blocks = compile_program(path, hccost.COST_MODELS["size"], profile,
+			unroll_factor, unroll_size)
+	if program_size(blocks) < program_size(smallest):
+		smallest = blocks
+
+	return smallest
+
+def main():
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Compile .hc files")
+	parser.add_argument("input", default=None)
+	parser.add_argument("-O", dest="goal", choices=[*hccost.COST_MODELS],
+			default=hccost.DEFAULT_COST_MODEL.name,
+			help="Metric to optimise the program for: its size, the number "
+				"of instructions, or its speed, the number of steps taken. "
+				"Defaults to speed.")
+	parser.add_argument("--max-size", type=int, default=None,
+			help="Largest number of instructions the program may take. "
+				"The fastest program within this size is produced. "
+				"Overrides -O.")
+	parser.add_argument("--profile", default=None,
+			help="Profile of a previous run of the program, as written by "
+				"test/hrm.py --profile, used to find which parts of the "
+				"program run most often.")
+	parser.add_argument("--unroll", type=int, default=1, metavar="FACTOR",
+			help="Largest number of copies of each loop to run one after "
+				"the other, to save jumping back to the start of the loop. "
+				"Defaults to 1, not unrolling loops.")
+	parser.add_argument("--unroll-size", type=int,
+			default=MAX_UNROLLED_SIZE, metavar="SIZE",
+			help="Largest number of instructions which may be added to "
+				f"unroll each loop. Defaults to {MAX_UNROLLED_SIZE}.")
+	parser.add_argument("--line-info", action="store_true",
+			help="Mark each part of the output with the line of source "
+				"it was compiled from, so that it may be profiled.")
+
+	args = parser.parse_args()
+
+	profile = None
+	if args.profile is not None:
+		try:
+			profile = hcprofile.Profile.load(args.profile)
+		except (OSError, ValueError) as e:
+			print(f"Unable to load profile: {e}", file=sys.stderr)
+			return 1
+
+	try:
+		if args.max_size is None:
+			blocks = compile_program(args.input,
+					hccost.COST_MODELS[args.goal], profile,
+					args.unroll, args.unroll_size)
+		else:
+			blocks = compile_within_size(args.input, args.max_size, profile,
+					args.unroll, args.unroll_size)
+	except (LexerError, HCParseError, HCTypeError) as e:
+		print(e, file=sys.stderr)
+		return 1
+
+	lines = program_lines(blocks, args.line_info)
+
+	size = hcpeephole.count_instructions(lines)
+	if args.max_size is not None and size > args.max_size:
+		print(f"Unable to fit program in {args.max_size} instructions. "
+				f"The smallest program found has {size} "
+				"instructions", file=sys.stderr)
+		return 1
+
 	print("-- HUMAN RESOURCE MACHINE PROGRAM --\n")
 
-	for block in blocks:
-		asm = block.to_asm()
-		if len(asm) > 0:
-			print(asm)
+	for line in lines:
+		print(line)
 
 	return 0
 
@@ -0,0 +1,241 @@
+# Synthesis of constant values.
+#
+# HRM has no instruction to load a constant into the hands. Constants which
+# are already known to be held by a floor tile may simply be loaded from it,
+# but any others must be built from values which are known at that point in
+# the program. The ways of doing so considered here are:
+#
+#  * adding or subtracting a tile with a known value from a known value,
+#  * subtracting any value from itself to get zero,
+#  * saving a known value to a temporary tile, then bumping it up or down, and
+#  * multiplying a known value using a chain of additions from hcmultable,
+#    then bumping the result into place.
+#
+# Each gives a straight sequence of instructions, so takes as many steps as
+# it has instructions, and the shortest is chosen.
+
+import hcmultable
+import hrminstr as hrmi
+
+# Pool of temporary tiles which may be used while building constants. The
+# same tiles are reused for each constant, so as not to use more of the floor
+# than needed. Their values are tracked like any other variable's, so a tile
+# holding a constant may still be loaded from later, until it is reused.
+class TemporaryTiles:
+	__slots__ = [
+		# Function generating a new, unused, variable name
+		"get_unique_name",
+
+		# List of names generated so far
+		"names",
+	]
+
+	def __init__(self, get_unique_name):
+		self.get_unique_name = get_unique_name
+		self.names = []
+
+	# Fetch the name of the nth temporary tile
+	def get(self, idx):
+		while len(self.names) <= idx:
+			self.names.append(self.get_unique_name())
+
+		return self.names[idx]
+
+	# Fetch the name of the first temporary tile not in the given collection
+	def get_unused(self, used):
+		idx = 0
+		while self.get(idx) in used:
+			idx += 1
+
+		return self.get(idx)
+
+# A sequence of instructions leaving a known value in the hands
+class Sequence:
+	__slots__ = [
+		"instructions",
+
+		# Value left in the hands
+		"value",
+
+		# Name of a tile also holding the value, or None
+		"tile",
+
+		# Set of temporary tiles written by the sequence
+		"temps",
+	]
+
+	def __init__(self, instructions, value, tile=None, temps=()):
+		self.instructions = instructions
+		self.value = value
+		self.tile = tile
+		self.temps = set(temps)
+
+	# Extend this sequence with more instructions
+	def then(self, instructions, value, tile=None, temps=()):
+		return Sequence(self.instructions + instructions, value, tile,
+				self.temps | set(temps))
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+				+ repr(self.instructions) + ", "
+				+ repr(self.value) + ")")
+
+# Find sequences which leave some known value in the hands, which may be used
+# as a starting point to build the required value from.
+def find_starting_points(state, known, temp_tiles):
+	starts = []
+
+	hands_vars = [name for name, offset in state.get_hands_offsets()
+			if offset == 0]
+	hand_val = state.get_value_in_hands()
+	if hand_val is not None:
+		tile = hands_vars[0] if len(hands_vars) > 0 else None
+		starts.append(Sequence([], hand_val, tile))
+
+	for name, value in known.items():
+		if name in hands_vars:
+			continue
+
+		starts.append(Sequence([hrmi.Load(name)], value, name))
+
+	# Any value subtracted from itself gives zero
+	zero = None
+	if len(hands_vars) > 0:
+		zero = Sequence([hrmi.Subtract(hands_vars[0])], 0)
+	elif len(state.get_assigned_variables()) > 0:
+		name = state.get_assigned_variables()[0]
+		zero = Sequence([hrmi.Load(name), hrmi.Subtract(name)], 0)
+	elif state.hands_hold_value():
+		temp = temp_tiles.get(0)
+		zero = Sequence([hrmi.Save(temp), hrmi.Subtract(temp)], 0,
+				temps=[temp])
+
+	if zero is not None and hand_val != 0:
+		starts.append(zero)
+
+	# One and minus one are useful bases for multiplication
+	for bump, value in [(hrmi.BumpUp, 1), (hrmi.BumpDown, -1)]:
+		for start in [*starts]:
+			if start.value != 0 or value in known.values():
+				continue
+
+			temp = temp_tiles.get_unused(start.temps)
+			starts.append(start.then([hrmi.Save(temp), bump(temp)],
+					value, temp, [temp]))
+
+	return starts
+
+# Ensure the value left by a sequence is held by a tile,
+# so that it may be added, or bumped.
+def save_to_temp(seq, temp_tiles, reuse_temp=False):
+	if seq.tile is not None and (not reuse_temp or seq.tile in seq.temps):
+		return seq
+
+	temp = temp_tiles.get_unused(seq.temps)
+	return seq.then([hrmi.Save(temp)], seq.value, temp, [temp])
+
+# Bump the value left by a sequence to the given value
+def bump_to(seq, value, temp_tiles):
+	seq = save_to_temp(seq, temp_tiles, reuse_temp=True)
+
+	diff = value - seq.value
+	bump = hrmi.BumpUp if diff > 0 else hrmi.BumpDown
+	return seq.then([bump(seq.tile) for _ in range(abs(diff))],
+			value, seq.tile)
+
+# Multiply the value left by a sequence using a chain of additions,
+# or return None if any step of the chain would be out of range.
+def multiply(seq, multiplier, temp_tiles):
+	seq = save_to_temp(seq, temp_tiles)
+	tiles = [seq.tile]
+	values = [seq.value]
+	temps = set(seq.temps)
+
+	instructions = []
+	hands = seq.value
+	for opcode, idx in hcmultable.get_chain(multiplier):
+		if opcode == hcmultable.OP_SAVE:
+			temp = temp_tiles.get_unused(temps | set(tiles))
+			temps.add(temp)
+			tiles.append(temp)
+			values.append(hands)
+			instructions.append(hrmi.Save(temp))
+			continue
+
+		if opcode == hcmultable.OP_ADD:
+			hands += values[idx]
+			instructions.append(hrmi.Add(tiles[idx]))
+		else:
+			hands -= values[idx]
+			instructions.append(hrmi.Subtract(tiles[idx]))
+
+		if abs(hands) > hrmi.MAX_VALUE:
+			return None
+
+	return seq.then(instructions, hands, None, temps)
+
+# Find each way of building the given value considered
+def find_sequences(value, state, temp_tiles):
+	known = {}
+	for name in state.get_assigned_variables():
+		var_val = state.get_variable_value(name)
+		if var_val is not None and var_val not in known.values():
+			known[name] = var_val
+
+	for start in find_starting_points(state, known, temp_tiles):
+		if start.value == value:
+			yield start
+
+		for name, var_val in known.items():
+			if start.value + var_val == value:
+				yield start.then([hrmi.Add(name)], value)
+			if start.value - var_val == value:
+				yield start.then([hrmi.Subtract(name)], value)
+
+		yield bump_to(start, value, temp_tiles)
+
+		# Multiply to the nearest multiple, then bump the rest of the way
+		if start.value == 0:
+			continue
+
+		multiplier = round(value / start.value)
+		if abs(multiplier) < 2:
+			continue
+
+		product = multiply(start, multiplier, temp_tiles)
+		if product is None:
+			continue
+		elif product.value == value:
+			yield product
+		else:
+			yield bump_to(product, value, temp_tiles)
+
+# Find the cheapest list of instructions to leave the given value in the hands,
+# given the state of the office, or None if no value is available to build it
+# from.
+def synthesise_constant(value, state, cost_model, temp_tiles):
+	sequences = [*find_sequences(value, state, temp_tiles)]
+	if len(sequences) == 0:
+		return None
+
+	best = cost_model.choose(sequences, lambda seq:
+			(len(seq.instructions), len(seq.instructions)))
+	return best.instructions
+
+# Name standing in for any tile with an unknown value in estimates
+ESTIMATE_UNKNOWN_TILE = object()
+
+# Estimate the number of instructions needed to build the given value, before
+# the state of the office is known, given a dict mapping the names of tiles
+# which initially hold constants to their values. Assumes only those tiles,
+# and some other tile with an unknown value, are available.
+def estimate_constant_size(value, initial_values):
+	state = hrmi.OfficeState([hrmi.EmptyHands(),
+			hrmi.VariableAssigned(ESTIMATE_UNKNOWN_TILE)])
+	for name, tile_value in initial_values.items():
+		state.add_constraint(hrmi.VariableHasValue(name, tile_value))
+		state.add_constraint(hrmi.VariableAssigned(name))
+
+	temp_tiles = TemporaryTiles(lambda: object())
+	return min(len(seq.instructions)
+			for seq in find_sequences(value, state, temp_tiles))
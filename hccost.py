@@ -0,0 +1,126 @@
+# Cost models used to choose between alternative ways of compiling the same
+# code.
+#
+# HRM scores each solution on two metrics: its size, the number of instructions
+# in the program, and its speed, the number of steps taken to run it. Usually
+# one can only be improved at the expense of the other, eg. a multiplication
+# loop is small but slow, while unrolling it is fast but large. The compiler is
+# given a cost model for the metric to optimise for, and wherever it has a
+# choice, it picks the alternative the model rates as cheapest.
+
+class CostModel:
+	# Name used to select this model on the command line
+	name = None
+
+	# Key to sort alternatives by, given an estimate of the number of
+	# instructions each would add to the program, and the number of steps
+	# each would take to run. Alternatives with lower keys are preferred.
+	def key(self, size, steps):
+		raise NotImplementedError("CostModel.key", self)
+
+	# Pick the cheapest of a number of alternatives.
+	# cost is a function returning a tuple of (size, steps) for an alternative.
+	def choose(self, alternatives, cost):
+		return min(alternatives, key=lambda alt: self.key(*cost(alt)))
+
+	def __repr__(self):
+		return type(self).__name__ + "()"
+
+# Minimise the number of instructions, using steps to break ties
+class SizeCostModel(CostModel):
+	name = "size"
+
+	def key(self, size, steps):
+		return (size, steps)
+
+# Minimise the number of steps, using instructions to break ties
+class SpeedCostModel(CostModel):
+	name = "speed"
+
+	def key(self, size, steps):
+		return (steps, size)
+
+# Record of a single choice made by a BudgetCostModel
+class Choice:
+	__slots__ = [
+		# List of (size, steps) estimates for each alternative
+		"costs",
+
+		# Index of the alternative which was chosen
+		"chosen",
+	]
+
+	def __init__(self, costs, chosen):
+		self.costs = costs
+		self.chosen = chosen
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+			+ repr(self.costs) + ", " + repr(self.chosen) + ")")
+
+# Minimise the number of steps, while keeping the size of the whole program
+# within a limit. No single choice can tell how large the rest of the program
+# will be, so each choice follows the speed model unless it has been
+# overridden. Every choice made is recorded, so that after compiling, the
+# compiler can see which choices could make the program smaller, override
+# some of them, and compile again. See hccompile.compile_within_size.
+#
+# Choices are identified by the order in which they are made, which is the
+# same for each compile of a program, provided overriding one choice doesn't
+# change which others are made.
+class BudgetCostModel(CostModel):
+	def __init__(self):
+		# Dict mapping the index of a choice to the index of
+		# the alternative which should be chosen for it.
+		self.overrides = {}
+
+		# List of Choices made during the current compile
+		self.choices = []
+
+	def key(self, size, steps):
+		return (steps, size)
+
+	def choose(self, alternatives, cost):
+		alternatives = [*alternatives]
+		costs = [cost(alt) for alt in alternatives]
+
+		chosen = self.overrides.get(len(self.choices))
+		if chosen is None or chosen >= len(alternatives):
+			chosen = min(range(len(alternatives)),
+					key=lambda i: self.key(*costs[i]))
+
+		self.choices.append(Choice(costs, chosen))
+		return alternatives[chosen]
+
+	# Forget the choices made by a previous compile
+	def reset(self):
+		self.choices = []
+
+	# Find the override which is expected to save the most instructions for
+	# each extra step it takes. Returns a tuple of (choice index, alternative
+	# index), or None if no choice has a smaller alternative.
+	def find_smaller_choice(self):
+		best = None
+		best_key = None
+
+		for choice_idx, choice in enumerate(self.choices):
+			size, steps = choice.costs[choice.chosen]
+
+			for alt_idx, (alt_size, alt_steps) in enumerate(choice.costs):
+				if alt_size >= size:
+					continue
+
+				saved = size - alt_size
+				key = ((alt_steps - steps) / saved, -saved)
+				if best_key is None or key < best_key:
+					best = (choice_idx, alt_idx)
+					best_key = key
+
+		return best
+
+COST_MODELS = {model.name: model for model in [
+	SizeCostModel(),
+	SpeedCostModel(),
+]}
+
+DEFAULT_COST_MODEL = COST_MODELS["speed"]
@@ -37,6 +37,8 @@ tokens = (
 	"SUBTRACT",
 	"DBL_SUB",
 	"MULTIPLY",
+	"DIVIDE",
+	"MODULO",
 	"OPEN_BRACKET",
 	"CLOSE_BRACKET",
 	"BANG",
@@ -45,6 +47,8 @@ tokens = (
 	"ADD_EQUALS",
 	"SUB_EQUALS",
 	"MUL_EQUALS",
+	"DIV_EQUALS",
+	"MOD_EQUALS",
 
 	*keywords.values(),
 )
@@ -163,6 +167,22 @@ def t_MULTIPLY(t):
 	r"\*"
 	return track(t)
 
+def t_DIV_EQUALS(t):
+	r"/="
+	return track(t)
+
+def t_DIVIDE(t):
+	r"/"
+	return track(t)
+
+def t_MOD_EQUALS(t):
+	r"%="
+	return track(t)
+
+def t_MODULO(t):
+	r"%"
+	return track(t)
+
 def t_OPEN_BRACKET(t):
 	r"\("
 	return track(t)
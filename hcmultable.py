@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# Table of strategies for multiplying by a constant.
+#
+# HRM has no multiply instruction, so multiplying a value x by a constant is
+# done by repeated addition. The cheapest way to do this is found by searching
+# for the shortest "accumulator addition chain": a program which starts with x
+# both in the hands and on the floor, and is made up of two operations:
+#
+#  * ADD a value which has already been saved to the floor, and
+#  * SAVE the value currently in the hands to a new floor tile, so that it may
+#    be added again later.
+#
+# Each operation costs one instruction, and the program finishes once the hands
+# hold n * x. Saving intermediate values lets them be reused, eg. 10x may be
+# made as 5x + 5x rather than from a series of factors.
+#
+# Saved values may also be subtracted. Negative multipliers start by
+# subtracting x twice to get -x, then follow the chain for the positive
+# multiplier with the sign of each step flipped. Both positive and negative
+# chains are then improved where finishing with a subtraction is cheaper,
+# eg. 863x = 864x - x.
+#
+# The search is too slow to run on every compile, so the best chain for
+# every value in HRM's range is computed offline and saved to a data file,
+# which is loaded the first time it is needed. Run this module directly to
+# regenerate the data file.
+
+import os
+import sys
+from array import array
+from functools import lru_cache
+
+# Range of multipliers covered by the table
+TABLE_MIN = -999
+TABLE_MAX =  999
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+		"hcmultable.dat")
+
+# Operation codes used in chains.
+# Each operation is a tuple of (opcode, index), where index refers to the list
+# of floor tiles saved so far. Index 0 is always the original value.
+OP_SAVE = "save"
+OP_ADD  = "add"
+OP_SUB  = "sub"
+
+# Encoding of operations in the data file. Each operation takes one byte:
+# 0 for a save, 1 + index for an add, or 128 + index for a subtraction.
+def encode_op(op):
+	opcode, idx = op
+	if opcode == OP_SAVE:
+		return 0
+	elif opcode == OP_ADD:
+		return 1 + idx
+	else:
+		return 128 + idx
+
+def decode_op(byte):
+	if byte == 0:
+		return (OP_SAVE, None)
+	elif byte < 128:
+		return (OP_ADD, byte - 1)
+	else:
+		return (OP_SUB, byte - 128)
+
+# Run a chain, returning (the final multiplier in the hands,
+# and the list of multipliers saved to the floor).
+def run_chain(chain):
+	hands = 1
+	saved = [1]
+
+	for opcode, idx in chain:
+		if opcode == OP_SAVE:
+			saved.append(hands)
+		elif opcode == OP_ADD:
+			hands += saved[idx]
+		else:
+			hands -= saved[idx]
+
+	return (hands, saved)
+
+# Evaluate a chain, returning the multiplier it produces.
+def evaluate_chain(chain):
+	return run_chain(chain)[0]
+
+# Convert a chain which multiplies by n to one which multiplies by -n.
+# x is subtracted from itself twice to get -x, then each step is mirrored.
+# Since every saved value is negated, only uses of x itself must be flipped.
+def negate_chain(chain):
+	negated = [(OP_SUB, 0), (OP_SUB, 0)]
+
+	for opcode, idx in chain:
+		if idx == 0:
+			opcode = OP_SUB if opcode == OP_ADD else OP_ADD
+
+		negated.append((opcode, idx))
+
+	return negated
+
+# Largest value which may be in the hands after the given number of operations,
+# given the current value in hands, and the largest saved value.
+@lru_cache(maxsize=None)
+def _max_reachable(hands, largest_saved, ops):
+	if ops == 0:
+		return hands
+
+	best = _max_reachable(hands + largest_saved, largest_saved, ops - 1)
+	if hands != largest_saved:
+		best = max(best, _max_reachable(hands, hands, ops - 1))
+
+	return best
+
+# Find a chain of at most max_ops operations which multiplies by n.
+# Returns a list of operations, or None if no such chain exists.
+def _search(n, max_ops):
+	chain = []
+
+	# Additions between two saves may happen in any order, so they are always
+	# made in descending order of index to avoid searching each permutation.
+	def search_from(hands, saved, ops_left, max_idx, just_saved):
+		if hands == n:
+			return True
+
+		if ops_left == 0 or _max_reachable(hands, saved[-1], ops_left) < n:
+			return False
+
+		for idx in range(max_idx, -1, -1):
+			if hands + saved[idx] > n:
+				continue
+
+			chain.append((OP_ADD, idx))
+			if search_from(hands + saved[idx], saved, ops_left - 1,
+					idx, False):
+				return True
+			chain.pop()
+
+		# Saving is only useful after adding something new
+		if not just_saved:
+			chain.append((OP_SAVE, None))
+			if search_from(hands, (*saved, hands), ops_left - 1,
+					len(saved), True):
+				return True
+			chain.pop()
+
+		return False
+
+	if search_from(1, (1,), max_ops, 0, True):
+		return chain
+
+	return None
+
+# Find the shortest chain which multiplies by n, for any n >= 1, using only
+# additions. Uses iterative deepening, so that the first chain found is optimal.
+def find_chain(n):
+	if n < 1:
+		raise ValueError("Chains may only be found for positive multipliers", n)
+
+	max_ops = 0
+	while True:
+		chain = _search(n, max_ops)
+		if chain is not None:
+			return chain
+
+		max_ops += 1
+
+# Improve chains in the table by ending them with up to
+# max_tail extra additions or subtractions of saved values.
+# Repeats until no chain can be improved.
+def improve_with_subtraction(chains, max_tail=2):
+	improved = True
+	while improved:
+		improved = False
+
+		for chain in [*chains.values()]:
+			hands, saved = run_chain(chain)
+
+			tails = [([], hands)]
+			for _ in range(max_tail):
+				tails = [(tail + [(opcode, idx)],
+							value + saved[idx] if opcode == OP_ADD
+								else value - saved[idx])
+						for tail, value in tails
+						for idx in range(len(saved))
+						for opcode in (OP_ADD, OP_SUB)]
+
+				for tail, value in tails:
+					if (value == 0 or value < TABLE_MIN
+							or value > TABLE_MAX):
+						continue
+
+					if (value not in chains
+							or len(chain) + len(tail) < len(chains[value])):
+						chains[value] = chain + tail
+						improved = True
+
+# Lazily loaded table data: (offsets, operation bytes)
+_table = None
+
+def _load_table():
+	global _table
+
+	offsets = array("H")
+	ops = array("B")
+
+	with open(TABLE_PATH, "rb") as f:
+		offsets.fromfile(f, TABLE_MAX - TABLE_MIN + 2)
+		ops.frombytes(f.read())
+
+	if sys.byteorder != "little":
+		offsets.byteswap()
+
+	_table = (offsets, ops)
+
+# Look up the best known chain for multiplying by n.
+# Values outside the range of the table are searched for directly.
+def get_chain(n):
+	if n < TABLE_MIN or n > TABLE_MAX:
+		if n < 0:
+			return negate_chain(find_chain(-n))
+
+		return find_chain(n)
+
+	if _table is None:
+		_load_table()
+
+	offsets, ops = _table
+	idx = n - TABLE_MIN
+	return [decode_op(b) for b in ops[offsets[idx]:offsets[idx + 1]]]
+
+def generate_table(path=TABLE_PATH, verbose=False):
+	chains = {}
+	for n in range(1, TABLE_MAX + 1):
+		chains[n] = find_chain(n)
+		chains[-n] = negate_chain(chains[n])
+
+		if verbose:
+			print(n, len(chains[n]), file=sys.stderr)
+
+	improve_with_subtraction(chains)
+
+	offsets = array("H", [0])
+	ops = array("B")
+
+	# Multiplying by zero needs no chain, so is stored as an empty entry
+	for n in range(TABLE_MIN, TABLE_MAX + 1):
+		ops.extend(encode_op(op) for op in chains.get(n, []))
+		offsets.append(len(ops))
+
+	if sys.byteorder != "little":
+		offsets.byteswap()
+
+	with open(path, "wb") as f:
+		offsets.tofile(f)
+		ops.tofile(f)
+
+def main():
+	import argparse
+
+	parser = argparse.ArgumentParser(
+			description="Generate the constant multiplication table")
+	parser.add_argument("-o", "--output", default=TABLE_PATH,
+			help="Path to write the table to")
+	parser.add_argument("-v", "--verbose", action="store_true",
+			help="Print each chain length as it is found")
+
+	args = parser.parse_args()
+
+	generate_table(args.output, args.verbose)
+
+if __name__ == "__main__":
+	main()
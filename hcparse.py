@@ -101,6 +101,14 @@ def p_operator_mul_equals(p):
 	"mul_equals : MUL_EQUALS optws"
 	pass
 
+def p_operator_div_equals(p):
+	"div_equals : DIV_EQUALS optws"
+	pass
+
+def p_operator_mod_equals(p):
+	"mod_equals : MOD_EQUALS optws"
+	pass
+
 def p_operator_add(p):
 	"add : ADD optws"
 	pass
@@ -121,6 +129,14 @@ def p_operator_multiply(p):
 	"multiply : MULTIPLY optws"
 	pass
 
+def p_operator_divide(p):
+	"divide : DIVIDE optws"
+	pass
+
+def p_operator_modulo(p):
+	"modulo : MODULO optws"
+	pass
+
 def p_open_bracket(p):
 	"open_bracket : OPEN_BRACKET optws"
 	pass
@@ -229,6 +245,14 @@ def p_mul_assign(p):
 	"expr_assign : l_expr mul_equals expr_assign"
 	p[0] = ast.Assignment(p[1], ast.Multiply(ast.VariableRef(p[1]), p[3]))
 
+def p_div_assign(p):
+	"expr_assign : l_expr div_equals expr_assign"
+	p[0] = ast.Assignment(p[1], ast.Divide(ast.VariableRef(p[1]), p[3]))
+
+def p_mod_assign(p):
+	"expr_assign : l_expr mod_equals expr_assign"
+	p[0] = ast.Assignment(p[1], ast.Modulo(ast.VariableRef(p[1]), p[3]))
+
 def p_no_assign(p):
 	"expr_assign : expr"
 	p[0] = p[1]
@@ -303,12 +327,20 @@ def p_expr_m(p):
 	"expr_s : expr_m"
 	p[0] = p[1]
 
-# Expressions - Multiplication
+# Expressions - Multiplicative Operators
 
 def p_mul(p):
 	"expr_m : expr_m multiply expr_unary"
 	p[0] = ast.Multiply(p[1], p[3])
 
+def p_div(p):
+	"expr_m : expr_m divide expr_unary"
+	p[0] = ast.Divide(p[1], p[3])
+
+def p_mod(p):
+	"expr_m : expr_m modulo expr_unary"
+	p[0] = ast.Modulo(p[1], p[3])
+
 def p_expr_unary(p):
 	"expr_m : expr_unary"
 	p[0] = p[1]
@@ -0,0 +1,234 @@
+# Peephole optimisation of the final program.
+#
+# Some wasted instructions only show up once the blocks of the program have
+# been laid out one after the other, and their variables given addresses,
+# such as a block saving a value to a tile which the block after it loads
+# straight back. These are removed by looking over the lines of the finished
+# program for runs of instructions matching any of the patterns in RULES, and
+# replacing them with something shorter which does the same. Jumps to JUMPs
+# are also sent straight on to where they lead, and labels which are no
+# longer jumped to are removed, so that more of the patterns may match.
+# Everything is repeated until nothing more changes.
+#
+# Instructions which could only stop the program with an error, such as
+# loading from an empty tile, may be removed along with the rest.
+
+import re
+
+# Replaces a run of consecutive lines matching a pattern with other lines.
+#
+# Each line of a pattern is either an instruction, or a label followed by a
+# colon. Words in braces, such as {x}, are fields, which match any word, as
+# long as each field matches the same word everywhere it appears in the
+# pattern. A line of just * matches any instruction. The fields are filled
+# in on each line of the replacement.
+#
+# Comments between the matched lines, such as those added by --line-info,
+# are skipped over, and kept after the replacement.
+class Rule:
+	__slots__ = [
+		"pattern",
+		"replacement",
+
+		# Regular expression for each line of the pattern,
+		# with a group for each field
+		"regexes",
+	]
+
+	def __init__(self, pattern, replacement):
+		self.pattern = pattern
+		self.replacement = replacement
+		self.regexes = [None if line == "*" else
+				re.compile(re.sub(r"\\\{(\w+)\\\}", r"(?P<\1>\\w+)",
+					re.escape(line)))
+				for line in pattern]
+
+	# Match the pattern against the lines starting at the given index.
+	# Returns a tuple of (the index after the last line matched, and a dict
+	# mapping each field to the word it matched), or None.
+	def match(self, lines, idx):
+		fields = {}
+		for regex in self.regexes:
+			while idx < len(lines) and is_comment(lines[idx]):
+				idx += 1
+
+			if idx >= len(lines):
+				return None
+
+			line = lines[idx]
+			if regex is None:
+				if is_label(line):
+					return None
+
+				idx += 1
+				continue
+
+			match = regex.fullmatch(line)
+			if match is None:
+				return None
+
+			for name, word in match.groupdict().items():
+				if fields.setdefault(name, word) != word:
+					return None
+
+			idx += 1
+
+		return (idx, fields)
+
+	# Replace the lines matched from the given index, returning the
+	# index after the replacement, or None if the pattern doesn't match
+	def apply(self, lines, idx):
+		found = self.match(lines, idx)
+		if found is None:
+			return None
+
+		end, fields = found
+		replacement = [line.format(**fields) for line in self.replacement]
+		replacement += [line for line in lines[idx:end] if is_comment(line)]
+		lines[idx:end] = replacement
+		return idx + len(replacement)
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+				+ repr(self.pattern) + ", "
+				+ repr(self.replacement) + ")")
+
+RULES = [
+	# The hands still hold the value just saved
+	Rule(["COPYTO {x}", "COPYFROM {x}"], ["COPYTO {x}"]),
+
+	# The tile already holds the value just loaded from it
+	Rule(["COPYFROM {x}", "COPYTO {x}"], ["COPYFROM {x}"]),
+
+	# A value loaded and replaced straight away is never used
+	Rule(["COPYFROM {x}", "COPYFROM {y}"], ["COPYFROM {y}"]),
+
+	# Adding and subtracting the same tile leaves the hands as they were
+	Rule(["ADD {x}", "SUB {x}"], []),
+	Rule(["SUB {x}", "ADD {x}"], []),
+
+	# Jumps to the next line go to the same place either way
+	Rule(["JUMP {a}", "{a}:"], ["{a}:"]),
+	Rule(["JUMPZ {a}", "{a}:"], ["{a}:"]),
+	Rule(["JUMPN {a}", "{a}:"], ["{a}:"]),
+
+	# Nothing after a JUMP runs unless it's jumped to
+	Rule(["JUMP {a}", "*"], ["JUMP {a}"]),
+]
+
+# Longest pattern in RULES, so that the lines before a replacement which may
+# now match a pattern including it may be checked again
+MAX_PATTERN_LENGTH = max(len(rule.pattern) for rule in RULES)
+
+def is_comment(line):
+	return line.lstrip().startswith("--")
+
+def is_label(line):
+	return line.endswith(":")
+
+# Count the instructions in the lines of a program
+def count_instructions(lines):
+	return sum(not is_comment(line) and not is_label(line) for line in lines)
+
+# Split a jump instruction into its mnemonic and label, or return None
+def parse_jump(line):
+	match = re.fullmatch(r"(JUMP[ZN]?) (\w+)", line)
+	if match is None:
+		return None
+
+	return (match[1], match[2])
+
+# Apply the rules at each line, until none match. Returns True if any did.
+def apply_rules(lines, rules=RULES):
+	changed = False
+	idx = 0
+	while idx < len(lines):
+		if is_comment(lines[idx]):
+			idx += 1
+			continue
+
+		for rule in rules:
+			end = rule.apply(lines, idx)
+			if end is not None:
+				changed = True
+				idx = max(idx - MAX_PATTERN_LENGTH + 1, 0)
+				break
+		else:
+			idx += 1
+
+	return changed
+
+# Find the first instruction run after each label
+def find_label_targets(lines):
+	targets = {}
+	labels = []
+	for line in lines:
+		if is_comment(line):
+			continue
+
+		if is_label(line):
+			labels.append(line[:-1])
+			continue
+
+		for label in labels:
+			targets[label] = line
+
+		labels = []
+
+	return targets
+
+# Send jumps to a JUMP straight to where it leads.
+# Returns True if any jumps were changed.
+def thread_jumps(lines):
+	targets = find_label_targets(lines)
+
+	def follow(label):
+		seen = {label}
+		while True:
+			jump = parse_jump(targets.get(label, ""))
+			if jump is None or jump[0] != "JUMP":
+				return label
+
+			label = jump[1]
+
+			# Leave jumps into endless loops of JUMPs alone
+			if label in seen:
+				return None
+
+			seen.add(label)
+
+	changed = False
+	for idx, line in enumerate(lines):
+		jump = parse_jump(line)
+		if jump is None:
+			continue
+
+		mnemonic, label = jump
+		dest = follow(label)
+		if dest is not None and dest != label:
+			lines[idx] = mnemonic + " " + dest
+			changed = True
+
+	return changed
+
+# Remove labels which nothing jumps to. Returns True if any were removed.
+def remove_unused_labels(lines):
+	used = {jump[1] for jump in map(parse_jump, lines) if jump is not None}
+	kept = [line for line in lines
+			if not is_label(line) or line[:-1] in used]
+
+	changed = len(kept) != len(lines)
+	lines[:] = kept
+	return changed
+
+# Optimise the lines of a program, returning the optimised lines
+def optimise(lines):
+	lines = [*lines]
+
+	changed = True
+	while changed:
+		changed = apply_rules(lines)
+		changed |= thread_jumps(lines)
+		changed |= remove_unused_labels(lines)
+
+	return lines
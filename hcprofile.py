@@ -0,0 +1,91 @@
+# Execution profiles, recording how often each part of a program ran on some
+# representative inboxes.
+#
+# A profile is collected by compiling a program with --line-info, which marks
+# each part of the output with the line of source it was compiled from, then
+# running it in the emulator with --profile (see test/hrm.py). The profile may
+# then be passed back to the compiler with --profile, to guide decisions which
+# depend on which parts of the program run most often, such as how to lay out
+# blocks, and whether to rotate loops.
+#
+# Counts are keyed on source line numbers rather than on the labels in the
+# compiled program, so that a profile remains useful after small edits to the
+# source, or when the program is compiled with different options.
+#
+# Profiles are stored as JSON objects with the keys:
+#  * "lines": the number of times each line was entered, ie. the number of
+#    times control moved to an instruction compiled from that line, from an
+#    instruction compiled from a different line, or from the start of the
+#    program.
+#  * "branches": a pair of [taken, not taken] counts for the conditional
+#    jumps compiled from each line. Where a line has several conditional
+#    jumps, their counts are summed.
+#  * "labels": the number of times the instruction at each label in the
+#    profiled program ran. These are not used by the compiler, but may help
+#    to read the profile against the program it was collected from.
+
+import json
+
+class Profile:
+	__slots__ = [
+		# Dicts mapping line numbers to counts, as described above
+		"lines",
+		"branches",
+
+		# Dict mapping label names to counts
+		"labels",
+	]
+
+	def __init__(self, lines=None, branches=None, labels=None):
+		self.lines = lines if lines is not None else {}
+		self.branches = branches if branches is not None else {}
+		self.labels = labels if labels is not None else {}
+
+	@classmethod
+	def load(cls, path):
+		with open(path) as f:
+			data = json.load(f)
+
+		return cls(
+			{int(line): count
+				for line, count in data.get("lines", {}).items()},
+			{int(line): tuple(counts)
+				for line, counts in data.get("branches", {}).items()},
+			data.get("labels", {}))
+
+	# Number of times the given line was entered,
+	# or None if the profile has no record of the line.
+	def get_line_count(self, lineno):
+		return self.lines.get(lineno)
+
+	# Probability that a conditional jump compiled from the given line is
+	# taken, or None if no conditional jump on that line was ever run.
+	def get_branch_probability(self, lineno):
+		taken, not_taken = self.branches.get(lineno, (0, 0))
+		if taken + not_taken == 0:
+			return None
+
+		return taken / (taken + not_taken)
+
+	# Average number of times a loop ran its body each time it was entered,
+	# given the line of the loop's condition, and the lines of the statements
+	# making up the top level of its body, or None if unknown.
+	#
+	# The condition is entered once as the loop is entered, then again after
+	# each run of the body, so the number of times the loop was entered is the
+	# number of times the condition was entered, less the number of times the
+	# body was.
+	def get_loop_iterations(self, cond_lineno, body_linenos):
+		cond_count = self.get_line_count(cond_lineno)
+		body_counts = [self.get_line_count(lineno) for lineno in body_linenos]
+		if cond_count is None or None in body_counts or len(body_counts) == 0:
+			return None
+
+		# Some statements may not compile to any instructions, and
+		# so are never entered, so the most often entered is used.
+		iterations = max(body_counts)
+		entries = cond_count - iterations
+		if entries <= 0:
+			return None
+
+		return iterations / entries
@@ -0,0 +1,467 @@
+# Static single assignment form, and sparse conditional constant propagation.
+#
+# The program is converted into SSA form, where each value written to a floor
+# tile or to the hands is a separate definition, and a phi node at the start
+# of a block chooses between the definitions reaching it from each jump into
+# it. Sparse conditional constant propagation then finds which of these values
+# are constant, along with which jumps may ever be followed, by evaluating
+# only the definitions which may be reached from the start of the program.
+#
+# Unlike the state tracking done by propagate_state in hccompile, whose facts
+# about each path into a block are intersected where they meet, this finds
+# the values of definitions which only differ along paths it has found can't
+# be followed, and runs before any variables share tiles, so it may decide
+# conditional jumps on values which the state tracking loses.
+#
+# The SSA form is kept alongside the blocks, rather than replacing their
+# variables. No definition is moved or copied while it is in SSA form, so the
+# definitions of each variable never overlap, and converting back is only a
+# matter of applying what was found to the original instructions, and dropping
+# the phi nodes.
+
+import hrminstr as hrmi
+
+# Location of the value in the processor's hands, as opposed to any variable
+HANDS = None
+
+# Values in the lattice other than constant numbers. A definition starts as
+# UNDEFINED, until some value has been found for it. A definition may then
+# only move from UNDEFINED, to a constant, to NONZERO, to VARYING, so
+# each is evaluated a limited number of times.
+class LatticeValue:
+	__slots__ = ["name"]
+
+	def __init__(self, name):
+		self.name = name
+
+	def __repr__(self):
+		return "hcssa." + self.name
+
+UNDEFINED = LatticeValue("UNDEFINED")
+
+# Any value other than zero. This is as much as is known about a Difference,
+# which may give either of its variables minus the other.
+NONZERO = LatticeValue("NONZERO")
+
+VARYING = LatticeValue("VARYING")
+
+# Check whether a value in the lattice is a known constant number
+def is_constant(value):
+	return isinstance(value, int)
+
+# Find the lattice value covering both of the given values
+def meet(left, right):
+	if left is UNDEFINED or left == right:
+		return right
+
+	if right is UNDEFINED:
+		return left
+
+	if left is VARYING or right is VARYING or left == 0 or right == 0:
+		return VARYING
+
+	return NONZERO
+
+# Find the result of some arithmetic on two lattice values
+def combine(left, right, operator):
+	if left is VARYING or right is VARYING:
+		return VARYING
+
+	if left is UNDEFINED or right is UNDEFINED:
+		return UNDEFINED
+
+	if not is_constant(left) or not is_constant(right):
+		return VARYING
+
+	result = hrmi.checked_value(operator(left, right))
+	return VARYING if result is None else result
+
+def add(left, right):
+	return left + right
+
+def subtract(left, right):
+	return left - right
+
+# A single definition of the value in the hands or a variable
+class Definition:
+	__slots__ = [
+		# Name of the variable, or HANDS
+		"loc",
+
+		# Known value, as an int or LatticeValue
+		"value",
+
+		# List of the Operations, PhiNodes, and Blocks whose
+		# conditional jumps use this definition
+		"uses",
+	]
+
+	def __init__(self, loc, value=UNDEFINED):
+		self.loc = loc
+		self.value = value
+		self.uses = []
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+				+ repr(self.loc) + ", "
+				+ repr(self.value) + ")")
+
+# Chooses the definition of a location at the start of a block
+# from the one reaching the end of the jump which was followed.
+class PhiNode:
+	__slots__ = [
+		"block",
+		"definition",
+
+		# Dict mapping each jump into the block to the definition it brings.
+		# The start of the program is included as a jump of None.
+		"args",
+	]
+
+	def __init__(self, block, loc):
+		self.block = block
+		self.definition = Definition(loc)
+		self.args = {}
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+				+ repr(self.definition.loc) + ", "
+				+ repr([*self.args.values()]) + ")")
+
+# An instruction, with the definitions it reads and writes
+class Operation:
+	__slots__ = [
+		"block",
+		"instr",
+
+		# Dicts mapping each location read, or written, to its definition
+		"uses",
+		"defs",
+
+		# Dict mapping each location written to the
+		# definition it held before this instruction
+		"previous",
+	]
+
+	def __init__(self, block, instr):
+		self.block = block
+		self.instr = instr
+		self.uses = {}
+		self.defs = {}
+		self.previous = {}
+
+	# Find the value of each location this instruction writes, given
+	# the values of the locations it reads
+	def evaluate(self):
+		instr = self.instr
+		values = {loc: defn.value for loc, defn in self.uses.items()}
+
+		if isinstance(instr, hrmi.Save):
+			return {instr.loc: values[HANDS]}
+
+		if isinstance(instr, hrmi.Load):
+			return {HANDS: values[instr.loc]}
+
+		if isinstance(instr, hrmi.LoadConstant):
+			return {HANDS: instr.value}
+
+		if isinstance(instr, hrmi.Add):
+			return {HANDS: combine(values[HANDS], values[instr.loc], add)}
+
+		if isinstance(instr, hrmi.Subtract):
+			return {HANDS: combine(values[HANDS], values[instr.loc],
+					subtract)}
+
+		if isinstance(instr, hrmi.AbstractBumpInstruction):
+			value = combine(values[instr.loc], instr.delta, add)
+			return {instr.loc: value, HANDS: value}
+
+		if isinstance(instr, hrmi.LoadDifference):
+			return {HANDS: combine(values[instr.left], values[instr.right],
+					subtract)}
+
+		# Only whether a Difference is zero is known,
+		# as it may be negated
+		if isinstance(instr, hrmi.Difference):
+			value = combine(values[instr.left], values[instr.right],
+					subtract)
+			if is_constant(value) and value != 0:
+				value = NONZERO
+
+			return {HANDS: value}
+
+		# Input and output leave unknown values, or nothing, in the hands
+		return {loc: VARYING for loc in self.defs}
+
+	# Check whether this instruction only writes values which
+	# each location it writes to is already known to hold
+	def is_redundant(self):
+		return len(self.defs) > 0 and all(is_constant(defn.value)
+				and self.previous[loc].value == defn.value
+				for loc, defn in self.defs.items())
+
+	def __repr__(self):
+		return type(self).__name__ + "(" + repr(self.instr) + ")"
+
+# Find the names of the locations an instruction reads and writes,
+# as a tuple of (a list of locations read, a list of locations written)
+def get_locations(instr):
+	reads = [*instr.get_variables_read()]
+	writes = []
+
+	if isinstance(instr, (hrmi.Output, hrmi.Save, hrmi.Add, hrmi.Subtract)):
+		reads.insert(0, HANDS)
+
+	if instr.writes_variable or instr.modifies_variable:
+		writes.append(instr.loc)
+
+	if (instr.writes_hands
+			or isinstance(instr, (hrmi.Output, hrmi.Add, hrmi.Subtract))):
+		writes.append(HANDS)
+
+	return (reads, writes)
+
+# Jumps into a block from blocks which may be reached
+def get_jumps_in(block, reachable):
+	return [jmp for jmp in block.jumps_in if jmp.src in reachable]
+
+# Find the dominance frontier of each block: the blocks which may be reached
+# from it, but which it doesn't dominate, without passing through any others.
+# This is where definitions made in the block may meet others.
+def find_dominance_frontiers(order, idoms):
+	reachable = set(order)
+	frontiers = {blk: {} for blk in order}
+
+	for blk in order:
+		preds = [jmp.src for jmp in get_jumps_in(blk, reachable)]
+		if blk is order[0]:
+			preds.append(None)
+
+		if len(preds) < 2:
+			continue
+
+		for pred in preds:
+			runner = pred
+			while runner is not None and runner is not idoms.get(blk):
+				frontiers[runner][blk] = None
+				runner = idoms.get(runner)
+
+	return frontiers
+
+# Program in SSA form, with the known value of each definition
+class SSAForm:
+	__slots__ = [
+		# Reachable blocks, in reverse postorder
+		"order",
+
+		# Dict mapping each block to a list of its phi nodes
+		"phis",
+
+		# Dict mapping each block to a list of Operations,
+		# one for each of its instructions
+		"operations",
+
+		# Dict mapping each block to a dict mapping
+		# each location to its definition at the end
+		"defs_at_end",
+
+		# Properties found by propagate_constants
+		"executable_jumps",
+		"executable_blocks",
+	]
+
+	# Convert the reachable blocks in the given order into SSA form, given
+	# the immediate dominator of each, and the initial memory map.
+	def __init__(self, order, idoms, initial_memory):
+		self.order = order
+		self.phis = {}
+		self.operations = {}
+		self.defs_at_end = {}
+		self.executable_jumps = {}
+		self.executable_blocks = {}
+
+		start_values = {mem.name: mem.value for mem in initial_memory
+				if mem.value is not None}
+
+		# Every location is defined at the start of the program, as
+		# well as in each block with an instruction writing to it
+		def_blocks = {HANDS: {order[0]: None}}
+		for blk in order:
+			for instr in blk.instructions:
+				reads, writes = get_locations(instr)
+				for loc in reads + writes:
+					def_blocks.setdefault(loc, {order[0]: None})
+
+				for loc in writes:
+					def_blocks[loc][blk] = None
+
+		# Definitions held at the start of the program
+		start_defs = {loc: Definition(loc, start_values.get(loc, VARYING))
+				for loc in def_blocks}
+
+		# Place a phi node wherever definitions of a location may meet, which
+		# is itself a new definition which may meet others
+		frontiers = find_dominance_frontiers(order, idoms)
+		phi_blocks = {blk: {} for blk in order}
+		for loc, blks in def_blocks.items():
+			to_check = [*blks]
+			while len(to_check) > 0:
+				blk = to_check.pop()
+				for frontier in frontiers[blk]:
+					if loc in phi_blocks[frontier]:
+						continue
+
+					phi_blocks[frontier][loc] = PhiNode(frontier, loc)
+					if frontier not in blks:
+						to_check.append(frontier)
+
+		# The definitions at the start of a block are those at the end of its
+		# immediate dominator, unless replaced by a phi node. Blocks come after
+		# their dominators, so these are always known.
+		for blk in order:
+			if blk in idoms:
+				defs = dict(self.defs_at_end[idoms[blk]])
+			else:
+				defs = dict(start_defs)
+
+			self.phis[blk] = [*phi_blocks[blk].values()]
+			for phi in self.phis[blk]:
+				defs[phi.definition.loc] = phi.definition
+
+			self.operations[blk] = []
+			for instr in blk.instructions:
+				op = Operation(blk, instr)
+				reads, writes = get_locations(instr)
+				for loc in reads:
+					op.uses[loc] = defs[loc]
+					defs[loc].uses.append(op)
+
+				for loc in writes:
+					op.previous[loc] = defs[loc]
+					op.defs[loc] = defs[loc] = Definition(loc)
+
+				self.operations[blk].append(op)
+
+			if blk.conditional is not None:
+				defs[HANDS].uses.append(blk)
+
+			self.defs_at_end[blk] = defs
+
+		reachable = set(order)
+		for blk in order:
+			for phi in self.phis[blk]:
+				loc = phi.definition.loc
+				if blk is order[0]:
+					phi.args[None] = start_defs[loc]
+
+				for jmp in get_jumps_in(blk, reachable):
+					phi.args[jmp] = self.defs_at_end[jmp.src][loc]
+					phi.args[jmp].uses.append(phi)
+
+	# Find the known value of each definition, and which jumps may be
+	# followed. Definitions are only evaluated once a jump into their block
+	# may be followed, and each phi node only uses the definitions from
+	# jumps which may be followed, so values only assigned along jumps which
+	# may never be followed don't stop others being known.
+	def propagate_constants(self):
+		jumps_to_check = [(None, self.order[0])]
+		uses_to_check = []
+
+		def set_value(defn, value):
+			if value != defn.value:
+				defn.value = value
+				uses_to_check.extend(defn.uses)
+
+		def visit_phi(phi):
+			value = UNDEFINED
+			for jmp, defn in phi.args.items():
+				if jmp in self.executable_jumps:
+					value = meet(value, defn.value)
+
+			set_value(phi.definition, value)
+
+		def visit_operation(op):
+			for loc, value in op.evaluate().items():
+				set_value(op.defs[loc], value)
+
+		def visit_jumps(blk):
+			cjump = blk.conditional
+			follow_cond, follow_next = False, True
+			if cjump is not None:
+				hands = self.defs_at_end[blk][HANDS].value
+				follow_cond, follow_next = get_jumps_followed(cjump, hands)
+
+			for jmp, followed in [(cjump, follow_cond),
+					(blk.next, follow_next)]:
+				if followed and jmp is not None:
+					jumps_to_check.append((jmp, jmp.dest))
+
+		while len(jumps_to_check) > 0 or len(uses_to_check) > 0:
+			if len(jumps_to_check) > 0:
+				jmp, blk = jumps_to_check.pop()
+				if jmp in self.executable_jumps:
+					continue
+
+				self.executable_jumps[jmp] = None
+
+				for phi in self.phis[blk]:
+					visit_phi(phi)
+
+				# The rest of the block only needs evaluating the first time
+				if blk in self.executable_blocks:
+					continue
+
+				self.executable_blocks[blk] = None
+				for op in self.operations[blk]:
+					visit_operation(op)
+
+				visit_jumps(blk)
+				continue
+
+			use = uses_to_check.pop()
+			if isinstance(use, PhiNode):
+				if use.block in self.executable_blocks:
+					visit_phi(use)
+			elif isinstance(use, Operation):
+				if use.block in self.executable_blocks:
+					visit_operation(use)
+			elif use in self.executable_blocks:
+				visit_jumps(use)
+
+	# Convert the program back out of SSA form, removing the jumps which were
+	# found never to be followed, and the instructions which only write values
+	# already held where they write them. Blocks which may no longer be
+	# reached are left in place, to be removed afterwards.
+	def apply(self):
+		for blk in self.executable_blocks:
+			blk.instructions = [op.instr for op in self.operations[blk]
+					if not op.is_redundant()]
+
+			cjump = blk.conditional
+			if cjump is None:
+				continue
+
+			if cjump not in self.executable_jumps:
+				if blk.next in self.executable_jumps:
+					blk.unlink_conditional()
+			elif blk.next not in self.executable_jumps:
+				blk.next.redirect(cjump.dest)
+				blk.unlink_conditional()
+
+# Find whether a conditional jump, and the jump following it, may be followed,
+# given the lattice value in the hands. Returns a tuple of booleans.
+def get_jumps_followed(cjump, hands):
+	if hands is UNDEFINED:
+		return (False, False)
+
+	if hands is VARYING:
+		return (True, True)
+
+	if isinstance(cjump, hrmi.JumpZero):
+		passes = hands == 0
+	elif hands is NONZERO:
+		return (True, True)
+	else:
+		passes = hands < 0
+
+	return (passes, not passes)
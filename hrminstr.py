@@ -1,8 +1,22 @@
+import copy
+
 from hcexceptions import HCTypeError
 
 class HRMIInternalError(Exception):
 	pass
 
+# Largest magnitude of any value in HRM. Arithmetic giving
+# a result outside of this range stops the program.
+MAX_VALUE = 999
+
+# Find the result of some arithmetic on known values,
+# or None if the operation would be out of range.
+def checked_value(value):
+	if abs(value) > MAX_VALUE:
+		return None
+
+	return value
+
 class HRMInstruction:
 	# Should be overridden to True for instructions which
 	# require a variable to be set to a value
@@ -14,6 +28,10 @@ class HRMInstruction:
 	# the value, but still rely on a value already being set.
 	writes_variable = False
 
+	# Should be overridden to True for instructions which modify the value
+	# of the variable in their .loc property, relying on its current value.
+	modifies_variable = False
+
 	# These two follow the same rules as (reads|writes)_variable, but applying
 	# to values read from or written to the hands.
 	reads_hands = False
@@ -65,14 +83,37 @@ class HRMInstruction:
 	def clear_variable_use(self):
 		self.variables_used.clear()
 
+	# Names of the variables whose values are read by this instruction
+	def get_variables_read(self):
+		return []
+
+	# Change any references to a variable to refer to another
+	def rename_variable(self, old_name, new_name):
+		pass
+
+	# Read each variable from the earliest copy of its current value instead,
+	# so that later copies may not need to be saved at all.
+	def propagate_copies(self, state):
+		for name in self.get_variables_read():
+			self.rename_variable(name, state.get_variable_source(name))
+
+	# Create a copy of this instruction, to be placed elsewhere in the program
+	def clone(self):
+		instr = copy.copy(self)
+		instr.variables_used = set(self.variables_used)
+		return instr
+
 class Input(HRMInstruction):
 	writes_hands = True
 
 	def to_asm(self):
 		return "INBOX"
 
+	# The program ends if the inbox is empty,
+	# so the hands always hold a value afterwards
 	def simulate_state(self, state):
 		state.clear_hand_constraints()
+		state.add_constraint(HandsAssigned())
 
 	def __repr__(self):
 		return "hrmi.Input()"
@@ -101,6 +142,13 @@ class AbstractParameterisedInstruction(HRMInstruction):
 	def to_asm(self):
 		return self.mnemonic + " " + str(self.loc)
 
+	def get_variables_read(self):
+		return [self.loc] if self.reads_variable else []
+
+	def rename_variable(self, old_name, new_name):
+		if self.loc == old_name:
+			self.loc = new_name
+
 	def __repr__(self):
 		return ("hrmi." + type(self).__name__ + "("
 				+ repr(self.loc) + ")")
@@ -111,12 +159,24 @@ class Save(AbstractParameterisedInstruction):
 	reads_hands = True
 
 	def simulate_state(self, state):
+		hands_range = state.get_hands_range()
+		hands_offsets = [(name, offset)
+				for name, offset in state.get_hands_offsets()
+				if name != self.loc]
+
 		state.clear_variable_constraints(self.loc)
 		state.add_constraint(VariableInHands(self.loc))
+		state.add_constraint(VariableAssigned(self.loc))
 
 		val = state.get_value_in_hands()
 		if val is not None:
 			state.add_constraint(VariableHasValue(self.loc, val))
+		else:
+			state.set_variable_range(self.loc, hands_range)
+
+		# The hands' relation to other variables now holds for this one too
+		for name, offset in hands_offsets:
+			state.add_constraint(VariableOffset(self.loc, name, offset))
 
 	def state_redundant(self, state_before):
 		return state_before.has_constraint(VariableInHands(self.loc))
@@ -132,19 +192,32 @@ class Load(AbstractParameterisedInstruction):
 	writes_hands = True
 
 	def simulate_state(self, state):
-		var_in_hands = VariableInHands(self.loc)
+		if not self.state_redundant(state):
+			offsets = state.get_variable_offsets(self.loc)
 
-		if not state.has_constraint(var_in_hands):
 			state.clear_hand_constraints()
 
-		state.add_constraint(var_in_hands)
+			for name, offset in offsets:
+				state.set_hands_offset(name, offset)
+
+		state.add_constraint(VariableInHands(self.loc))
 
 		val = state.get_variable_value(self.loc)
 		if val is not None:
 			state.add_constraint(ValueInHands(val))
+		else:
+			state.set_hands_range(state.get_variable_range(self.loc))
 
+	# The variable's value may already be in the hands, either because it
+	# was the last loaded or saved, or because the hands hold the same
+	# value relative to another variable as this variable does.
 	def state_redundant(self, state_before):
-		return state_before.has_constraint(VariableInHands(self.loc))
+		if state_before.has_constraint(VariableInHands(self.loc)):
+			return True
+
+		offsets = state_before.get_variable_offsets(self.loc)
+		return any(offset in offsets
+				for offset in state_before.get_hands_offsets())
 
 	def var_redundant(self):
 		return not self.needs_hands
@@ -153,36 +226,114 @@ class Add(AbstractParameterisedInstruction):
 	mnemonic = "ADD"
 	reads_variable = True
 
+	def var_redundant(self):
+		return not self.needs_hands
+
 	def simulate_state(self, state):
+		hand_val = state.get_value_in_hands()
+		var_val = state.get_variable_value(self.loc)
+		hands_offsets = state.get_hands_offsets()
+
 		state.clear_hand_constraints()
 
+		if hand_val is not None and var_val is not None:
+			result = checked_value(hand_val + var_val)
+			if result is not None:
+				state.add_constraint(ValueInHands(result))
+
+		elif var_val is not None:
+			for name, offset in hands_offsets:
+				state.set_hands_offset(name, offset + var_val)
+
+		elif hand_val is not None:
+			state.set_hands_offset(self.loc, hand_val)
+
 class Subtract(AbstractParameterisedInstruction):
 	mnemonic = "SUB"
 	reads_variable = True
 
+	def var_redundant(self):
+		return not self.needs_hands
+
 	def simulate_state(self, state):
-		state.clear_hand_constraints()
+		minuends = [con.name for con in state.constraints
+				if isinstance(con, VariableInHands)]
 
-class BumpUp(AbstractParameterisedInstruction):
-	mnemonic = "BUMPUP"
-	reads_variable = True
-	writes_hands = True
+		hand_val = state.get_value_in_hands()
+		var_val = state.get_variable_value(self.loc)
+		hands_offsets = state.get_hands_offsets()
+		var_offsets = dict(state.get_variable_offsets(self.loc))
+		var_offsets[self.loc] = 0
 
-	def simulate_state(self, state):
 		state.clear_hand_constraints()
-		state.clear_variable_constraints(self.loc)
-		state.add_constraint(VariableInHands(self.loc))
 
-class BumpDown(AbstractParameterisedInstruction):
-	mnemonic = "BUMPDN"
+		for name in minuends:
+			state.add_constraint(DifferenceInHands(name, self.loc))
+
+		if hand_val is not None and var_val is not None:
+			result = checked_value(hand_val - var_val)
+			if result is not None:
+				state.add_constraint(ValueInHands(result))
+			return
+
+		# If the hands and the variable are both offsets from the
+		# same variable, their difference is the difference in offsets.
+		for name, offset in hands_offsets:
+			if name in var_offsets:
+				state.add_constraint(ValueInHands(offset - var_offsets[name]))
+				return
+
+		if var_val is not None:
+			for name, offset in hands_offsets:
+				state.set_hands_offset(name, offset - var_val)
+
+# Adds a constant to a variable, and loads the result into the hands
+class AbstractBumpInstruction(AbstractParameterisedInstruction):
 	reads_variable = True
+	modifies_variable = True
 	writes_hands = True
 
+	# Amount added to the variable
+	delta = None
+
+	# The variable itself is changed, so may not be replaced by a copy
+	def propagate_copies(self, state):
+		pass
+
 	def simulate_state(self, state):
+		new_range = shift_range(state.get_variable_range(self.loc), self.delta)
+
+		val = state.get_variable_value(self.loc)
+		if val is not None:
+			val = checked_value(val + self.delta)
+
+		# Other variables keep their values, so
+		# this one's offsets from them change.
+		related = state.get_variable_offsets(self.loc)
+
 		state.clear_hand_constraints()
 		state.clear_variable_constraints(self.loc)
 		state.add_constraint(VariableInHands(self.loc))
 
+		if val is not None:
+			state.add_constraint(ValueInHands(val))
+			state.add_constraint(VariableHasValue(self.loc, val))
+		else:
+			state.set_hands_range(new_range)
+			state.set_variable_range(self.loc, new_range)
+
+		for name, offset in related:
+			state.add_constraint(VariableOffset(self.loc, name,
+					offset + self.delta))
+
+class BumpUp(AbstractBumpInstruction):
+	mnemonic = "BUMPUP"
+	delta = 1
+
+class BumpDown(AbstractBumpInstruction):
+	mnemonic = "BUMPDN"
+	delta = -1
+
 # Instruction which represents an action in the code which could not be
 # expanded into correct code at the initial code generation stage.
 # Pseudo instructions may be able to be expanded into correct code
@@ -246,10 +397,36 @@ class Difference(PseudoInstruction):
 		super().__init__()
 		self.left  = left
 		self.right = right
-	
+
+	def get_variables_read(self):
+		return [self.left, self.right]
+
+	def rename_variable(self, old_name, new_name):
+		if self.left == old_name:
+			self.left = new_name
+		if self.right == old_name:
+			self.right = new_name
+
 	def simulate_state(self, state):
+		if self.state_redundant(state):
+			return
+
 		state.clear_hand_constraints()
 
+		if self.right in state.get_equal_variables(self.left):
+			state.add_constraint(ValueInHands(0))
+
+	# The difference is not needed once the jump comparing it is removed
+	def var_redundant(self):
+		return not self.needs_hands
+
+	# Either difference may already be in the hands
+	def state_redundant(self, state_before):
+		return (state_before.has_constraint(
+					DifferenceInHands(self.left, self.right))
+				or state_before.has_constraint(
+					DifferenceInHands(self.right, self.left)))
+
 	def attempt_expand(self, hands):
 		if hands.has_constraint(VariableInHands(self.left)):
 			return [Subtract(self.right)]
@@ -266,6 +443,30 @@ class Difference(PseudoInstruction):
 			+ repr(self.left) + ", "
 			+ repr(self.right) + ")")
 
+# Loads the difference between two variables, left - right, into the hands.
+# This may already be in the hands, if it was calculated for an earlier
+# comparison of the same variables, eg. 'if a < b' followed by 'if a == b'.
+class LoadDifference(Difference):
+	def simulate_state(self, state):
+		if self.state_redundant(state):
+			return
+
+		Load(self.left).simulate_state(state)
+		Subtract(self.right).simulate_state(state)
+
+	def state_redundant(self, state_before):
+		return state_before.has_constraint(
+				DifferenceInHands(self.left, self.right))
+
+	def attempt_expand(self, hands):
+		if hands.has_constraint(VariableInHands(self.left)):
+			return [Subtract(self.right)]
+
+		return [
+			Load(self.left),
+			Subtract(self.right),
+		]
+
 # Block of instructions
 # A block consists of
 #  * a series of linear instructions (non jumps),
@@ -305,9 +506,14 @@ class Block:
 
 		return False
 
-	def to_asm(self):
+	# If line_info is set, blocks containing any instructions start with a
+	# comment giving the line of source they were compiled from, if known.
+	def to_asm(self, line_info=False):
 		lines = []
 
+		if line_info and self.lineno is not None and self.size() > 0:
+			lines.append(f"-- line {self.lineno}")
+
 		if self.label is not None and self.needs_label():
 			lines.append(self.label + ":")
 
@@ -321,9 +527,37 @@ class Block:
 			lines.append(self.next.to_asm())
 
 		return "\n".join(lines)
+
+	# Number of instructions this block will take in the final program
+	def size(self):
+		size = len(self.instructions)
+
+		if self.conditional is not None:
+			size += 1
+
+		if self.next is not None and not self.next.implicit:
+			size += 1
+
+		return size
 	
 	def add_instruction(self, instr):
 		self.instructions.append(instr)
+
+	# Create a copy of this block, with copies of each of its
+	# instructions, and jumps to the same places as this block.
+	# The copy is not jumped to from anywhere.
+	def duplicate(self):
+		dup = Block(self.lineno)
+		dup.instructions = [instr.clone() for instr in self.instructions]
+
+		if self.conditional is not None:
+			dup._assign_conditional(
+					type(self.conditional)(dup, self.conditional.dest))
+
+		if self.next is not None:
+			dup.assign_next(self.next.dest)
+
+		return dup
 	
 	def assign_next(self, next_block):
 		if self.next is not None:
@@ -513,14 +747,29 @@ class JumpZero(AbstractJump):
 	def simulate_state_pass(self, state):
 		state.add_constraint(ValueInHands(0))
 
+		# Any variable held in the hands, or relative to the hands,
+		# must have a known value.
+		for name, offset in state.get_hands_offsets():
+			state.add_constraint(VariableHasValue(name, -offset))
+
 	def simulate_state_fail(self, state):
 		state.add_constraint(ValueNotInHands(0))
 
+		# A range ending at zero may be narrowed to exclude it
+		low, high = state.get_hands_range()
+		if low == 0:
+			state.restrict_hands_range((1, None))
+		elif high == 0:
+			state.restrict_hands_range((None, -1))
+
 	# Check if this jump is guaranteed to fail given the state of the hands
 	def redundant_fails(self, hands):
 		value = hands.get_value_in_hands()
+		low, high = hands.get_hands_range()
 		return ((value is not None and value != 0)
-				or 0 in hands.get_values_not_in_hands())
+				or 0 in hands.get_values_not_in_hands()
+				or (low is not None and low > 0)
+				or (high is not None and high < 0))
 
 	# Check if this jump is guaranteed to pass given the state of the hands
 	def redundant_passes(self, hands):
@@ -530,15 +779,23 @@ class JumpNegative(AbstractJump):
 	def to_asm(self):
 		return "JUMPN " + self.dest.label
 
+	def simulate_state_pass(self, state):
+		state.restrict_hands_range((None, -1))
+
+	# Letters are not negative either, but
+	# a range with no upper bound may include them
+	def simulate_state_fail(self, state):
+		state.restrict_hands_range((0, None))
+
 	# Check if this jump is guaranteed to fail given the state of the hands
 	def redundant_fails(self, hands):
-		value = hands.get_value_in_hands()
-		return value is not None and value >= 0
+		low, _ = hands.get_hands_range()
+		return low is not None and low >= 0
 
 	# Check if this jump is guaranteed to pass given the state of the hands
 	def redundant_passes(self, hands):
-		value = hands.get_value_in_hands()
-		return value is not None and value < 0
+		_, high = hands.get_hands_range()
+		return high is not None and high < 0
 
 # Pseudo blocks used to represent the multiple blocks involved
 # in control flow statements such as 'forever', or 'if'
@@ -547,7 +804,9 @@ class CompoundBlock:
 		# Entry point into this block
 		"first_block",
 
-		# Set of exit points out of this block
+		# Exit points out of this block, without duplicates.
+		# Kept in a list, rather than a set, so that jumps out of
+		# the block are always assigned in the same order.
 		"exit_points",
 	]
 
@@ -555,9 +814,9 @@ class CompoundBlock:
 		self.first_block = first_block
 
 		if exit_points is None:
-			self.exit_points = set()
+			self.exit_points = []
 		else:
-			self.exit_points = set(exit_points)
+			self.exit_points = [*dict.fromkeys(exit_points)]
 
 	def add_instruction(self, instr):
 		raise TypeError("Cannot add instruction directly to a Compound Block")
@@ -605,6 +864,14 @@ class AbstractStateConstraint:
 	def __hash__(self):
 		return hash(self.CONSTRAINT_ID)
 
+	# Names of the variables whose values this constraint depends on
+	def get_variable_names(self):
+		return ()
+
+	# Check if this constraint depends on the value of the given variable
+	def refers_to(self, name):
+		return name in self.get_variable_names()
+
 # The processor has nothing in their hands
 class EmptyHands(AbstractStateConstraint):
 	CONSTRAINT_ID = 0
@@ -614,6 +881,15 @@ class EmptyHands(AbstractStateConstraint):
 	def __repr__(self):
 		return type(self).__name__ + "()"
 
+# The processor is holding some value, though which is unknown
+class HandsAssigned(AbstractStateConstraint):
+	CONSTRAINT_ID = 11
+
+	constrains_hands = True
+
+	def __repr__(self):
+		return type(self).__name__ + "()"
+
 # The processor is holding a value which matches the value of a variable
 class VariableInHands(AbstractStateConstraint):
 	CONSTRAINT_ID = 1
@@ -636,6 +912,9 @@ class VariableInHands(AbstractStateConstraint):
 	def __hash__(self):
 		return hash((self.CONSTRAINT_ID, self.name))
 
+	def get_variable_names(self):
+		return (self.name,)
+
 	def __repr__(self):
 		return type(self).__name__ + "(" + repr(self.name) + ")"
 
@@ -691,28 +970,327 @@ class VariableHasValue(AbstractStateConstraint):
 	def __hash__(self):
 		return hash((self.CONSTRAINT_ID, self.name, self.value))
 
+	def get_variable_names(self):
+		return (self.name,)
+
 	def __repr__(self):
 		return (type(self).__name__ + "("
 				+ repr(self.name) + ", "
 				+ repr(self.value) + ")")
 
+# The processor is holding the value of one variable minus another
+class DifferenceInHands(AbstractStateConstraint):
+	CONSTRAINT_ID = 5
+
+	constrains_hands = True
+	constrains_variable = True
+
+	__slots__ = [
+		"left",
+		"right",
+	]
+
+	def __init__(self, left, right):
+		self.left = left
+		self.right = right
+
+	def __eq__(self, other):
+		super_result = super().__eq__(other)
+		if super_result != True:
+			return super_result
+
+		return self.left == other.left and self.right == other.right
+
+	def __hash__(self):
+		return hash((self.CONSTRAINT_ID, self.left, self.right))
+
+	def get_variable_names(self):
+		return (self.left, self.right)
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+				+ repr(self.left) + ", "
+				+ repr(self.right) + ")")
+
+# The processor is holding a variable's value plus a non-zero constant offset.
+# Where the offset is zero, VariableInHands is used instead.
+class VariableOffsetInHands(AbstractStateConstraint):
+	CONSTRAINT_ID = 8
+
+	constrains_hands = True
+	constrains_variable = True
+
+	__slots__ = [
+		"name",
+		"offset",
+	]
+
+	def __init__(self, name, offset):
+		self.name = name
+		self.offset = offset
+
+	def __eq__(self, other):
+		super_result = super().__eq__(other)
+		if super_result != True:
+			return super_result
+
+		return self.name == other.name and self.offset == other.offset
+
+	def __hash__(self):
+		return hash((self.CONSTRAINT_ID, self.name, self.offset))
+
+	def get_variable_names(self):
+		return (self.name,)
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+				+ repr(self.name) + ", "
+				+ repr(self.offset) + ")")
+
+# One variable holds the value of another plus a constant offset,
+# which may be zero if the two variables are equal.
+class VariableOffset(AbstractStateConstraint):
+	CONSTRAINT_ID = 9
+
+	constrains_variable = True
+
+	__slots__ = [
+		"name",
+		"base",
+		"offset",
+	]
+
+	def __init__(self, name, base, offset):
+		self.name = name
+		self.base = base
+		self.offset = offset
+
+	def __eq__(self, other):
+		super_result = super().__eq__(other)
+		if super_result != True:
+			return super_result
+
+		return (self.name == other.name and self.base == other.base
+				and self.offset == other.offset)
+
+	def __hash__(self):
+		return hash((self.CONSTRAINT_ID, self.name, self.base, self.offset))
+
+	def get_variable_names(self):
+		return (self.name, self.base)
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+				+ repr(self.name) + ", "
+				+ repr(self.base) + ", "
+				+ repr(self.offset) + ")")
+
+# A variable has been given some value, though which value may be unknown.
+# A variable never becomes unassigned, so this isn't cleared when its value
+# changes.
+class VariableAssigned(AbstractStateConstraint):
+	CONSTRAINT_ID = 10
+
+	__slots__ = ["name"]
+
+	def __init__(self, name):
+		self.name = name
+
+	def __eq__(self, other):
+		super_result = super().__eq__(other)
+		if super_result != True:
+			return super_result
+
+		return self.name == other.name
+
+	def __hash__(self):
+		return hash((self.CONSTRAINT_ID, self.name))
+
+	def get_variable_names(self):
+		return (self.name,)
+
+	def __repr__(self):
+		return type(self).__name__ + "(" + repr(self.name) + ")"
+
+# Bounds of a range of values which are tracked with a constraint
+class AbstractRangeConstraint(AbstractStateConstraint):
+	__slots__ = [
+		# Lowest and highest values which may be held, inclusive.
+		# Either may be None, if the range is unbounded on that side.
+		"low",
+		"high",
+	]
+
+	def __init__(self, low, high):
+		self.low = low
+		self.high = high
+
+	def get_range(self):
+		return (self.low, self.high)
+
+	def __eq__(self, other):
+		super_result = super().__eq__(other)
+		if super_result != True:
+			return super_result
+
+		return self.low == other.low and self.high == other.high
+
+	def __hash__(self):
+		return hash((self.CONSTRAINT_ID, self.low, self.high))
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+				+ repr(self.low) + ", "
+				+ repr(self.high) + ")")
+
+# The processor is holding a value within a range.
+# Letters pass neither JUMPN nor JUMPZ, so behave like positive numbers,
+# and may be held if the range has no upper bound.
+class HandsInRange(AbstractRangeConstraint):
+	CONSTRAINT_ID = 6
+	constrains_hands = True
+
+# A variable holds a value within a range, as for HandsInRange
+class VariableInRange(AbstractRangeConstraint):
+	CONSTRAINT_ID = 7
+	constrains_variable = True
+
+	__slots__ = ["name"]
+
+	def __init__(self, name, low, high):
+		super().__init__(low, high)
+		self.name = name
+
+	def __eq__(self, other):
+		super_result = super().__eq__(other)
+		if super_result != True:
+			return super_result
+
+		return self.name == other.name
+
+	def __hash__(self):
+		return hash((self.CONSTRAINT_ID, self.name, self.low, self.high))
+
+	def get_variable_names(self):
+		return (self.name,)
+
+	def __repr__(self):
+		return (type(self).__name__ + "("
+				+ repr(self.name) + ", "
+				+ repr(self.low) + ", "
+				+ repr(self.high) + ")")
+
+UNBOUNDED_RANGE = (None, None)
+
+# Bounds which ranges are widened to when states from different paths are
+# merged. Widening, rather than keeping the exact bounds from each path, means
+# ranges in loops settle quickly, eg. rather than growing by one for each
+# BUMPUP, while still keeping the sign of a value.
+RANGE_WIDENING_BOUNDS = (-1, 0, 1)
+
+# Find the range of values within both of two ranges
+def intersect_ranges(a, b):
+	lows  = [low  for low,  _    in (a, b) if low  is not None]
+	highs = [high for _,    high in (a, b) if high is not None]
+
+	return (max(lows)  if len(lows)  > 0 else None,
+			min(highs) if len(highs) > 0 else None)
+
+# Find a range covering both of two ranges,
+# widening any bounds which differ between them.
+def merge_ranges(a, b):
+	(a_low, a_high), (b_low, b_high) = a, b
+
+	if a_low == b_low:
+		low = a_low
+	elif a_low is None or b_low is None:
+		low = None
+	else:
+		low = max((bound for bound in RANGE_WIDENING_BOUNDS
+				if bound <= min(a_low, b_low)), default=None)
+
+	if a_high == b_high:
+		high = a_high
+	elif a_high is None or b_high is None:
+		high = None
+	else:
+		high = min((bound for bound in RANGE_WIDENING_BOUNDS
+				if bound >= max(a_high, b_high)), default=None)
+
+	return (low, high)
+
+# Add a constant to each bound of a range
+def shift_range(rng, offset):
+	return tuple(None if bound is None else bound + offset for bound in rng)
+
 # Holds a set of zero or more constraints about the processor's
 # hands at a particular point in execution
 class OfficeState:
+	# The constraints are held in a dict used as an insertion-ordered set,
+	# so that queries which may match several constraints always return the
+	# same one, regardless of the hash seed.
 	__slots__ = ["constraints"]
 
 	def __init__(self, constraints=[]):
-		self.constraints = set(constraints)
+		self.constraints = dict.fromkeys(constraints)
 
 	# Return only constraints which are guaranteed to be true in both the self and other cases
 	def worst_case(self, other):
-		return OfficeState(self.constraints & other.constraints)
+		state = OfficeState(con for con in self.constraints
+				if con in other.constraints)
+
+		# Variables are equal where they are in the same class in both states.
+		# Each class is stored as copies of the variable this state would
+		# load in place of the others, so that merging a state with one
+		# which implies it leaves it unchanged.
+		groups = []
+		grouped = set()
+		for con in self.constraints:
+			if not isinstance(con, VariableOffset) or con.offset != 0:
+				continue
+
+			if con.name in grouped:
+				continue
+
+			# Split the class by the classes in the other state
+			source = self.get_variable_source(con.name)
+			remaining = [*self.get_equal_variables(source)]
+			grouped.update(remaining)
+
+			while len(remaining) > 0:
+				other_equal = other.get_equal_variables(remaining[0])
+				group = [name for name in remaining if name in other_equal]
+				remaining = [name for name in remaining
+						if name not in other_equal]
+
+				if len(group) > 1:
+					groups.append(group)
+
+		state.set_equal_variables(groups)
+
+		# Ranges which differ between the two states are merged, rather than
+		# dropped. This includes ranges of a single value, so that, eg. a
+		# variable known to be 0 on one path, and 1 on another, is known to
+		# be non-negative on both.
+		if state.get_value_in_hands() is None:
+			state.set_hands_range(merge_ranges(self.get_hands_range(),
+					other.get_hands_range()))
+
+		names = [con.name for con in self.constraints
+				if isinstance(con, (VariableHasValue, VariableInRange))]
+		for name in dict.fromkeys(names):
+			if state.get_variable_value(name) is None:
+				state.set_variable_range(name, merge_ranges(
+						self.get_variable_range(name),
+						other.get_variable_range(name)))
+
+		return state
 
 	def has_constraint(self, cons):
 		return cons in self.constraints
 
 	def add_constraint(self, cons):
-		self.constraints.add(cons)
+		self.constraints[cons] = None
 
 	def clear_constraints(self):
 		self.constraints.clear()
@@ -721,13 +1299,27 @@ class OfficeState:
 		constraints_to_remove = [con for con in self.constraints
 				if con.constrains_hands]
 		for con in constraints_to_remove:
-			self.constraints.remove(con)
+			del self.constraints[con]
 
 	def clear_variable_constraints(self, name):
 		constraints_to_remove = [con for con in self.constraints
-				if con.constrains_variable and con.name == name]
+				if con.constrains_variable and con.refers_to(name)]
 		for con in constraints_to_remove:
-			self.constraints.remove(con)
+			del self.constraints[con]
+
+	# Check if the processor is known to be holding some value, even if
+	# which value is unknown. Every constraint on the hands other than
+	# EmptyHands is only ever added where they hold a value.
+	def hands_hold_value(self):
+		return any(con.constrains_hands and not isinstance(con, EmptyHands)
+				for con in self.constraints)
+
+	# Fetch a list of the variables known to hold some value,
+	# even if which value is unknown.
+	def get_assigned_variables(self):
+		names = [name for con in self.constraints
+				for name in con.get_variable_names()]
+		return [*dict.fromkeys(names)]
 
 	# Fetch the name of a variable which is already in the processor's hands, or
 	# None if the hands do not match a variable.
@@ -745,8 +1337,97 @@ class OfficeState:
 			if isinstance(constraint, ValueInHands):
 				return constraint.value
 
+		# The value may be relative to a variable with a known value
+		for name, offset in self.get_hands_offsets():
+			value = self._get_direct_variable_value(name)
+			if value is not None:
+				return value + offset
+
 		return None
 
+	# Fetch a list of tuples of (variable name, offset) for each variable
+	# the value in the hands is known to be relative to.
+	def get_hands_offsets(self):
+		offsets = []
+		for con in self.constraints:
+			if isinstance(con, VariableInHands):
+				offsets.append((con.name, 0))
+			elif isinstance(con, VariableOffsetInHands):
+				offsets.append((con.name, con.offset))
+
+		return offsets
+
+	# Record that the hands hold a variable's value plus an offset
+	def set_hands_offset(self, name, offset):
+		if offset == 0:
+			self.add_constraint(VariableInHands(name))
+		else:
+			self.add_constraint(VariableOffsetInHands(name, offset))
+
+	# Fetch a list of tuples of (variable name, offset) for each
+	# other variable the given variable is known to be relative to,
+	# such that the given variable = other variable + offset.
+	def get_variable_offsets(self, name):
+		equal = self.get_equal_variables(name)
+		offsets = {other: 0 for other in equal if other != name}
+
+		for con in self.constraints:
+			if not isinstance(con, VariableOffset) or con.offset == 0:
+				continue
+
+			if con.name in equal:
+				offsets.setdefault(con.base, con.offset)
+			elif con.base in equal:
+				offsets.setdefault(con.name, -con.offset)
+
+		return [*offsets.items()]
+
+	# Fetch the set of variables known to hold the same value as the given
+	# variable, including itself. Equalities are followed transitively, so
+	# that if a = b and b = c, then a = c.
+	def get_equal_variables(self, name):
+		equal = {name: None}
+		to_check = [name]
+		while len(to_check) > 0:
+			var = to_check.pop()
+			for con in self.constraints:
+				if not isinstance(con, VariableOffset) or con.offset != 0:
+					continue
+
+				for a, b in [(con.name, con.base), (con.base, con.name)]:
+					if a == var and b not in equal:
+						equal[b] = None
+						to_check.append(b)
+
+		return equal.keys()
+
+	# Find the variable which the given variable's value was first copied
+	# from, or the variable itself if it is not known to be a copy.
+	def get_variable_source(self, name):
+		seen = {name}
+		while True:
+			for con in self.constraints:
+				if (isinstance(con, VariableOffset) and con.offset == 0
+						and con.name == name and con.base not in seen):
+					name = con.base
+					seen.add(name)
+					break
+			else:
+				return name
+
+	# Replace the equalities between variables with only those which hold in
+	# both this state and another, given as a list of groups of variables.
+	# Each group is recorded as copies of a single variable.
+	def set_equal_variables(self, groups):
+		for con in [*self.constraints]:
+			if isinstance(con, VariableOffset) and con.offset == 0:
+				del self.constraints[con]
+
+		for group in groups:
+			source = group[0]
+			for name in group[1:]:
+				self.add_constraint(VariableOffset(name, source, 0))
+
 	# Fetch a set of values guaranteed not to be in hands.
 	# Note that this does not include values excluded by a ValueInHands
 	# constraint, only those excluded by ValueNotInHands constraints.
@@ -759,8 +1440,75 @@ class OfficeState:
 
 		return excluded_values
 
+	# Fetch a tuple of the lowest and highest values which may be in the
+	# hands. Either may be None, if the value is not bounded on that side.
+	def get_hands_range(self):
+		value = self.get_value_in_hands()
+		if value is not None:
+			return (value, value)
+
+		for con in self.constraints:
+			if isinstance(con, HandsInRange):
+				return con.get_range()
+
+		return UNBOUNDED_RANGE
+
+	# Replace the range of values which may be in the hands
+	def set_hands_range(self, rng):
+		for con in [*self.constraints]:
+			if isinstance(con, HandsInRange):
+				del self.constraints[con]
+
+		if rng != UNBOUNDED_RANGE:
+			self.add_constraint(HandsInRange(*rng))
+
+	# Narrow the range of values which may be in the hands, along
+	# with that of any variable known to hold the same value.
+	def restrict_hands_range(self, rng):
+		self.set_hands_range(intersect_ranges(self.get_hands_range(), rng))
+
+		for con in [*self.constraints]:
+			if isinstance(con, VariableInHands):
+				self.set_variable_range(con.name, intersect_ranges(
+						self.get_variable_range(con.name), rng))
+
+	# Fetch the range of values the given variable may hold,
+	# as for get_hands_range.
+	def get_variable_range(self, name):
+		value = self.get_variable_value(name)
+		if value is not None:
+			return (value, value)
+
+		for con in self.constraints:
+			if isinstance(con, VariableInRange) and con.name == name:
+				return con.get_range()
+
+		return UNBOUNDED_RANGE
+
+	# Replace the range of values which the given variable may hold
+	def set_variable_range(self, name, rng):
+		for con in [*self.constraints]:
+			if isinstance(con, VariableInRange) and con.name == name:
+				del self.constraints[con]
+
+		if rng != UNBOUNDED_RANGE:
+			self.add_constraint(VariableInRange(name, *rng))
+
 	# Fetch the value of the given variable or None if not known.
 	def get_variable_value(self, name):
+		value = self._get_direct_variable_value(name)
+		if value is not None:
+			return value
+
+		# The value may be relative to another variable with a known value
+		for base, offset in self.get_variable_offsets(name):
+			value = self._get_direct_variable_value(base)
+			if value is not None:
+				return value + offset
+
+		return None
+
+	def _get_direct_variable_value(self, name):
 		for con in self.constraints:
 			if isinstance(con, VariableHasValue) and con.name == name:
 				return con.value
@@ -776,6 +1524,11 @@ class OfficeState:
 			if isinstance(con, VariableHasValue) and con.value == value:
 				return con.name
 
+		for con in self.constraints:
+			if (isinstance(con, VariableOffset)
+					and self.get_variable_value(con.name) == value):
+				return con.name
+
 		return None
 
 	def clone(self):
@@ -785,8 +1538,8 @@ class OfficeState:
 		if not isinstance(other, OfficeState):
 			return NotImplemented
 
-		return self.constraints == other.constraints
+		return self.constraints.keys() == other.constraints.keys()
 
 	def __repr__(self):
 		return (type(self).__name__ + "("
-				+ repr(self.constraints) + ")")
+				+ repr([*self.constraints]) + ")")
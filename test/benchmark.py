@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+# === Benchmarks ===
+#
+# Compiles programs and reports the two metrics HRM scores solutions on: size,
+# the number of instructions in the program, and speed, the total number of
+# steps taken to run the program on each of its inboxes. Also reports the
+# average number of unconditional JUMPs run for each item in the inboxes.
+#
+# Run from the root of the repository, eg.
+#	test/benchmark.py solutions
+#	test/benchmark.py mul-neg --baseline /path/to/older/checkout
+#	test/benchmark.py solutions -O size -O speed
+#	test/benchmark.py solutions -- <extra compiler arguments>
+
+import os
+import sys
+import subprocess
+import tempfile
+from dataclasses import dataclass, field
+
+import hrm
+from common_test import TEST_SOURCE_DIR
+
+@dataclass
+class Benchmark:
+	name: str
+
+	# Either the path to a source file, relative to TEST_SOURCE_DIR,
+	# or the text of the program itself.
+	source: str
+
+	inboxes: list
+
+	initial_memory: list = field(default_factory=lambda: [None] * 16)
+
+	# Optional function producing the expected outbox for an inbox
+	expected: object = None
+
+	def get_source_path(self, tmp_dir):
+		if self.source.endswith(".hc"):
+			return os.path.join(TEST_SOURCE_DIR, self.source)
+
+		path = os.path.join(tmp_dir, self.name + ".hc")
+		with open(path, "w") as f:
+			f.write(self.source)
+
+		return path
+
+# Result of running a single benchmark
+@dataclass
+class Result:
+	size: int = None
+	steps: int = None
+	jumps_per_item: float = None
+	error: str = None
+
+	def __str__(self):
+		if self.error is not None:
+			return self.error
+
+		return f"{self.size:9} {self.steps:10} {self.jumps_per_item:7.2f}"
+
+def solution(name, inboxes, initial_memory=None):
+	if initial_memory is None:
+		initial_memory = [None] * 10
+
+	return Benchmark(name, f"solutions/{name}.hc", inboxes, initial_memory)
+
+SUITES = {
+	"solutions": [
+		solution("y1-mail-room", [[1, 2, 3], [4, 8, 15], [16, 23, 42]]),
+		solution("y2-busy-mail-room", [[*"BOOTSEQUENCE"], [*"AUTOEXEC"]]),
+		solution("y3-copy-floor", [[]], ["U", "J", "X", "G", "B", "E"]),
+		solution("y4-scrambler-handler", [
+			[1, 9, "P", "G", 2, 8],
+			[4, 9, "K", "X", 1, 8],
+		]),
+		solution("y6-rainy-summer", [
+			[2, 2, 4, 0, -6, 9, 9, -5],
+			[8, 0, 1, 4, -4, 1, 0, -7],
+		]),
+		solution("y7-zero-exterminator", [
+			[8, 0, -1, "F", 0, 0,  3, 0],
+			[5, 0,  2, "E", 0, 0, -2, 0],
+		]),
+		solution("y8-tripler-room", [[6, -6, 3, 0], [6, -1, 7, 0]]),
+		solution("y9-zero-preservation-initiative", [
+			[8, 0, -1, "F", 0, 0,  3, 0],
+			[5, 0,  2, "E", 0, 0, -2, 0],
+		]),
+		solution("y10-octoplier-suite", [[3, -2, 6, 0], [5, -2, 6, 0]]),
+		solution("y11-sub-hallway", [
+			[3, 8, 7, 4, -8, -8, 4, -8],
+			[3, 6, 6, 3, -8, -8, 3, -8],
+		]),
+		solution("y12-tetracontiplier", [[3, -7, 5, 0], [5, -2, 7, 0]]),
+		solution("y13-equalization-room", [
+			[4, 6, 6, 6,  6,  5, -7, -7],
+			[3, 3, 8, 8,  2, -2, -5, -5],
+		]),
+		solution("y14-maximization-room", [
+			[7, 7, -8, -9, 8, 8,  0,  8],
+			[3, 6, -4, -4, 9, 9, -6, -2],
+		]),
+		solution("y16-absolute-positivity", [
+			[4, -3,  6, 0, -8,  7, 1],
+			[1, -2, -9, 0, -9,  5, 9],
+		]),
+		solution("y17-exclusive-lounge", [
+			[-6,  1, -8,  2, -1,  5,  1, -4],
+			[ 7, -5, -1, -1,  7, -2,  1,  7],
+		], [None, None, None, None, 0, 1]),
+		solution("y19-countdown", [[8, -6, 0,  1], [4, -8, 0,  3]]),
+		solution("y20-multiplication-workshop", [
+			[7, 3, 7, 3, 8, 0, 0, 6, 7, 6],
+			[6, 4, 7, 9, 5, 0, 0, 1, 7, 7],
+		], [None] * 9 + [0]),
+	],
+
+	# Multiplication by negative constants, compared against
+	# multiplying by the positive constant then negating the result
+	"mul-neg": [
+		Benchmark(f"mul-{name}-{k}",
+			"forever\n"
+			f"\toutput {expr}\n",
+			[[3, -5, 0, 7, -1, 12]],
+			expected=lambda inbox, k=k: [x * -k for x in inbox])
+		for k in [1, 2, 3, 7, 10, 40]
+		for name, expr in [
+			("neg", f"input * -{k}"),
+			("negated", f"0 - input * {k}"),
+		]
+	],
+
+	# Multiplication of two values read at runtime, as in year 20
+	"mul-runtime": [
+		Benchmark(f"mul-runtime-{name}",
+			"init 0 @ 15\n"
+			"forever\n"
+			"\toutput input * input\n",
+			inboxes, [None] * 15 + [0],
+			expected=lambda inbox: [a * b
+				for a, b in zip(inbox[::2], inbox[1::2])])
+		for name, inboxes in [
+			("small", [
+				[7, 3, 7, 3, 8, 0, 0, 6, 7, 6],
+				[6, 4, 7, 9, 5, 0, 0, 1, 7, 7],
+			]),
+			("hundreds", [
+				[250, 3, 7, 120, 999, 1, 12, 80, 9, 111],
+				[4, 200, 333, 3, 19, 50, 141, 7, 2, 499],
+			]),
+			("large", [
+				[31, 31, 24, 41, 17, 58, 30, 29, 22, 45],
+				[13, 76, 27, 36, 19, 52, 25, 39, 31, 32],
+			]),
+			("signed", [
+				[-7, 3, 7, -3, -8, -9, 0, -6, 25, -30],
+				[-120, 4, 6, -111, -19, -50, 14, 70, -2, -499],
+			]),
+		]
+	],
+
+	# Loops, some of which may be rotated to test their condition at the end
+	"loops": [
+		solution("y19-countdown", [[8, -6, 0,  1], [4, -8, 0,  3]]),
+		Benchmark("count-up",
+			"forever\n"
+			"\tx = input\n"
+			"\twhile x < 0\n"
+			"\t\toutput x\n"
+			"\t\t++x\n",
+			[[-8, 0, -3, -20, 5, -1]],
+			expected=lambda inbox: [y for x in inbox for y in range(x, 0)]),
+		Benchmark("count-to-double",
+			"forever\n"
+			"\tlimit = input\n"
+			"\tx = 0\n"
+			"\twhile x < limit * 2 - 1\n"
+			"\t\toutput x\n"
+			"\t\tx += 1\n",
+			[[3, 0, 5, -2, 1]],
+			[None] * 15 + [0],
+			expected=lambda inbox: [y for x in inbox
+				for y in range(x * 2 - 1)]),
+		Benchmark("mul-runtime-loop",
+			"init 0 @ 15\n"
+			"forever\n"
+			"\toutput input * input\n",
+			[[7, 3, 7, 3, 8, 0, 0, 6, 7, 6, 6, 4, 7, 9, 5, 0, 0, 1, 7, 7]],
+			[None] * 15 + [0],
+			expected=lambda inbox: [a * b
+				for a, b in zip(inbox[::2], inbox[1::2])]),
+	],
+
+	# Addition and subtraction of constants, which may be made by bumping
+	# the value, or by building the constant in a tile and adding that
+	"add-const": [
+		Benchmark(f"add-const-{name}",
+			"forever\n"
+			f"\toutput input {op} {k}\n",
+			[[0, 7, -42, 300, -500, 600]],
+			expected=lambda inbox, op=op, k=k: [x + k if op == "+" else x - k
+				for x in inbox])
+		for name, op, k in [
+			("3", "+", 3),
+			("minus-5", "-", 5),
+			("50", "+", 50),
+			("minus-200", "-", 200),
+			("negative-60", "+", -60),
+		]
+	],
+
+	# Division, compared against a hand-written repeated subtraction loop
+	"div": [
+		*(Benchmark(f"div-const-{k}",
+			"forever\n"
+			f"\toutput input / {k}\n",
+			[[0, 7, 42, 99, 100, 365, 512, 999]],
+			expected=lambda inbox, k=k: [x // k for x in inbox])
+		for k in [3, 10, 100]),
+		Benchmark("div-loop-10",
+			"init ten = 10 @ 15\n"
+			"forever\n"
+			"\tx = input\n"
+			"\tq = ten - ten\n"
+			"\twhile x >= ten\n"
+			"\t\tx -= ten\n"
+			"\t\t++q\n"
+			"\toutput q\n",
+			[[0, 7, 42, 99, 100, 365, 512, 999]],
+			[None] * 15 + [10],
+			expected=lambda inbox: [x // 10 for x in inbox]),
+		Benchmark("mod-const-10",
+			"forever\n"
+			"\toutput input % 10\n",
+			[[0, 7, 42, 99, 100, 365, 512, 999]],
+			expected=lambda inbox: [x % 10 for x in inbox]),
+		Benchmark("divmod-const-10",
+			"forever\n"
+			"\tx = input\n"
+			"\toutput x / 10\n"
+			"\toutput x % 10\n",
+			[[0, 7, 42, 99, 100, 365, 512, 999]],
+			expected=lambda inbox: [result for x in inbox
+				for result in (x // 10, x % 10)]),
+		Benchmark("div-runtime",
+			"forever\n"
+			"\toutput input / input\n",
+			[[999, 3, 512, 2, 365, 7, 42, 6, 99, 100, 7, 999]],
+			expected=lambda inbox: [a // b
+				for a, b in zip(inbox[::2], inbox[1::2])]),
+		Benchmark("div-runtime-signed",
+			"forever\n"
+			"\toutput input / input\n",
+			[[-999, 3, 512, -2, -365, -7, 42, 6, -99, 100, 7, -999]],
+			expected=lambda inbox: [a // b
+				for a, b in zip(inbox[::2], inbox[1::2])]),
+	],
+}
+
+def run_benchmark(bench, compiler_dir, compiler_args, tmp_dir):
+	src_path = bench.get_source_path(tmp_dir)
+	exe_path = os.path.join(tmp_dir, bench.name + ".hrm")
+
+	with open(exe_path, "w") as exe:
+		process = subprocess.run(
+				[os.path.join(compiler_dir, "hccompile.py"),
+					*compiler_args, os.path.abspath(src_path)],
+				cwd=compiler_dir, stdout=exe, stderr=subprocess.PIPE)
+
+	if process.returncode != 0:
+		return Result(error="compile error")
+
+	office = hrm.load_program(exe_path, bench.initial_memory)
+	result = Result(size=len(office.program), steps=0)
+
+	jumps = 0
+	items = 0
+	for inbox in bench.inboxes:
+		run = office.clone()
+		outbox = []
+		run.inbox = iter(inbox)
+		run.outbox = hrm.list_outbox(outbox)
+		run.count_executions()
+
+		try:
+			run.execute()
+		except hrm.BossError:
+			return Result(error="boss error")
+
+		if bench.expected is not None and outbox != bench.expected(inbox):
+			return Result(error="wrong outbox")
+
+		result.steps += run.steps
+		jumps += sum(count for instr, count
+				in zip(run.program, run.executions)
+				if isinstance(instr, hrm.Jump))
+		items += len(inbox)
+
+	result.jumps_per_item = jumps / max(items, 1)
+	return result
+
+def main():
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Benchmark compiled programs")
+	parser.add_argument("suites", nargs="*", default=["solutions"],
+			choices=[*SUITES], metavar="suite",
+			help="Suites to run: " + ", ".join(SUITES))
+	parser.add_argument("--baseline", default=None,
+			help="Directory of another checkout of the compiler "
+				"to compare results against")
+	parser.add_argument("-O", "--goal", dest="goals", action="append",
+			default=[],
+			help="Compile with the given optimisation goal. May be given "
+				"more than once to compare goals. Not passed to the baseline.")
+	parser.usage = parser.format_usage()[7:].rstrip() + " [-- compiler args]"
+
+	# Anything after '--' is passed to the compiler
+	argv = sys.argv[1:]
+	compiler_args = []
+	if "--" in argv:
+		split = argv.index("--")
+		argv, compiler_args = argv[:split], argv[split + 1:]
+
+	args = parser.parse_args(argv)
+
+	# Tuples of (column label, compiler directory, compiler arguments)
+	compilers = [("", os.getcwd(), compiler_args)]
+	if len(args.goals) > 0:
+		compilers = [(f"O{goal} ", os.getcwd(), ["-O", goal, *compiler_args])
+				for goal in args.goals]
+	if args.baseline is not None:
+		compilers.insert(0, ("base ", os.path.abspath(args.baseline),
+				compiler_args))
+
+	header = f"{'benchmark':32}"
+	for label, _, _ in compilers:
+		header += (f" {label + 'size':>9} {label + 'steps':>10}"
+				f" {label + 'jumps':>7}")
+	print(header)
+
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		for suite in args.suites:
+			for bench in SUITES[suite]:
+				line = f"{bench.name:32}"
+				for _, compiler_dir, extra_args in compilers:
+					result = run_benchmark(bench, compiler_dir, extra_args,
+							tmp_dir)
+					line += f" {str(result):>28}"
+
+				print(line, flush=True)
+
+if __name__ == "__main__":
+	main()
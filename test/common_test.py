@@ -5,6 +5,7 @@ import os
 import sys
 import subprocess
 import re
+import tempfile
 
 import hrm
 
@@ -16,6 +17,9 @@ class AbstractTests:
 		# source_path    - Location of source file
 		# exec_path      - Location to save compiled file
 		# initial_memory - Initial floor state
+		# compiler_args  - Extra arguments to pass to the compiler
+
+		compiler_args = []
 
 		@classmethod
 		def get_src(cls):
@@ -38,7 +42,8 @@ class AbstractTests:
 			with open(cls.get_exe(), "w") as exe:
 				try:
 					process = subprocess.run(
-							["./hccompile.py", cls.get_src()],
+							["./hccompile.py", *cls.compiler_args,
+								cls.get_src()],
 							check=True, stderr=subprocess.PIPE,
 							stdout=exe)
 				except subprocess.CalledProcessError as e:
@@ -81,8 +86,27 @@ class AbstractTests:
 			# Fallback for missed inconsistencies
 			self.assertEqual(expected, actual)
 
-		def run_program(self, inbox, expected_outbox):
-			office = self.office.clone()
+		# Compile the source file again with other compiler arguments, and
+		# return an office holding the program, with the same initial floor
+		@classmethod
+		def compile_variant(cls, *compiler_args):
+			with tempfile.TemporaryDirectory() as tmp_dir:
+				exe_path = os.path.join(tmp_dir, "variant.hrm")
+				with open(exe_path, "w") as exe:
+					subprocess.run(
+							["./hccompile.py", *compiler_args, cls.get_src()],
+							check=True, stdout=exe)
+
+				return hrm.load_program(exe_path, [*cls.office.floor])
+
+		# Run the program on the given inbox, checking its output. Runs the
+		# given office if any, otherwise the compiled program. Returns the
+		# office after running, to check the number of steps taken.
+		def run_program(self, inbox, expected_outbox, office=None):
+			if office is None:
+				office = self.office
+
+			office = office.clone()
 			outbox = []
 
 			office.inbox = iter(inbox)
@@ -94,6 +118,8 @@ class AbstractTests:
 
 			self.assert_outbox(expected_outbox, outbox)
 
+			return office
+
 		# Run a series of test cases on the compiled program
 		# test_cases should be an iterable of tuples of (inbox, expected_outbox)
 		def run_tests(self, test_cases):
@@ -160,9 +186,11 @@ class AbstractTests:
 	class TestError(unittest.TestCase):
 		# Check that the given file throws the specified error.
 		# Checks that the expected error is in the stderr output.
-		def assertError(self, src_path, expected_error, msg=None):
+		# compiler_args may give extra arguments to pass to the compiler.
+		def assertError(self, src_path, expected_error, msg=None,
+				compiler_args=()):
 			process = subprocess.run([
-						"./hccompile.py",
+						"./hccompile.py", *compiler_args,
 						os.path.join(TEST_SOURCE_DIR, src_path)],
 					capture_output=True)
 
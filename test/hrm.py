@@ -210,6 +210,21 @@ class Office:
 
 		# Id of next instruction
 		"program_counter",
+
+		# Number of instructions executed so far
+		"steps",
+
+		# Optional list of the number of times each instruction has been
+		# executed, or None if not being counted
+		"executions",
+
+		# Optional list of the number of times each jump instruction
+		# has jumped, or None if not being counted
+		"jumps_taken",
+
+		# List of the source line each instruction was compiled from, as
+		# given by '-- line N' comments in the program, or None if unknown
+		"source_lines",
 	]
 
 	def __init__(self, program, labels, floor=None):
@@ -222,16 +237,34 @@ class Office:
 		self.hands = None
 		self.floor = floor if floor is not None else []
 		self.program_counter = 0
+		self.steps = 0
+		self.executions = None
+		self.jumps_taken = None
+		self.source_lines = [None] * len(program)
+
+	# Start counting the number of times each instruction
+	# is executed, and each jump is taken
+	def count_executions(self):
+		self.executions = [0] * len(self.program)
+		self.jumps_taken = [0] * len(self.program)
 
 	def execute(self):
 		while self.program_counter < len(self.program):
-			instr = self.program[self.program_counter]
+			pc = self.program_counter
+			instr = self.program[pc]
 
 			try:
 				instr.execute(self)
 			except StopIteration:
 				break
 
+			if self.executions is not None:
+				self.executions[pc] += 1
+
+				if self.program_counter != pc:
+					self.jumps_taken[pc] += 1
+
+			self.steps += 1
 			self.program_counter += 1
 
 	# Creates a clone of the current office.
@@ -241,6 +274,11 @@ class Office:
 		copy.outbox = self.outbox
 		copy.hands = self.hands
 		copy.program_counter = self.program_counter
+		copy.steps = self.steps
+		copy.source_lines = self.source_lines
+		if self.executions is not None:
+			copy.executions = [*self.executions]
+			copy.jumps_taken = [*self.jumps_taken]
 		return copy
 
 	def __repr__(self):
@@ -274,6 +312,8 @@ BOSS_PASTE_ERROR = ("You can't paste that\n"
 def load_program(path, initial_floor=[]):
 	program = []
 	labels = {}
+	source_lines = []
+	source_line = None
 
 	floor_size = len(initial_floor)
 
@@ -285,6 +325,11 @@ def load_program(path, initial_floor=[]):
 
 			line = line.rstrip("\n")
 
+			# Comments marking the source line of the following instructions
+			match = re.fullmatch(r"\s*--\s*line\s+(\d+)\s*", line)
+			if match:
+				source_line = int(match[1])
+
 			# Remove comments
 			match = re.fullmatch(r"(.*?)--.*", line)
 			if match:
@@ -335,12 +380,66 @@ def load_program(path, initial_floor=[]):
 				raise BossError(BOSS_PASTE_ERROR
 						+ f"Unrecognised instruction: '{line}'\n")
 
+			source_lines.append(source_line)
+
 	# Swap jump parameters from label names to positions in the code
 	for instr in program:
 		if isinstance(instr, AbstractJump):
 			instr.param = labels[instr.param]
 
-	return Office(program, labels, initial_floor)
+	office = Office(program, labels, initial_floor)
+	office.source_lines = source_lines
+	return office
+
+# Add the counts collected by an office run with count_executions to a
+# profile, a dict in the format read by hcprofile.Profile.load, keyed on the
+# source lines given in the program. See hcprofile for details.
+def add_to_profile(profile, office):
+	lines = profile.setdefault("lines", {})
+	branches = profile.setdefault("branches", {})
+	labels = profile.setdefault("labels", {})
+
+	program = office.program
+	source_lines = office.source_lines
+
+	# Every line present in the program is recorded,
+	# so that lines which never ran are known to be cold.
+	for pc, instr in enumerate(program):
+		line = source_lines[pc]
+		if line is None:
+			continue
+
+		lines.setdefault(str(line), 0)
+		if isinstance(instr, (JumpZ, JumpN)):
+			branches.setdefault(str(line), [0, 0])
+
+	def enter(src, dest, count):
+		line = source_lines[dest]
+		if line is not None and (src is None or source_lines[src] != line):
+			lines[str(line)] += count
+
+	if len(program) > 0 and office.executions[0] > 0:
+		enter(None, 0, 1)
+
+	for pc, instr in enumerate(program):
+		executions = office.executions[pc]
+		taken = office.jumps_taken[pc]
+
+		if isinstance(instr, AbstractJump):
+			enter(pc, instr.param, taken)
+
+		if pc + 1 < len(program):
+			enter(pc, pc + 1, executions - taken)
+
+		line = source_lines[pc]
+		if line is not None and isinstance(instr, (JumpZ, JumpN)):
+			counts = branches[str(line)]
+			counts[0] += taken
+			counts[1] += executions - taken
+
+	for name, pc in office.labels.items():
+		if pc < len(program):
+			labels[name] = labels.get(name, 0) + office.executions[pc]
 
 # Generate numbers from the given file
 def read_input(file_in):
@@ -386,26 +485,67 @@ def main():
 
 	parser = argparse.ArgumentParser(description="Emulate the Human Resource Machine")
 	parser.add_argument("program", help="Input program filepath")
+	parser.add_argument("inboxes", nargs="*",
+			help="Files to read inboxes from, one value per line. The "
+				"program is run once for each. Defaults to standard input.")
+	parser.add_argument("--floor", default=None,
+			help="Comma-separated initial values of each tile on the floor, "
+				"leaving empty tiles blank, eg. ',,,0'")
+	parser.add_argument("--profile", default=None,
+			help="Write a profile of how often each source line of the "
+				"program ran to this path, for use with hccompile.py "
+				"--profile. The program should be compiled with --line-info.")
 
 	args = parser.parse_args()
 
-	try:
-		office = load_program(args.program)
-	except BossError as e:
-		sys.stderr.write(str(e))
-		sys.exit(1)
-
-	office.inbox = read_input(sys.stdin)
-	office.outbox = file_outbox(sys.stdout)
+	floor = []
+	if args.floor is not None:
+		for value in args.floor.split(","):
+			value = value.strip()
+			if value == "":
+				floor.append(None)
+			elif re.fullmatch(r"-?\d+", value):
+				floor.append(int(value))
+			else:
+				floor.append(value)
 
 	try:
-		office.execute()
+		office = load_program(args.program, floor)
 	except BossError as e:
 		sys.stderr.write(str(e))
 		sys.exit(1)
-	except InboxError as e:
-		sys.stderr.write(str(e))
-		sys.exit(2)
+
+	profile = {}
+	for path in args.inboxes or [None]:
+		run = office.clone()
+		run.outbox = file_outbox(sys.stdout)
+		if args.profile is not None:
+			run.count_executions()
+
+		try:
+			if path is None:
+				run.inbox = read_input(sys.stdin)
+				run.execute()
+			else:
+				with open(path) as f:
+					run.inbox = read_input(f)
+					run.execute()
+		except BossError as e:
+			sys.stderr.write(str(e))
+			sys.exit(1)
+		except InboxError as e:
+			sys.stderr.write(str(e))
+			sys.exit(2)
+
+		if args.profile is not None:
+			add_to_profile(profile, run)
+
+	if args.profile is not None:
+		import json
+
+		with open(args.profile, "w") as f:
+			json.dump(profile, f, indent="\t")
+			f.write("\n")
 
 if __name__ == "__main__":
 	main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# === Determinism tests ===
+#
+# The compiler should produce exactly the same program for a given source
+# file every time it is run, regardless of Python's hash seed.
+
+import unittest
+import os
+import subprocess
+
+from common_test import TEST_SOURCE_DIR
+
+# Hash seeds to compile each program under
+HASH_SEEDS = ["0", "1", "42", "random"]
+
+class TestHashSeed(unittest.TestCase):
+	def compile_with_seed(self, src_path, seed):
+		env = {**os.environ, "PYTHONHASHSEED": seed}
+		process = subprocess.run(["./hccompile.py", src_path],
+				check=True, capture_output=True, env=env)
+		return process.stdout.decode()
+
+	def assert_deterministic(self, subdir):
+		src_dir = os.path.join(TEST_SOURCE_DIR, subdir)
+
+		for filename in sorted(os.listdir(src_dir)):
+			if not filename.endswith(".hc"):
+				continue
+
+			src_path = os.path.join(src_dir, filename)
+			with self.subTest(filename):
+				expected = self.compile_with_seed(src_path, HASH_SEEDS[0])
+
+				for seed in HASH_SEEDS[1:]:
+					self.assertEqual(expected,
+							self.compile_with_seed(src_path, seed),
+							f"Output of {filename} differs between "
+								f"hash seeds {HASH_SEEDS[0]} and {seed}")
+
+	def test_solutions(self):
+		self.assert_deterministic("solutions")
+
+if __name__ == "__main__":
+	unittest.main()
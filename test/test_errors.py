@@ -58,5 +58,29 @@ class TestVariables(AbstractTests.TestError):
 				"Attempting to use a variable before it is assigned should "
 						"produce a useful error message")
 
+class TestDivision(AbstractTests.TestError):
+	def test_div_zero(self):
+		self.assertError("errors/div-zero.hc",
+				"Division by zero",
+				"Dividing by a constant zero should produce "
+						"an error message")
+
+class TestConstants(AbstractTests.TestError):
+	def test_no_values(self):
+		self.assertError("errors/constant-no-values.hc",
+				"Unable to create the constant 1 on line 5, "
+					"as no values are known to be available to create it from",
+				"A constant with nothing to create it from should produce "
+						"an informative error message")
+
+class TestMaxSize(AbstractTests.TestError):
+	def test_too_small(self):
+		self.assertError("solutions/y20-multiplication-workshop.hc",
+				"Unable to fit program in 20 instructions. "
+					"The smallest program found has 26 instructions",
+				"A size limit smaller than any program the compiler can "
+						"produce should report the closest size found",
+				["--max-size", "20"])
+
 if __name__ == "__main__":
 	unittest.main()
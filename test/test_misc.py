@@ -5,6 +5,12 @@
 # These are tests of programs which should be valid, and compile correctly,
 # but don't make sense to include as an actual solution test.
 
+import os
+import subprocess
+import tempfile
+import unittest
+
+import hrm
 from common_test import AbstractTests
 
 class TestMixedIndent(AbstractTests.TestEcho):
@@ -53,6 +59,118 @@ class TestConstMul(AbstractTests.TestEcho):
 	source_path = "misc/const-mul.hc"
 	floor_size = 16
 
+class TestMulConstChain(AbstractTests.TestValidProgram):
+	source_path = "misc/mul-const-chain.hc"
+	floor_size = 16
+
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [x * 23 for x in inbox]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0],
+			[1, 2, 3, 4, 5],
+			[43, -43, 17, -21],
+			[-1, 0, 1, 8, -9, 30],
+		])
+
+class TestMulNegConst(AbstractTests.TestMultiply):
+	# Tests multiplication by a negative constant
+	source_path = "misc/mul-neg-const.hc"
+	factor = -7
+
+class TestMultiplySigns(AbstractTests.TestValidProgram):
+	source_path = "misc/multiply-signs.hc"
+	floor_size = 16
+
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [a * b for a, b in zip(inbox[::2], inbox[1::2])]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0, 0, 0, 5, 5, 0, 0, -5, -5, 0],
+			[1, 1, -1, 1, 1, -1, -1, -1],
+			[6, 7, -6, 7, 6, -7, -6, -7],
+			[3, 300, 300, 3, -3, 300, 300, -3, -300, -3],
+			[31, 32, -32, 31, 31, -31, -1, 999, 999, -1],
+			[16, 62, 17, 58, -23, 43, 2, 499, -998, 1],
+		])
+
+	# Operands are usually small, so the short linear loop should be chosen
+	# over the much larger binary decomposition
+	def test_linear(self):
+		self.assertLess(len(self.office.program), 100)
+
+class TestDivide(AbstractTests.TestValidProgram):
+	source_path = "misc/divide.hc"
+	floor_size = 16
+
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [result for x, y in zip(inbox[::2], inbox[1::2])
+				for result in (x // y, x % y)]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0, 1, 0, -1, 1, 1, 1, -1, -1, 1, -1, -1],
+			[7, 2, -7, 2, 7, -2, -7, -2],
+			[6, 3, -6, 3, 6, -3, -6, -3],
+			[2, 7, -2, 7, 2, -7, -2, -7],
+			[999, 1, -999, 1, 999, -1, -999, -1],
+			[999, 2, -999, 2, 998, 499, -999, 999],
+			[914, 7, 849, 149, 500, 999, 999, 500],
+		])
+
+class TestDivideConst(AbstractTests.TestValidProgram):
+	source_path = "misc/divide-const.hc"
+	floor_size = 16
+
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [result for x in inbox
+				for result in (x // 10, x % 10, x // -3, x % -3)]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0, 1, 2, 3, 9, 10, 11],
+			[-1, -2, -3, -9, -10, -11],
+			[999, -999, 500, -500, 123, -456],
+		])
+
+class TestDivmodConst(AbstractTests.TestValidProgram):
+	source_path = "misc/divmod-const.hc"
+	floor_size = 16
+
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [result for x in inbox for result in (x // 7, x % 7)]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0, 1, 6, 7, 8, 13, 14],
+			[-1, -6, -7, -8, -14],
+			[999, -999, 500, -500],
+		])
+
+# The same program, optimising for size
+class TestDivmodConstSize(TestDivmodConst):
+	compiler_args = ["-O", "size"]
+	exec_path = "misc/divmod-const-size.hrm"
+
+	# The divisor is built from one using four additions. The tile holding
+	# it after the division still holds it for the modulo, so shouldn't
+	# be built again.
+	def test_divisor_built_once(self):
+		self.assertEqual(sum(isinstance(instr, hrm.Add)
+				for instr in self.office.program), 4)
+
 class TestAddMulPrecedence(AbstractTests.TestValidProgram):
 	source_path = "misc/add-mul-precedence.hc"
 	floor_size = 16
@@ -278,6 +396,104 @@ class TestLogicalXnor(AbstractTests.TestValidProgram):
 			 [  0,   0,                    -5, -11]),
 		])
 
+class TestXorSharedOperand(AbstractTests.TestValidProgram):
+	source_path = "misc/xor-shared-operand.hc"
+	floor_size = 16
+
+	# This program tests XOR where the value compared by the right condition
+	# is costly to calculate. Pairs of values are output only if exactly one
+	# of x and x + 5y is negative.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		outbox = []
+		for x, y in zip(inbox[::2], inbox[1::2]):
+			if (x < 0) != (x + 5 * y < 0):
+				outbox.extend([x, y])
+
+		return outbox
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[1, -1],
+			[-3, 1],
+			[5, -1, -5, 1, 4, 0, -4, 0],
+			[10, -2, -10, 2, 10, -3, -10, 3, 0, 0, 0, -1, 0, 1],
+		])
+
+# The same program, optimising for size,
+# which calculates x + 5y only once
+class TestXorSharedOperandSize(TestXorSharedOperand):
+	compiler_args = ["-O", "size"]
+	exec_path = "misc/xor-shared-operand-size.hrm"
+
+class TestNestedXor(AbstractTests.TestValidProgram):
+	source_path = "misc/nested-xor.hc"
+	floor_size = 16
+
+	# This program tests XORs nested inside each other. Groups of four values
+	# are read, and the first is output if an odd number are negative, or the
+	# second otherwise.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		outbox = []
+		for i in range(0, len(inbox) - 3, 4):
+			group = inbox[i:i + 4]
+			odd = sum(x < 0 for x in group) % 2 == 1
+			outbox.append(group[0] if odd else group[1])
+
+		return outbox
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[1, 2, 3, 4],
+			[-1, 2, 3, 4],
+			[1, -2, -3, 4, -1, -2, -3, -4, 0, 0, 0, -9],
+			[5, -5, 0, 7, -7, 8, -1, -2, 3, 3, 3, -3, -6, 6, 6, 6],
+		])
+
+# Conditions nested within XORs should be shared between each copy of the
+# right side, so that the size of the program grows linearly with the depth
+# of nesting, rather than exponentially.
+class TestNestedXorGrowth(unittest.TestCase):
+	DEPTHS = range(2, 9)
+
+	# Program comparing the signs of the given number of inputs,
+	# eg. (v0 < 0 != (v1 < 0 != v2 < 0))
+	@staticmethod
+	def get_source(depth):
+		names = [f"v{i}" for i in range(depth)]
+		cond = f"{names[-1]} < 0"
+		for name in reversed(names[:-1]):
+			cond = f"({name} < 0 != {cond})"
+
+		return ("forever\n"
+			+ "".join(f"\t{name} = input\n" for name in names)
+			+ f"\tif {cond}\n"
+			+ "\t\toutput v0\n"
+			+ "\telse\n"
+			+ "\t\toutput v1\n")
+
+	def get_size(self, depth, tmp_dir):
+		src_path = os.path.join(tmp_dir, f"xor-{depth}.hc")
+		with open(src_path, "w") as f:
+			f.write(self.get_source(depth))
+
+		process = subprocess.run(["./hccompile.py", src_path],
+				check=True, capture_output=True)
+		return len([line for line in process.stdout.decode().splitlines()
+				if line != "" and not line.startswith("--")
+					and not line.endswith(":")])
+
+	def test_linear_growth(self):
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			sizes = [self.get_size(depth, tmp_dir) for depth in self.DEPTHS]
+
+		growth = [b - a for a, b in zip(sizes, sizes[1:])]
+		self.assertLessEqual(max(growth), min(growth) + 2,
+				f"Sizes for depths {[*self.DEPTHS]}: {sizes}")
+
 class TestConstXor(AbstractTests.TestMultiply):
 	source_path = "misc/const-xor.hc"
 	factor = 2
@@ -328,6 +544,22 @@ class TestMulEquals(AbstractTests.TestMultiply):
 	source_path = "misc/mul-equals.hc"
 	factor = 4
 
+class TestDivEquals(AbstractTests.TestValidProgram):
+	source_path = "misc/div-equals.hc"
+	floor_size = 16
+
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [y for x in inbox for y in (x // 4, x // 4 % 3)]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0, 1, 3, 4, 5, 11, 12, 13],
+			[-1, -3, -4, -5, -11, -12, -13],
+			[999, -999, 400, -400],
+		])
+
 class TestWhile(AbstractTests.TestValidProgram):
 	source_path = "misc/while.hc"
 
@@ -349,6 +581,494 @@ class TestWhile(AbstractTests.TestValidProgram):
 			([ -4,  5,  0, -9, 2], [5, 4, 3, 2, 1, 2, 1]),
 		])
 
+class TestWhileRotated(AbstractTests.TestValidProgram):
+	source_path = "misc/while-rotated.hc"
+	floor_size = 16
+
+	# This file tests while loops which may be rotated.
+	# Pairs of x and y are read, and each number from x up to -1
+	# is output, or up to 0 if y is zero.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		outbox = []
+		for x, y in zip(inbox[::2], inbox[1::2]):
+			outbox.extend(range(x, 1 if y == 0 else 0))
+
+		return outbox
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[-3, 1],
+			[-3, 0],
+			[0, 0, 0, 5, 4, 0],
+			[-1, -1, -2, 0, 3, 3, -5, 7],
+		])
+
+	# The loop is rotated, so that its condition jumps straight back to the
+	# start of its body. Optimising for size, the condition isn't copied to
+	# before the loop, which is entered by jumping to the condition instead,
+	# so each run of the loop takes an extra step to load x there.
+	def test_rotated(self):
+		size_office = self.compile_variant("-O", "size")
+
+		def steps_per_run(office):
+			steps = [self.run_program(inbox, self.get_expected_outbox(inbox),
+						office).steps
+					for inbox in ([0, 1], [-10, 1])]
+			return (steps[1] - steps[0]) / 10
+
+		self.assertLess(steps_per_run(self.office), steps_per_run(size_office))
+
+class TestTailDuplicate(AbstractTests.TestValidProgram):
+	source_path = "misc/tail-duplicate.hc"
+	floor_size = 16
+
+	# This file tests copying the end of a loop body into the branches of
+	# an if statement. Pairs of x and y are read, and x is output, or zero
+	# if x is negative, followed by y.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		outbox = []
+		for x, y in zip(inbox[::2], inbox[1::2]):
+			outbox += [max(x, 0), y]
+
+		return outbox
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[3, 1],
+			[-3, 0],
+			[0, -2, -7, 5, 4, 0],
+			[-1, "A", 2, "B", -5, -5, 8, 8],
+		])
+
+	# The outputs are copied into the branch for negative x, so it doesn't
+	# need to jump back to them. Optimising for size, they aren't copied.
+	def test_tail_copied(self):
+		size_office = self.compile_variant("-O", "size")
+
+		def count_outputs(office):
+			return sum(isinstance(instr, hrm.Outbox)
+					for instr in office.program)
+
+		self.assertEqual(count_outputs(size_office), 2)
+		self.assertEqual(count_outputs(self.office), 4)
+
+		inbox = [-3, 1]
+		expected = self.get_expected_outbox(inbox)
+		self.assertLess(self.run_program(inbox, expected).steps,
+				self.run_program(inbox, expected, size_office).steps)
+
+class TestJumpThreading(AbstractTests.TestValidProgram):
+	source_path = "misc/jump-threading.hc"
+	floor_size = 16
+
+	# This file tests redirecting jumps past a condition already known to
+	# pass. x is read, and if it is negative or zero, the next value is
+	# output, otherwise x is.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		outbox = []
+		inbox = iter(inbox)
+		for x in inbox:
+			if x <= 0:
+				outbox.append(next(inbox))
+			else:
+				outbox.append(x)
+
+		return outbox
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[3],
+			[-3, 7],
+			[0, -2, 5, -7, 4],
+			[-1, "A", 2, 0, "B", -5, -5, 8],
+		])
+
+	# For negative x, x is known to be zero once it's been set, so the jump
+	# for negative values should go straight to the output of the next
+	# value, without testing x again. Optimising for size, it is tested.
+	def test_threaded(self):
+		def count_tests(office):
+			office = office.clone()
+			office.count_executions()
+
+			inbox = [-3, 7]
+			run = self.run_program(inbox, self.get_expected_outbox(inbox),
+					office)
+			return sum(count for instr, count
+					in zip(run.program, run.executions)
+					if isinstance(instr, (hrm.JumpZ, hrm.JumpN)))
+
+		self.assertEqual(count_tests(self.office), 1)
+		self.assertEqual(count_tests(self.compile_variant("-O", "size")), 2)
+
+class TestCompareReuse(AbstractTests.TestValidProgram):
+	source_path = "misc/compare-reuse.hc"
+	floor_size = 16
+
+	# This file tests reusing the difference between two variables
+	# from one comparison in a later comparison of the same variables.
+	# Pairs of values are read, and the lesser is output, or both if
+	# they are equal.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		outbox = []
+		for a, b in zip(inbox[::2], inbox[1::2]):
+			if a < b:
+				outbox.append(a)
+			elif a == b:
+				outbox += [a, b]
+			else:
+				outbox.append(b)
+
+		return outbox
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[3, 7],
+			[7, 3],
+			[5, 5],
+			[-2, -2, 0, 4, 9, -9, 0, 0],
+		])
+
+	# Both comparisons should share a single subtraction
+	def test_single_subtraction(self):
+		self.assertEqual(sum(isinstance(instr, hrm.Sub)
+				for instr in self.office.program), 1)
+
+class TestCommonSubexpression(AbstractTests.TestValidProgram):
+	source_path = "misc/common-subexpression.hc"
+	floor_size = 16
+
+	# This file tests reusing the value of an expression calculated
+	# earlier. Pairs of values are read, and their product is output,
+	# followed by the square of their difference, the product of the first
+	# plus one and the second, and the original product again.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		outbox = []
+		for a, b in zip(inbox[::2], inbox[1::2]):
+			outbox += [a * b, (a - b) ** 2, (a + 1) * b, a * b]
+
+		return outbox
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[3, 7],
+			[-4, 6],
+			[0, 0, -1, -1],
+			[12, -9, 5, 5],
+		])
+
+	# Each multiplication loops bumping a counter up, and the increment
+	# bumps a up, so there should be one for each of the three
+	# multiplications which must be calculated, and one more.
+	def test_multiplications(self):
+		self.assertEqual(sum(isinstance(instr, hrm.BumpUp)
+				for instr in self.office.program), 4)
+
+class TestSignRange(AbstractTests.TestValidProgram):
+	source_path = "misc/sign-range.hc"
+	floor_size = 16
+
+	# This file tests removing conditions decided by the sign of a value
+	# tested earlier. Negative values are output twice, followed by the
+	# value plus one if it is still negative. Other values are output
+	# once, followed by one if the value is zero.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		outbox = []
+		for x in inbox:
+			if x < 0:
+				outbox += [x, x]
+				if x + 1 < 0:
+					outbox.append(x + 1)
+			else:
+				outbox.append(x)
+				if x == 0:
+					outbox.append(x + 1)
+
+		return outbox
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0],
+			[-1],
+			[-2, 5],
+			[3, -7, 0, -1, 0, 999, -999],
+		])
+
+	# Each value's sign should only be tested once
+	def test_single_sign_test(self):
+		self.assertEqual(sum(isinstance(instr, hrm.JumpN)
+				for instr in self.office.program), 2)
+
+class TestKnownArithmetic(AbstractTests.TestValidProgram):
+	source_path = "misc/known-arithmetic.hc"
+	initial_memory = [None] * 15 + [0]
+
+	# This file tests tracking the results of arithmetic on known values,
+	# and on values relative to variables. Each value is output plus one,
+	# then twice more unchanged.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [y for x in inbox for y in (x + 1, x, x)]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0],
+			[-1, 5],
+			[998, -999, 12, 0],
+		])
+
+	# b is only copied from a, and n is only compared with a known value,
+	# so neither should need to be loaded, or compared at runtime.
+	def test_folded(self):
+		program = self.office.program
+		self.assertEqual(sum(isinstance(instr, hrm.CopyFrom)
+				for instr in program), 2)
+		self.assertFalse(any(isinstance(instr, hrm.JumpZ)
+				for instr in program))
+
+class TestCopyPropagation(AbstractTests.TestValidProgram):
+	source_path = "misc/copy-propagation.hc"
+	floor_size = 16
+
+	# This file tests reading copies of a variable from the original, so that
+	# the copies are never saved, and comparing copies at compile time.
+	# Pairs of values are read, and the second is output, then the first
+	# twice.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [y for a, b in zip(inbox[::2], inbox[1::2]) for y in (b, a, a)]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[1, 2],
+			[0, -5, "A", "B"],
+			[7, 7, -999, 999, 0, 0],
+		])
+
+	def test_copies_removed(self):
+		program = self.office.program
+		self.assertEqual(sum(isinstance(instr, hrm.CopyTo)
+				for instr in program), 1)
+		self.assertFalse(any(isinstance(instr, (hrm.Sub, hrm.JumpZ))
+				for instr in program))
+
+class TestUnreachableBranch(AbstractTests.TestValidProgram):
+	source_path = "misc/unreachable-branch.hc"
+	initial_memory = [None] * 15 + [0]
+
+	# This file tests deciding comparisons of a variable which would only
+	# change in a branch which is never taken. Each non-zero value in the
+	# inbox is output.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [x for x in inbox if x != 0]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0, 0],
+			[1, 0, -3, "A"],
+			[0, 999, -999, 0],
+		])
+
+	def test_branch_removed(self):
+		program = self.office.program
+		self.assertEqual(sum(isinstance(instr, hrm.JumpZ)
+				for instr in program), 1)
+		self.assertFalse(any(isinstance(instr, hrm.CopyTo)
+				and instr.param == 15 for instr in program))
+
+	# The peephole optimiser removes a reload of the value just saved, so
+	# the program only fits in 5 instructions once it has run
+	def test_max_size(self):
+		office = self.compile_variant("--max-size", "5")
+		self.assertLessEqual(len(office.program), 5)
+		self.run_program([1, 0, -3], [1, -3], office)
+
+class TestConstantPropagation(AbstractTests.TestValidProgram):
+	source_path = "misc/constant-propagation.hc"
+	initial_memory = [None] * 14 + [0, 1]
+
+	# This file tests finding values which are constant on every path which
+	# may be followed, where a branch which is never taken would change them.
+	# Each value in the inbox is output.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [*inbox]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0, 0],
+			[1, 0, -3, "A"],
+			[0, 999, -999, 0],
+		])
+
+	# The flag may only be known to stay zero once the branch setting it is
+	# known never to be taken, so neither comparison is decided by merging
+	# what is known about each path into the second.
+	def test_branches_removed(self):
+		self.assertFalse(any(isinstance(instr, (hrm.JumpZ, hrm.JumpN))
+				for instr in self.office.program))
+
+class TestLoopInvariant(AbstractTests.TestValidProgram):
+	source_path = "misc/loop-invariant.hc"
+	initial_memory = [None] * 15 + [0]
+
+	# This file tests moving calculations which give the same value on each
+	# run of a loop to before the loop. Pairs of values a, b are read, and
+	# b - 1 + x is output for each x counting up from 0 while x < a * 2 - 1.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [b - 1 + x for a, b in zip(inbox[::2], inbox[1::2])
+				for x in range(max(a * 2 - 1, 0))]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0, 5],
+			[1, 0, 3, -4],
+			[-2, 7, 4, 100, 2, -50],
+		])
+
+	def test_loop_body_size(self):
+		program = self.office.program
+		loop_start = max(self.office.labels.values())
+		self.assertLessEqual(len(program) - loop_start, 7)
+
+class TestLoopInvariantEntry(AbstractTests.TestValidProgram):
+	source_path = "misc/loop-invariant-entry.hc"
+	initial_memory = [None] * 14 + [1, 0]
+
+	# This file tests a loop which may be entered part way through.
+	# For each positive value, the squares of each value counting down to 1
+	# are output, then the value left is output if the comparisons agree.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		outbox = []
+		for a in inbox:
+			while a > 0:
+				outbox.append(a * a)
+				a -= 1
+
+			if ((1 > a) != ((5 - a) != a)) == (((a // 5) != a) == (a < 2)):
+				outbox.append(a)
+
+		return outbox
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0],
+			[3, -1, 0, -7],
+			[-5, 2, -12, 1, 5, -20],
+		])
+
+class TestUnroll(AbstractTests.TestValidProgram):
+	source_path = "misc/unroll.hc"
+	compiler_args = ["--unroll", "4"]
+	floor_size = 1
+
+	# This file tests unrolling loops, so that copies of the loop run one
+	# after the other. Each positive value in the inbox is output doubled.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [x * 2 for x in inbox if x > 0]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[1],
+			[0, -4, 3],
+			[5, 6, -7, 8, 9, 0, 10, 11],
+		])
+
+	# Only the last copy needs to jump back to the first
+	def test_unrolled(self):
+		program = self.office.program
+		self.assertGreater(sum(isinstance(instr, hrm.Outbox)
+				for instr in program), 1)
+		self.assertEqual(sum(type(instr) is hrm.Jump
+				for instr in program), 1)
+
+class TestConstantSynthesis(AbstractTests.TestValidProgram):
+	source_path = "misc/constant-synthesis.hc"
+	floor_size = 16
+
+	# This file tests creating constants which no tile holds, from other
+	# values known at the time. Each value read is output after a series
+	# of constants.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [y for x in inbox for y in (1, -3, 50, 999, x)]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0],
+			[7, -2],
+			[999, -999, 1, 50],
+		])
+
+	# Letters subtracted from themselves also give zero
+	def test_letters(self):
+		self.run_tests_auto([
+			["A"],
+			["Z", 4, "B"],
+		])
+
+# The same program, optimising for size
+class TestConstantSynthesisSize(TestConstantSynthesis):
+	compiler_args = ["-O", "size"]
+	exec_path = "misc/constant-synthesis-size.hrm"
+
+class TestConstAfterInput(AbstractTests.TestValidProgram):
+	source_path = "misc/const-after-input.hc"
+	floor_size = 16
+
+	# This file tests creating a constant straight after input, where the
+	# value in the hands is the only one known to be available. Only the
+	# first value is read, and 7 is output.
+	def test_output(self):
+		self.run_tests([
+			([], []),
+			([3], [7]),
+			([-999, 4], [7]),
+			(["A"], [7]),
+		])
+
+class TestConstAfterInputForever(AbstractTests.TestValidProgram):
+	source_path = "misc/const-after-input-forever.hc"
+	floor_size = 16
+
+	# As TestConstAfterInput, but inside a forever loop,
+	# so 5 is output for each value read.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [5] * len(inbox)
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0],
+			[5, -5, 999],
+			["A", 1, "Z"],
+		])
+
 class TestIncrement(AbstractTests.TestValidProgram):
 	source_path = "misc/increment.hc"
 	floor_size = 16
@@ -429,6 +1149,35 @@ class TestAddVarConst(AbstractTests.TestValidProgram):
 			([ 8,  9,   0,   4, -9], [9, 10,   1,   5, -8]),
 		])
 
+class TestAddLargeConst(AbstractTests.TestValidProgram):
+	source_path = "misc/add-large-const.hc"
+	initial_memory = [None] * 15 + [10]
+
+	# This program tests addition and subtraction of large and negative
+	# constants, which are cheaper to build in a tile than to bump towards.
+	@staticmethod
+	def get_expected_outbox(inbox):
+		return [y for x in inbox for y in (x + 50, x - 200, x - 3, x + 10)]
+
+	def test_output(self):
+		self.run_tests_auto([
+			[],
+			[0],
+			[7, -42],
+			[300, -500, 600, 3],
+		])
+
+	# 50 and 200 should be built in a tile by adding up the 10 on the floor,
+	# rather than bumped towards, whichever goal the program is compiled for.
+	# Only 3 is close enough to bump towards.
+	def test_constants_built(self):
+		for goal in ["speed", "size"]:
+			with self.subTest(goal):
+				program = self.compile_variant("-O", goal).program
+				self.assertLess(len(program), 50)
+				self.assertLessEqual(sum(isinstance(instr, hrm.AbstractBump)
+						for instr in program), 3)
+
 class TestBooleanLiteral(AbstractTests.TestEcho):
 	# This file tests use of boolean literal keywords.
 	source_path = "misc/boolean-literal.hc"
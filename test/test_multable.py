@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# === Multiplication table tests ===
+#
+# Checks the precomputed table of constant multiplication strategies.
+
+import unittest
+
+import hcmultable
+
+class TestMultiplicationTable(unittest.TestCase):
+	# Every chain in the table should multiply by the value it is stored under
+	def test_chain_values(self):
+		for n in range(hcmultable.TABLE_MIN, hcmultable.TABLE_MAX + 1):
+			if n == 0:
+				continue
+
+			with self.subTest(n):
+				self.assertEqual(n,
+						hcmultable.evaluate_chain(hcmultable.get_chain(n)))
+
+	# The table should be at least as good as a fresh search using only
+	# additions, ie. it should be up to date
+	def test_chain_optimal(self):
+		for n in range(1, 100):
+			with self.subTest(n):
+				self.assertLessEqual(len(hcmultable.get_chain(n)),
+						len(hcmultable.find_chain(n)))
+
+	# Negative chains should never be worse than negating the positive chain
+	def test_negative_chains(self):
+		for n in range(1, hcmultable.TABLE_MAX + 1):
+			with self.subTest(-n):
+				self.assertLessEqual(len(hcmultable.get_chain(-n)),
+						len(hcmultable.get_chain(n)) + 2)
+
+	# Subtraction should be used where it is cheaper.
+	# 863x takes 21 operations using only additions, but 864x - x takes 19.
+	def test_subtraction(self):
+		self.assertEqual(19, len(hcmultable.get_chain(863)))
+
+	# Chains should reuse intermediate sums where it helps.
+	# Factors and an offset alone need 10 operations to multiply by 23,
+	# but 23x = 2 * 10x + 3x takes only 9.
+	def test_reuses_sums(self):
+		self.assertEqual(9, len(hcmultable.get_chain(23)))
+
+if __name__ == "__main__":
+	unittest.main()
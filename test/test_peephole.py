@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# === Peephole optimiser tests ===
+#
+# Checks the rewrites made to the lines of finished programs.
+
+import unittest
+import os
+import random
+import tempfile
+
+import hrm
+import hcpeephole
+
+HEADER = "-- HUMAN RESOURCE MACHINE PROGRAM --"
+
+FLOOR_SIZE = 4
+
+# Program with a chance for each of the rules
+PROGRAM = [
+	"a:",
+	"INBOX",
+	"COPYTO 0",
+	"COPYFROM 0",
+	"ADD 0",
+	"SUB 0",
+	"JUMPZ b",
+	"COPYFROM 0",
+	"COPYTO 0",
+	"OUTBOX",
+	"JUMP c",
+	"b:",
+	"JUMP a",
+	"COPYFROM 1",
+	"c:",
+	"JUMP b",
+]
+
+class TestPeephole(unittest.TestCase):
+	def assert_optimised(self, lines, expected):
+		self.assertEqual(hcpeephole.optimise(lines), expected)
+
+	def test_save_load(self):
+		self.assert_optimised(["COPYTO 2", "COPYFROM 2", "OUTBOX"],
+				["COPYTO 2", "OUTBOX"])
+
+	def test_load_save(self):
+		self.assert_optimised(["COPYFROM 2", "COPYTO 2", "OUTBOX"],
+				["COPYFROM 2", "OUTBOX"])
+
+	def test_load_load(self):
+		self.assert_optimised(["COPYFROM 1", "COPYFROM 2", "OUTBOX"],
+				["COPYFROM 2", "OUTBOX"])
+
+	def test_add_sub(self):
+		self.assert_optimised(["INBOX", "ADD 1", "SUB 1", "OUTBOX"],
+				["INBOX", "OUTBOX"])
+		self.assert_optimised(["INBOX", "SUB 1", "ADD 1", "OUTBOX"],
+				["INBOX", "OUTBOX"])
+
+	# Different tiles shouldn't cancel out
+	def test_different_fields(self):
+		lines = ["INBOX", "COPYTO 1", "COPYFROM 2", "ADD 1", "SUB 2", "OUTBOX"]
+		self.assert_optimised(lines, lines)
+
+	def test_jump_to_next(self):
+		self.assert_optimised(["a:", "INBOX", "JUMPN b", "b:", "OUTBOX",
+				"JUMP a"], ["a:", "INBOX", "OUTBOX", "JUMP a"])
+
+	def test_dead_after_jump(self):
+		self.assert_optimised(["a:", "INBOX", "OUTBOX", "JUMP a", "INBOX"],
+				["a:", "INBOX", "OUTBOX", "JUMP a"])
+
+	# Code after a JUMP should be kept if something else jumps to it
+	def test_label_after_jump(self):
+		lines = ["a:", "INBOX", "JUMPZ b", "JUMP a", "b:", "OUTBOX", "JUMP a"]
+		self.assert_optimised(lines, lines)
+
+	def test_thread_jumps(self):
+		self.assert_optimised(["a:", "INBOX", "JUMPZ b", "OUTBOX", "JUMP a",
+				"b:", "JUMP c", "c:", "JUMP a"],
+				["a:", "INBOX", "JUMPZ a", "OUTBOX", "JUMP a"])
+
+	# Jumps into an endless loop of JUMPs should be left alone
+	def test_jump_cycle(self):
+		self.assert_optimised(["INBOX", "JUMPZ a", "OUTBOX", "a:", "JUMP b",
+				"b:", "JUMP a"], ["INBOX", "JUMPZ a", "OUTBOX", "a:", "JUMP a"])
+
+	# Comments between the lines should not stop a pattern matching
+	def test_comments(self):
+		self.assert_optimised(["INBOX", "COPYTO 0", "-- line 3", "COPYFROM 0",
+				"OUTBOX"], ["INBOX", "COPYTO 0", "-- line 3", "OUTBOX"])
+
+	# The optimised program should give the same output as the original,
+	# in no more steps
+	def test_emulated(self):
+		optimised = hcpeephole.optimise(PROGRAM)
+		self.assertLess(len(optimised), len(PROGRAM))
+
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			offices = []
+			for name, lines in (("original", PROGRAM), ("optimised", optimised)):
+				path = os.path.join(tmp_dir, name + ".hrm")
+				with open(path, "w") as f:
+					f.write("\n".join([HEADER, *lines]) + "\n")
+
+				offices.append(hrm.load_program(path, [None] * FLOOR_SIZE))
+
+		rng = random.Random(0)
+		for _ in range(20):
+			inbox = [rng.randint(-99, 99) for _ in range(rng.randint(0, 10))]
+
+			with self.subTest(inbox):
+				runs = []
+				for office in offices:
+					run = office.clone()
+					outbox = []
+					run.inbox = iter(inbox)
+					run.outbox = hrm.list_outbox(outbox)
+					run.execute()
+					runs.append((outbox, run.steps))
+
+				(original_out, original_steps), (new_out, new_steps) = runs
+				self.assertEqual(new_out, original_out)
+				self.assertLessEqual(new_steps, original_steps)
+
+if __name__ == "__main__":
+	unittest.main()
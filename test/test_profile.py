@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# === Profile tests ===
+#
+# Programs compiled with --line-info may be profiled by running them in the
+# emulator, and the profile passed back to the compiler with --profile.
+
+import unittest
+import os
+import json
+import subprocess
+import tempfile
+
+import hrm
+from common_test import TEST_SOURCE_DIR
+
+SOURCE_PATH = os.path.join(TEST_SOURCE_DIR, "misc/profile-if.hc")
+
+# All negative, so that the then branch of the if statement is
+# always taken, and the else branch never is
+INBOX = [-5, -3, -7, -1, -12, -2]
+
+FLOOR_SIZE = 4
+
+class TestProfile(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.tmp_dir.cleanup()
+
+	def compile(self, *args):
+		exe_path = os.path.join(self.tmp_dir.name, "program.hrm")
+		with open(exe_path, "w") as exe:
+			subprocess.run(["./hccompile.py", *args, SOURCE_PATH],
+					check=True, stdout=exe)
+
+		return hrm.load_program(exe_path, [None] * FLOOR_SIZE)
+
+	def run_office(self, office):
+		run = office.clone()
+		outbox = []
+		run.inbox = iter(INBOX)
+		run.outbox = hrm.list_outbox(outbox)
+		run.count_executions()
+		run.execute()
+
+		self.assertEqual(outbox, [x - 1 if x < 0 else 2 * x for x in INBOX])
+		return run
+
+	def write_profile(self):
+		run = self.run_office(self.compile("--line-info"))
+
+		profile = {}
+		hrm.add_to_profile(profile, run)
+
+		profile_path = os.path.join(self.tmp_dir.name, "profile.json")
+		with open(profile_path, "w") as f:
+			json.dump(profile, f)
+
+		return (profile, profile_path)
+
+	def test_counts(self):
+		profile, _ = self.write_profile()
+
+		# Input is taken once for each item,
+		# plus once more to find the inbox is empty.
+		self.assertEqual(profile["lines"]["9"], len(INBOX) + 1)
+		self.assertEqual(profile["lines"]["11"], len(INBOX))
+		self.assertEqual(profile["lines"]["13"], 0)
+		self.assertEqual(profile["branches"]["10"], [len(INBOX), 0])
+
+	# Without a profile, the output is copied into one branch of the if
+	# statement, so that neither branch needs to jump to it. With the
+	# profile, the else branch is known never to run, so isn't worth the
+	# extra instruction, but the then branch is still the faster.
+	def test_cold_branch_not_duplicated(self):
+		_, profile_path = self.write_profile()
+
+		plain = self.run_office(self.compile())
+		profiled = self.run_office(self.compile("--profile", profile_path))
+
+		self.assertLess(len(profiled.program), len(plain.program))
+		self.assertLessEqual(profiled.steps, plain.steps)
+
+	# When optimising for size, the output isn't duplicated, so one branch
+	# must jump to it. The profile lets the hot branch be the one which
+	# falls through instead.
+	def test_hot_branch_falls_through(self):
+		_, profile_path = self.write_profile()
+
+		plain = self.run_office(self.compile("-O", "size"))
+		profiled = self.run_office(self.compile("-O", "size",
+				"--profile", profile_path))
+
+		self.assertLess(profiled.steps, plain.steps)
+
+	def test_line_info_ignored(self):
+		plain = self.run_office(self.compile())
+		marked = self.run_office(self.compile("--line-info"))
+
+		self.assertEqual(len(marked.program), len(plain.program))
+		self.assertEqual(marked.steps, plain.steps)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import subprocess
+
 from common_test import AbstractTests
 
 class TestYear1(AbstractTests.TestValidProgram):
@@ -352,5 +354,31 @@ class TestYear20(AbstractTests.TestValidProgram):
 			([ 1,  1, 13,  0,  0, 12,  0,  0,  1,  0], [ 1,   0, 0,   0,   0]),
 		])
 
+# Year 20 again, optimising for size, which multiplies with a smaller loop
+class TestYear20Size(TestYear20):
+	compiler_args = ["-O", "size"]
+	exec_path = "solutions/y20-multiplication-workshop-size.hrm"
+
+# Year 20 again, with a size limit one less than the program compiled for
+# speed, but larger than the one compiled for size, so that the budget search
+# has to give up some speed, but not all of it
+class TestYear20MaxSize(TestYear20):
+	compiler_args = ["--max-size", "54"]
+	exec_path = "solutions/y20-multiplication-workshop-max-size.hrm"
+
+	def compile_with(self, *args):
+		process = subprocess.run(["./hccompile.py", *args, self.get_src()],
+				check=True, capture_output=True)
+		return process.stdout.decode()
+
+	def test_size(self):
+		self.assertLessEqual(len(self.office.program), 54)
+
+		with open(self.get_exe()) as f:
+			program = f.read()
+
+		self.assertNotEqual(program, self.compile_with())
+		self.assertNotEqual(program, self.compile_with("-O", "size"))
+
 if __name__ == "__main__":
 	unittest.main()